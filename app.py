@@ -1,35 +1,61 @@
+import csv
+import io
 import logging
+import re
 import time
-import uuid
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy, copy
-from threading import Thread
+from queue import Queue
 from urllib.parse import unquote
 
-from flask import Flask, render_template, request, redirect, url_for, jsonify
+from flask import Flask, Response, render_template, request, redirect, url_for, jsonify, stream_template
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, select
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
 import json
 
-from helpers.commands import exec_command
-from helpers.domain import lookup_user, lookup_group_members
-from models.share import Share
+from helpers.commands import exec_batch, exec_command, invalidate_reads, read_cache_stats
+from helpers.config import ConfigFile, config_stats, load_server_config
+from helpers.connections import local_runner_stats, ssh_pool_stats, web_pool_stats
+from helpers.domain import lookup_user, ldap_stats, invalidate_cache
+from helpers.fixer import desired_acl, fix_permissions as fix_permissions_on_server
+from helpers.importer import fetch_acl, fetch_tree, list_folders, probe_tree
+from helpers.inventory import inventory_stats
+from helpers.jobs import FINISHED, JobQueue
+from helpers import metrics
+from models.fingerprint import Fingerprint, store_fingerprints
+from models.job import Job
+from models.search import create_share_fts, search_shares, page_shares
+from models.share import Share, create_share_indexes, migrate_permission_column, reconcile_acl
 from models.base import Base
 from models.shareform import ShareForm
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your_secret_key'
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///app.db'  # Replace with your database URI
+app.config['JOB_WORKERS'] = 4  # Background job threads per web worker process
+app.config['JOB_MAX_ATTEMPTS'] = 3  # Attempts of jobs that are safe to repeat (imports, fixes, reconciliations)
+app.config['JOB_EVENTS_TIMEOUT'] = 300  # Seconds a /api/jobs/events stream stays open, browsers reconnect after it
+app.config['SLOW_OPERATION_SECONDS'] = None  # Log commands, lookups and commits slower than this, None to disable
 db = SQLAlchemy(app)
+metrics.slow_threshold = app.config['SLOW_OPERATION_SECONDS']
 
-# Form
 
+@event.listens_for(Session, 'before_commit')
+def start_commit_timer(session):
+    session.info['commit_started'] = time.perf_counter()
+
+
+@event.listens_for(Session, 'after_commit')
+def observe_commit(session):
+    # before_commit runs before the flush, so the time spent writing pending rows is included
+    started = session.info.pop('commit_started', None)
+    if started is not None:
+        metrics.DB_COMMIT_SECONDS.observe(time.perf_counter() - started)
+
+# Form
 
-# Load JSON Config
-with open('configs/customers.json') as f:
-    customerConfig_json = json.load(f)
-    # Reorder the dictionary to make 'Generic' the first key
-    customerConfig = {'Generic': customerConfig_json.pop('Generic')} if 'Generic' in customerConfig_json else {
-        'parent': {'value': ''}, 'quota': {'value': 0}}
-    customerConfig.update({k: customerConfig_json[k] for k in sorted(customerConfig_json)})
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -38,37 +64,61 @@ with app.app_context():
     Base.metadata.bind = db.engine
     Base.query = db.session.query_property()
     Base.metadata.create_all(bind=db.engine)  # Automatically create the database tables
+    migrate_permission_column(db.engine)  # Permissions used to be stored as "r,w,x" strings
+    create_share_indexes(db.engine)  # Indexes added after the share table was created
+    create_share_fts(db.engine)  # Full-text index over the searchable Share columns, kept up to date by triggers
 
     app.logger.setLevel(logging.DEBUG)
 
-    # Create an item in the database for each customerConfig if it hasn't been created yet
-    for customer, customer_share in customerConfig.items():
-        existing_share = Share.query.filter_by(folder_name=customer_share['parent']['value']).first()
-        if existing_share:
-            continue
-
-        existing_share = Share(customer=customer,
-                               folder_name=customer_share.get('parent', {}).get('value', ''),
-                               quota=int(customer_share.get('quota', {}).get('value', 0)),
-                               server=customer_share.get('server', {}).get('value', ''),
-                               protocol=customer_share.get('protocol', {}).get('value', 'nfs,smb'),
-                               owner=customer_share.get('owner', {}).get('value', ''),
-                               users=str(customer_share.get('owner', {}).get('value', '')),
-                               permission=customer_share.get('permission', {}).get('value', 'rwx'),
-                               # Never let desktop fix the permissions on underlying shares
-                               can_fix=False
-                               )
-        db.session.add(existing_share)
-
-    db.session.commit()
-
-    # Update customerConfig with the IDs of existing shares - do not do this before creating the values
-    for customer_share in customerConfig.values():
-        existing_share = Share.query.filter_by(folder_name=customer_share['parent']['value']).first()
-        customer_share['id'] = existing_share.id
 
-with open('configs/servers.json') as f:
-    serverConfig = json.load(f)
+def load_customer_config(path) -> dict:
+    """
+    Loads customers.json with 'Generic' first and creates a share for every customer parent folder that is not in
+    the database yet, in one query for the existing folders and one batch for the new ones. The id of the parent
+    share is stored in each customer entry.
+    """
+    with open(path) as f:
+        customer_config_json = json.load(f)
+    # Reorder the dictionary to make 'Generic' the first key
+    customer_config = {'Generic': customer_config_json.pop('Generic')} if 'Generic' in customer_config_json else {
+        'parent': {'value': ''}, 'quota': {'value': 0}}
+    customer_config.update({k: customer_config_json[k] for k in sorted(customer_config_json)})
+
+    folders = {customer_share['parent']['value'] for customer_share in customer_config.values()}
+    # A session of its own, a reload can happen in the middle of a request that has uncommitted changes
+    with app.app_context(), Session(db.engine, expire_on_commit=False) as session:
+        parent_ids = dict(session.execute(select(Share.folder_name, Share.id)
+                                          .where(Share.folder_name.in_(folders))).all())
+        new_shares = {}
+        for customer, customer_share in customer_config.items():
+            folder_name = customer_share.get('parent', {}).get('value', '')
+            if folder_name in parent_ids or folder_name in new_shares:
+                continue
+            new_shares[folder_name] = Share(customer=customer,
+                                            folder_name=folder_name,
+                                            quota=int(customer_share.get('quota', {}).get('value', 0)),
+                                            server=customer_share.get('server', {}).get('value', ''),
+                                            protocol=customer_share.get('protocol', {}).get('value', 'nfs,smb'),
+                                            owner=customer_share.get('owner', {}).get('value', ''),
+                                            users=str(customer_share.get('owner', {}).get('value', '')),
+                                            permission=customer_share.get('permission', {}).get('value', 'rwx'),
+                                            # Never let desktop fix the permissions on underlying shares
+                                            can_fix=False
+                                            )
+        if new_shares:
+            session.add_all(new_shares.values())
+            session.commit()
+            parent_ids.update({folder_name: share.id for folder_name, share in new_shares.items()})
+
+    # Update customer_config with the IDs of existing shares - do not do this before creating the values
+    for customer_share in customer_config.values():
+        customer_share['id'] = parent_ids[customer_share['parent']['value']]
+    return customer_config
+
+
+# Reloaded when the files change, a broken template or regexp is reported and the previous version stays active
+customerConfig = ConfigFile('configs/customers.json', load_customer_config)
+serverConfig = ConfigFile('configs/servers.json', load_server_config)
 
 @app.route('/create', methods=['GET', 'POST'])
 @app.route('/edit/<int:share_id>', methods=['GET', 'POST'])
@@ -105,7 +155,7 @@ def manage_share(share_id=None):
 
         app.logger.debug(form.data)
         if not form.validate_on_submit():
-            return render_template('create.html', form=form, edit_mode=edit_mode, config=customerConfig)
+            return render_template('create.html', form=form, edit_mode=edit_mode, config=customerConfig.current)
 
         if not edit_mode:
             # Prevent disaster by not allowing changes to various fields when editing
@@ -126,7 +176,7 @@ def manage_share(share_id=None):
             setattr(share, field, getattr(form, field).data)
 
         # Map ACL permissions to the template
-        mapped_permission = serverConfig[share.server]['mapped_permission'][share.permission]
+        mapped_permission = serverConfig[share.server]['mapped_permission'][str(share.permission)]
         share_dict = deepcopy(share.__dict__)
         share_dict.update({"mapped_permission": mapped_permission})
 
@@ -141,7 +191,256 @@ def manage_share(share_id=None):
         db.session.commit()
         return redirect(url_for('shares'))
 
-    return render_template('create.html', form=form, edit_mode=edit_mode, config=customerConfig)
+    return render_template('create.html', form=form, edit_mode=edit_mode, config=customerConfig.current)
+
+
+# The fields an edit can change, like in manage_share the customer, server and folder of a share are fixed
+EDITABLE_FIELDS = ('protocol', 'quota', 'index', 'owner', 'users', 'permission')
+BULK_MAX_ROWS = 1000
+
+
+def read_bulk_rows() -> list[dict]:
+    """The rows of a bulk request: a JSON list, {"rows": [...]} or CSV with a header line."""
+    if request.mimetype == 'text/csv':
+        return list(csv.DictReader(io.StringIO(request.get_data(as_text=True))))
+    data = request.get_json(silent=True)
+    rows = data.get('rows') if isinstance(data, dict) else data
+    if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+        raise ValueError('Expected a JSON list of rows, {"rows": [...]} or text/csv')
+    return rows
+
+
+def validate_share_row(row: dict, parents: dict) -> tuple[dict | None, dict]:
+    """
+    Validates a bulk row like manage_share validates the form: customer overrides first, then the ShareForm
+    rules and the column validators of Share. parent is the folder name (or id) of an existing share, ``parents``
+    caches the lookups. A row with an id edits that share.
+
+    Returns:
+        tuple: the Share column values (with the full folder_name, and the id of an edit) and the errors by field
+    """
+    row = {key: value for key, value in row.items() if value is not None and value != ''}
+    if isinstance(row.get('protocol'), str):
+        row['protocol'] = [protocol for protocol in re.split(r'[,;\s]+', row['protocol']) if protocol]
+
+    if 'id' in row:
+        share = Share.query.get(int(row['id'])) if str(row['id']).isdigit() else None
+        if not share:
+            return None, {'id': ['Share not found']}
+        data = {**share.to_dict(), 'protocol': share.protocol.split(',') if share.protocol else [],
+                'folder_name': share.folder_name.rsplit('/', 1)[-1], 'parent': str(share.parent_id or '')}
+        data.update({field: row[field] for field in EDITABLE_FIELDS if field in row})
+        parent = share.parent
+    else:
+        data = dict(row)
+        # customer_data overrides field values, like in manage_share
+        customer_data = customerConfig.get(str(data.get('customer')), {})
+        for field, props in customer_data.items():
+            if isinstance(props, dict) and props.get('disabled'):
+                data[field] = props.get('value', '')
+        key = str(data.get('parent', ''))
+        if key not in parents:
+            parents[key] = (Share.query.get(int(key)) if key.isdigit()
+                            else Share.query.filter_by(folder_name=key).first())
+        parent = parents[key]
+        data['parent'] = str(parent.id) if parent else ''
+
+    form = ShareForm(formdata=None, data=data, meta={'csrf': False})
+    form.customer.choices = [(key, key) for key in customerConfig.keys()]
+    form.server.choices = [(key, value['title']) for key, value in serverConfig.items()]
+    form.parent.choices = [(str(parent.id), parent.folder_name)] if parent else [('', 'None')]
+    form.validate()
+    errors = {field: list(messages) for field, messages in form.errors.items() if field != 'submit'}
+    if not parent and 'id' not in row:
+        errors['parent'] = ['Parent share not found']
+    if errors:
+        return None, errors
+
+    server_config = serverConfig[form.server.data]
+    command_type = 'edit_acl' if 'id' in row else 'create_acl'
+    if command_type not in server_config.templates:
+        return None, {'server': [f'No {command_type}_command configured for {form.server.data}']}
+    if form.permission.data not in server_config.get('mapped_permission', {}):
+        return None, {'permission': [f'No mapped_permission for {form.permission.data} on {form.server.data}']}
+
+    values = {
+        'customer': form.customer.data,
+        'folder_name': share.folder_name if 'id' in row else f"{parent.folder_name}/{form.folder_name.data}",
+        'quota': form.quota.data,
+        'server': form.server.data,
+        'protocol': form.protocol.data,
+        'owner': form.owner.data,
+        'users': form.users.data,
+        'index': form.index.data,
+        'permission': form.permission.data,
+        'parent_id': parent.id if parent else None,
+    }
+    try:
+        # The column validators, e.g. a POSIX folder name
+        Share(**values)
+    except ValueError as e:
+        return None, {'share': [str(e)]}
+    if 'id' in row:
+        values['id'] = share.id
+    return values, {}
+
+
+def validate_share_rows(rows: list[dict]) -> tuple[list[dict], list[dict]]:
+    """Validates every bulk row and checks that no two shares end up with the same index in a folder."""
+    parents = {}
+    valid, errors = [], []
+    for number, row in enumerate(rows, start=1):
+        values, row_errors = validate_share_row(row, parents)
+        if row_errors:
+            errors.append({'row': number, 'errors': row_errors})
+        valid.append(values)
+
+    folders = {values['folder_name'] for values in valid if values}
+    taken = {(folder_name, index): share_id for share_id, folder_name, index in db.session.execute(
+        select(Share.id, Share.folder_name, Share.index).where(Share.folder_name.in_(folders)))}
+    seen = {}
+    for number, values in enumerate(valid, start=1):
+        if not values:
+            continue
+        key = (values['folder_name'], values['index'])
+        if key in seen:
+            errors.append({'row': number, 'errors': {'index': [f'Row {seen[key]} uses the same index in this folder']}})
+        elif taken.get(key, values.get('id')) != values.get('id'):
+            errors.append({'row': number, 'errors': {'index': ['Index already used by another share in this folder']}})
+        seen[key] = number
+    return valid, sorted(errors, key=lambda error: error['row'])
+
+
+@app.route('/api/shares/bulk', methods=['POST'])
+def bulk_shares_route():
+    """
+    Creates or edits many shares at once, from rows with the fields of the share form (see validate_share_row) as
+    JSON or CSV. Every row is validated up front, a single invalid row rejects the request with the errors of each
+    row. The batch is queued as a job that sends the create_acl and edit_acl commands per server in batches and
+    stores every applied row in one transaction, its result has the outcome of every row. ?dry_run=1 only
+    validates.
+    """
+    try:
+        rows = read_bulk_rows()
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+    if not rows or len(rows) > BULK_MAX_ROWS:
+        return jsonify({'message': f'Between 1 and {BULK_MAX_ROWS} rows are required'}), 400
+
+    valid, errors = validate_share_rows(rows)
+    if errors:
+        return jsonify({'message': f'{len(errors)} of {len(rows)} rows are invalid', 'rows': errors}), 400
+    if request.args.get('dry_run'):
+        return jsonify({'message': f'{len(rows)} rows are valid', 'rows': valid}), 200
+
+    task_id = jobs.submit('bulk_shares', {'rows': valid}, priority=INTERACTIVE_PRIORITY)
+    return jsonify({'task_id': task_id}), 200
+
+
+def bulk_shares_task(payload, job):
+    rows = payload['rows']
+    shares, commands, errors = [None] * len(rows), {}, [None] * len(rows)
+    for number, values in enumerate(rows):
+        try:
+            share = Share.query.get(values['id']) if 'id' in values else None
+            if 'id' in values and not share:
+                raise ValueError(f"Share {values['id']} does not exist anymore")
+            # Render the commands from a copy, the stored share only changes once its command succeeded
+            preview = Share(**{key: value for key, value in values.items() if key != 'id'})
+            share_dict = {column: getattr(preview, column) for column in Share.__table__.columns.keys()}
+            share_dict.update({'id': values.get('id'), 'mapped_permission':
+                               serverConfig[values['server']]['mapped_permission'][values['permission']]})
+        except (ValueError, KeyError) as e:
+            errors[number] = e
+            continue
+        shares[number] = share
+        commands[number] = ('edit_acl' if share else 'create_acl', share_dict)
+
+    by_server = {}
+    for number in commands:
+        by_server.setdefault(rows[number]['server'], []).append(number)
+
+    def store(number):
+        if shares[number]:
+            for field in EDITABLE_FIELDS:
+                setattr(shares[number], field, rows[number][field])
+        else:
+            shares[number] = Share(**rows[number])
+            db.session.add(shares[number])
+
+    def store_batch(results: dict):
+        """Stores the rows a batch applied on the server in one commit, or row by row if that commit fails."""
+        applied = [number for number, error in results.items() if error is None]
+        for number, error in results.items():
+            errors[number] = error
+        try:
+            for number in applied:
+                store(number)
+            db.session.commit()
+            return
+        except (ValueError, SQLAlchemyError) as e:
+            db.session.rollback()
+            app.logger.warning(f"Bulk shares: storing a batch of {len(applied)} rows failed, storing them one by one: "
+                               f"{e}")
+        for number in applied:
+            if not shares[number] or shares[number] not in db.session:
+                # A new share that was rolled back is added again
+                shares[number] = Share.query.get(rows[number]['id']) if 'id' in rows[number] else None
+            try:
+                store(number)
+                db.session.commit()
+            except (ValueError, SQLAlchemyError) as e:
+                db.session.rollback()
+                # The driver's error, without the statement and parameters
+                errors[number] = ValueError(f"Applied on {rows[number]['server']} but not stored: "
+                                            f"{getattr(e, 'orig', None) or e}")
+
+    # Every server runs in a thread of its own, its batches are stored here as they finish, since the session
+    # belongs to the job's thread
+    finished = Queue()
+
+    def apply(server):
+        numbers = by_server[server]
+        try:
+            exec_batch(serverConfig[server], [commands[number] for number in numbers],
+                       on_batch=lambda results: finished.put({numbers[index]: error
+                                                              for index, error in results.items()}))
+        finally:
+            finished.put(None)
+
+    done = len(rows) - len(commands)
+    job.progress(phase='applying', processed=done, total=len(rows))
+    with ThreadPoolExecutor(max_workers=max(1, len(by_server)), thread_name_prefix="bulk_shares") as executor:
+        futures = [executor.submit(apply, server) for server in by_server]
+        running = len(futures)
+        while running:
+            results = finished.get()
+            if results is None:
+                running -= 1
+                continue
+            store_batch(results)
+            done += len(results)
+            job.progress(phase='applying', processed=done, total=len(rows))
+    for future in futures:
+        if future.exception():
+            app.logger.error(f"Bulk shares: a server batch failed: {future.exception()}")
+
+    results = []
+    for number, values in enumerate(rows):
+        status = 'updated' if 'id' in values else 'created'
+        result = {'row': number + 1, 'folder_name': values['folder_name'], 'index': values['index']}
+        if errors[number] is None and (shares[number] is None or shares[number].id is None):
+            # Not reported by its server, e.g. the batch raised
+            errors[number] = ValueError('Not applied, the batch of its server stopped')
+        if errors[number] is not None:
+            results.append({**result, 'status': 'failed', 'message': str(errors[number])})
+        else:
+            results.append({**result, 'status': status, 'id': shares[number].id})
+    summary = {status: sum(result['status'] == status for result in results)
+               for status in ('created', 'updated', 'failed')}
+    app.logger.info(f"Bulk shares: {summary['created']} created, {summary['updated']} updated, "
+                    f"{summary['failed']} failed of {len(rows)}")
+    return {'total': len(rows), **summary, 'rows': results}
 
 
 @app.route('/success/<int:share_id>')
@@ -151,21 +450,40 @@ def success(share_id):
 
 @app.route('/', methods=['GET', 'POST'])
 def shares():
+    # The rows are loaded page by page from /api/shares, the page itself does not depend on the inventory size
+    search_query = request.args.get('search', '').strip()
+    render_servers = [(key, value['title']) for key, value in serverConfig.items()]
+    return render_template('shares.html', shares=[], paged=True, search_query=search_query, servers=render_servers)
+
+
+@app.route('/export', methods=['GET'])
+def export_shares():
+    """Every share in one table, rendered while the rows are read from the database."""
     search_query = request.args.get('search', '').strip()
     if search_query:
-        all_shares = Share.query.filter(
-            (Share.customer.ilike(f'%{search_query}%')) |
-            (Share.folder_name.ilike(f'%{search_query}%')) |
-            (Share.server.ilike(f'%{search_query}%')) |
-            (Share.protocol.ilike(f'%{search_query}%')) |
-            (Share.owner.ilike(f'%{search_query}%')) |
-            (Share.users.ilike(f'%{search_query}%')) |
-            (Share.permission.ilike(f'%{search_query}%'))
-        ).all()
+        # Ranked full-text search, supports prefixes and field qualifiers like users:jdoe
+        all_shares = search_shares(search_query)
     else:
-        all_shares = Share.query.all()
+        all_shares = Share.query.order_by(Share.id)
     render_servers = [(key, value['title']) for key, value in serverConfig.items()]
-    return render_template('shares.html', shares=all_shares, search_query=search_query, servers=render_servers)
+    return app.response_class(stream_template('shares.html', shares=all_shares.yield_per(500), paged=False,
+                                              search_query=search_query, servers=render_servers))
+
+
+@app.route('/api/shares', methods=['GET'])
+def shares_api():
+    search_query = request.args.get('search', '').strip()
+    query = search_shares(search_query, ranked=False) if search_query else Share.query
+    try:
+        limit = min(max(int(request.args.get('limit', 50)), 1), 500)
+        rows, cursor = page_shares(query,
+                                   sort=request.args.get('sort', 'folder_name'),
+                                   direction=request.args.get('dir', 'asc'),
+                                   after=request.args.get('after'),
+                                   limit=limit)
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+    return jsonify({'rows': [share.to_dict() for share in rows], 'next': cursor})
 
 
 @app.route('/lookup_user', methods=['GET'])
@@ -181,34 +499,60 @@ def lookup_user_route():
 @app.route('/delete', defaults={'share_id': None}, methods=['POST'])
 @app.route('/delete/<int:share_id>', methods=['POST'])
 def delete_share(share_id):
+    """Queues the deletion of an ACE and returns its job id right away, see /api/jobs/events."""
     share = Share.query.get_or_404(share_id)
 
     # We cannot delete POSIX permissions:
     if share.index < 0:
         return jsonify({"message": "Cannot delete POSIX permissions"}), 400
 
+    task_id = jobs.submit('delete', {'share_id': share_id}, priority=INTERACTIVE_PRIORITY)
+    return jsonify({'task_id': task_id}), 200
+
+
+def delete_task(payload, job):
+    share = Share.query.get(payload['share_id'])
+    if not share:
+        raise ValueError(f"Share {payload['share_id']} does not exist anymore")
+    server, folder_name = share.server, share.folder_name
+
     # Delete from SQL but do not commit - we do this here in case the SSH fails
     # we commit after the SSH command succeeds
+    job.progress(phase='deleting')
     db.session.delete(share)
-    exec_command(serverConfig[share.server], "delete_acl", share.__dict__)
+    exec_command(serverConfig[server], "delete_acl", share.__dict__)
     db.session.commit()
-    # Re-import the ACL from the server, because order may have changed
-    import_acl_from_server(share.server, share.folder_name)
-    return jsonify({"message": "Share deleted successfully"}), 200
+    # Re-import the ACL from the server, because order may have changed. The delete is committed, so a failing
+    # re-import must not fail (and retry) the job
+    try:
+        import_acl_from_server(server, folder_name, progress=job.progress)
+    except Exception as e:
+        db.session.rollback()
+        app.logger.warning(f"Re-import of {server}:{folder_name} after a delete failed: {e}")
+        return {"message": f"Share deleted successfully, the folder was not re-imported: {e}"}
+    return {"message": "Share deleted successfully"}
 
 
-# Simulated task queue and status storage
-task_queue = {}
-task_status = {}
+def progress_fields(processed, total, elapsed) -> dict:
+    """Progress of a long-running job as reported in its status: counts, rate per second and ETA in seconds."""
+    rate = processed / elapsed if elapsed else 0
+    return {'processed': processed, 'total': total, 'rate': round(rate, 2),
+            'eta': round((total - processed) / rate, 1) if rate else None}
 
 
-def fix_permissions_task(task_id, share_id):
-    try:
-        # Simulate a long-running task
-        time.sleep(10)  # Replace with actual logic
-        task_status[task_id] = {'status': 'completed'}
-    except Exception as e:
-        task_status[task_id] = {'status': 'failed', 'message': str(e)}
+def fix_permissions_task(payload, job):
+    share = Share.query.get(payload['share_id'])
+    if not share or not share.can_fix:
+        raise PermissionError(f"Fixing permissions is not allowed on share {payload['share_id']}")
+    server_config = serverConfig[share.server]
+    if 'fix_acl_command' not in server_config or 'fix_list_command' not in server_config:
+        raise NotImplementedError(f"No fix_list_command/fix_acl_command configured for {share.server}")
+
+    # The desired ACL is every ACE stored for this folder, not only the row the fix was started from
+    acls = desired_acl(server_config, Share.query.filter_by(folder_name=share.folder_name,
+                                                            server=share.server).all())
+    return fix_permissions_on_server(server_config, share.folder_name, acls,
+                                     lambda *args: job.progress(**progress_fields(*args)))
 
 
 @app.route('/api/fix_permissions', methods=['POST'])
@@ -226,102 +570,366 @@ def fix_permissions():
     if not share or not share.can_fix:
         return jsonify({'message': 'Permission denied'}), 403
 
-    task_id = str(uuid.uuid4())
-    task_status[task_id] = {'status': 'queued'}
-
-    # Start the task in a separate thread
-    thread = Thread(target=fix_permissions_task, args=(task_id, share_id))
-    thread.start()
+    task_id = jobs.submit('fix_permissions', {'share_id': share_id}, server=share.server,
+                          max_attempts=app.config['JOB_MAX_ATTEMPTS'])
 
     return jsonify({'task_id': task_id}), 200
 
 
 @app.route('/api/task_status/<task_id>', methods=['GET'])
 def task_status_route(task_id):
-    status = task_status.get(task_id)
+    status = jobs.get(task_id)
     if not status:
         return jsonify({'message': 'Task not found'}), 404
     return jsonify(status)
 
+
+@app.route('/api/jobs', methods=['GET'])
+def jobs_route():
+    try:
+        limit = min(max(int(request.args.get('limit', 50)), 1), 500)
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+    return jsonify(jobs.history(limit, request.args.get('status')))
+
+
+@app.route('/api/jobs/events', methods=['GET'])
+def job_events_route():
+    """
+    Server-Sent Events for the jobs in ?ids= (comma separated): a "job" event with the status of a job whenever it
+    changes and a "done" event once all of them are finished, after which the stream ends. One connection follows
+    every job of a page. After JOB_EVENTS_TIMEOUT seconds the stream ends without "done" and EventSource
+    reconnects.
+    """
+    job_ids = [job_id for job_id in request.args.get('ids', '').split(',') if job_id]
+    if not job_ids or len(job_ids) > 100:
+        return jsonify({'message': 'Between 1 and 100 job ids are required'}), 400
+
+    def events():
+        yield "retry: 2000\n\n"
+        statuses = {}
+        quiet_since = time.monotonic()
+        for changed in jobs.follow(job_ids, app.config['JOB_EVENTS_TIMEOUT']):
+            for status in changed:
+                statuses[status['id']] = status['status']
+                yield f"event: job\ndata: {json.dumps(status)}\n\n"
+            if changed:
+                quiet_since = time.monotonic()
+            elif time.monotonic() - quiet_since >= 15:
+                # Proxies close connections that stay silent for too long
+                yield ": keepalive\n\n"
+                quiet_since = time.monotonic()
+        if all(statuses.get(job_id) in (*FINISHED, 'not_found') for job_id in job_ids):
+            yield "event: done\ndata: {}\n\n"
+
+    return Response(events(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job_route(job_id):
+    if not jobs.cancel(job_id):
+        return jsonify({'message': 'Job not found or already finished'}), 404
+    return jsonify({'message': 'Cancellation requested'}), 200
+
+
+@app.route('/api/pool_stats', methods=['GET'])
+def pool_stats_route():
+    return jsonify({'ssh': ssh_pool_stats(), 'web': web_pool_stats(), 'local': local_runner_stats(),
+                    'ldap': ldap_stats(), 'read_cache': read_cache_stats(),
+                    'inventory': inventory_stats()})
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_route():
+    return Response(metrics.render_metrics(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/api/config_status', methods=['GET'])
+def config_status_route():
+    return jsonify({'configs': config_stats()})
+
+
+@app.route('/api/ldap_cache/invalidate', methods=['POST'])
+def invalidate_ldap_cache_route():
+    data = request.get_json(silent=True) or {}
+    # Without a query the whole cache is dropped
+    dropped = invalidate_cache(data.get('query'))
+    return jsonify({'message': f'Invalidated {dropped} cached entries'}), 200
+
+
+@app.route('/api/read_cache/invalidate', methods=['POST'])
+def invalidate_read_cache_route():
+    data = request.get_json(silent=True) or {}
+    server = data.get('server')
+    if server is not None and server not in serverConfig:
+        return jsonify({'message': f'Unknown server {server}'}), 400
+    # Without a server the whole cache is dropped, without a folder_name everything of the server
+    dropped = invalidate_reads(serverConfig[server] if server else None, data.get('folder_name'))
+    return jsonify({'message': f'Invalidated {dropped} cached entries'}), 200
+
+
 @app.route('/import', methods=['POST'])
 def import_share():
+    """Queues the import of a folder and returns its job id right away, see /api/jobs/events."""
     data = request.get_json()
     server = data.get('server')
     folder = data.get('remote_folder')
 
-    return import_acl_from_server(server, folder)
+    if server not in serverConfig or not folder:
+        return jsonify({'message': 'A known server and a remote_folder are required'}), 400
+    if not parent_share(server, folder):
+        return jsonify({"message": "Parent folder not found"}), 404
+
+    task_id = jobs.submit('import', {'server': server, 'remote_folder': folder, 'refresh': bool(data.get('refresh'))},
+                          priority=INTERACTIVE_PRIORITY, max_attempts=app.config['JOB_MAX_ATTEMPTS'])
+    return jsonify({'task_id': task_id}), 200
+
 
+def import_task(payload, job):
+    return import_acl_from_server(payload['server'], payload['remote_folder'], payload.get('refresh', False),
+                                  job.progress)
 
-def import_acl_from_server(server, remote_folder):
+
+def store_acl(server, fetched, customer, parent_id) -> dict:
     """
-    Connects to a server via SSH, gets the ACL from the folder and adds the entry to the database.
+    Reconciles the stored ACL of a folder with the one returned by helpers.importer.fetch_acl, without committing.
+    New and changed ACEs are upserted in batches and ACEs that are gone from the server are removed.
+
+    Returns:
+        dict: the summary of models.share.reconcile_acl, "ids" maps each ACE index to its row id
     """
+    rows = [{
+        "customer": customer,
+        "quota": fetched['quota'],
+        "index": acl['index'],
+        "server": server,
+        "protocol": fetched['protocols'],
+        "owner": fetched['owner'],
+        "parent_id": parent_id,
+        "permission": acl['permission'],
+        "users": acl['users'],
+    } for acl in fetched['acls']]
+    return reconcile_acl(db.session, fetched['folder_name'], rows)
+
+
+def parent_share(server, remote_folder) -> Share | None:
     parent_folder = "/".join(remote_folder.split('/')[:-1])
-    parent = Share.query.filter_by(folder_name=parent_folder, server=server).first()
+    return Share.query.filter_by(folder_name=parent_folder, server=server).first()
+
+
+def import_acl_from_server(server, remote_folder, refresh=False, progress=None) -> dict:
+    """
+    Connects to a server via SSH, gets the ACL from the folder and adds the entry to the database.
+    Recently read outputs of the folder are reused unless refresh is set. ``progress`` is called with the
+    phase (reading, storing) as keyword.
+
+    Returns:
+        dict: the message and the inserted, updated, unchanged and deleted counts of the import
+    """
+    parent = parent_share(server, remote_folder)
     if not parent:
-        return jsonify({"message": "Parent folder not found"}), 404
+        raise ValueError("Parent folder not found")
 
-    acl_output = exec_command(serverConfig[server], "acl", {"folder_name": remote_folder})
-    quota_output = exec_command(serverConfig[server], "quota", {"folder_name": remote_folder})
-    protocol_output = exec_command(serverConfig[server], "protocol", {"folder_name": remote_folder})
+    if progress:
+        progress(phase='reading')
+    fetched = fetch_acl(serverConfig[server], remote_folder, refresh=refresh)
+    if not fetched['acls']:
+        raise ValueError("No ACL entries to import")
+    if progress:
+        progress(phase='storing')
+    result = store_acl(server, fetched, parent.customer, parent.id)
 
-    owner_str = ""
-    owner = lookup_user(acl_output['owner'], search_by=[serverConfig[server]["acl_ldap_attribute"]], exact=True)
-    if owner:
-        owner_str = owner[0][serverConfig[server]["acl_ldap_attribute"]]
+    # Commit changes to the database
+    db.session.commit()
 
-    # Get the keys for each protocol that is not 0
-    protocols = {key for key, value in protocol_output.items() if value != 0}
-    quota = quota_output['hard']
+    return {"message": "Import completed successfully",
+            **{key: result[key] for key in ("inserted", "updated", "unchanged", "deleted")}}
 
-    for acl in acl_output['permissions']:
-        if acl['access'] == "deny":
-            # Skip denied permissions
-            continue
-        elif acl['type'] == 'user':
-            # Add the user to the users
-            user = lookup_user(acl['name'], search_by=[serverConfig[server]["acl_ldap_attribute"]], exact=True)
-            if not user:
+
+def import_tree(server, root_folder, max_depth=None, progress=None, refresh=False) -> dict:
+    """
+    Imports root_folder and every folder below it, parents before children.
+
+    The remote reads run on import_workers (servers.json, default 8) threads. Every import_batch_size fetched
+    folders (default 100) are written in order on this thread in one short transaction, which is never held open
+    while waiting for the server, so job submissions and heartbeats are not locked out of the database.
+    """
+    server_config = serverConfig[server]
+    workers = server_config.get('import_workers', 8)
+    batch_size = server_config.get('import_batch_size', 100)
+
+    root_folder = root_folder.rstrip('/')
+    folders = list_folders(server_config, root_folder, max_depth)
+    if not Share.query.filter_by(folder_name=root_folder, server=server).first():
+        folders.insert(0, root_folder)
+
+    # (customer, row id) of the parents written during this import, so children do not need to query them
+    parents = {}
+    summary = {"total": len(folders), "imported": 0, "skipped": [], "failed": []}
+    started = time.monotonic()
+
+    def write(batch):
+        for folder, fetched in batch:
+            parent_folder = "/".join(folder.split('/')[:-1])
+            parent = parents.get(parent_folder)
+            if not parent:
+                share = Share.query.filter_by(folder_name=parent_folder, server=server).first()
+                parent = (share.customer, share.id) if share else None
+            if not parent or not fetched['acls']:
+                # Without a parent (or without any ACE to store) there is nothing to attach this folder or its
+                # children to
+                summary["skipped"].append(folder)
                 continue
+
+            ids = store_acl(server, fetched, *parent)["ids"]
+            parents[folder] = (parent[0], ids[min(ids)])
+            summary["imported"] += 1
+        db.session.commit()
+
+    batch = []
+    for folder, fetched, error in fetch_tree(server_config, folders, workers, progress, refresh):
+        if error:
+            summary["failed"].append({"folder_name": folder, "message": str(error)})
+            continue
+        batch.append((folder, fetched))
+        if len(batch) >= batch_size:
+            write(batch)
+            batch = []
+    write(batch)
+
+    summary["elapsed"] = round(time.monotonic() - started, 3)
+    summary["rate"] = round(summary["total"] / summary["elapsed"], 2) if summary["elapsed"] else 0
+    app.logger.info(f"Imported {summary['imported']}/{summary['total']} folders of {server}:{root_folder} "
+                    f"in {summary['elapsed']}s ({summary['rate']} folders/s)")
+    return summary
+
+
+def import_tree_task(payload, job):
+    return import_tree(payload['server'], payload['remote_folder'], payload.get('max_depth'),
+                       lambda *args: job.progress(**progress_fields(*args)), payload.get('refresh', False))
+
+
+@app.route('/api/import_tree', methods=['POST'])
+def import_tree_route():
+    data = request.get_json()
+    server = data.get('server')
+    root_folder = data.get('remote_folder')
+    max_depth = data.get('max_depth')
+
+    if server not in serverConfig or not root_folder:
+        return jsonify({'message': 'A known server and a remote_folder are required'}), 400
+    if 'list_command' not in serverConfig[server]:
+        return jsonify({'message': f'No list_command configured for {server}'}), 400
+
+    task_id = jobs.submit('import_tree', {'server': server, 'remote_folder': root_folder,
+                                          'max_depth': int(max_depth) if max_depth is not None else None,
+                                          'refresh': bool(data.get('refresh'))},
+                          server=server, max_attempts=app.config['JOB_MAX_ATTEMPTS'])
+
+    return jsonify({'task_id': task_id}), 200
+
+
+def reconcile_server(server, force=False, progress=None) -> dict:
+    """
+    Compares every managed folder of a server with the database and returns a drift report.
+
+    Each folder is probed with its raw acl, quota and protocol commands. Folders with the same fingerprint as on
+    the previous run are skipped, the others are parsed and their ACL reconciled with the stored rows. Pass force
+    to reconcile every folder regardless of its fingerprint. The probe results are written import_batch_size
+    folders at a time in one short transaction, never while a probe is outstanding.
+    """
+    server_config = serverConfig[server]
+    workers = server_config.get('import_workers', 8)
+    batch_size = server_config.get('import_batch_size', 100)
+
+    # The customer and parent the ACEs of every managed folder hang off, customer parent shares are not managed here
+    folders = {}
+    for folder_name, customer, parent_id in db.session.execute(
+            select(Share.folder_name, Share.customer, Share.parent_id)
+            .where(Share.server == server, Share.can_fix.is_(True))
+            .order_by(Share.folder_name, Share.index)):
+        folders.setdefault(folder_name, (customer, parent_id))
+    known = dict(db.session.execute(select(Fingerprint.folder_name, Fingerprint.digest)
+                                    .where(Fingerprint.server == server)).all())
+
+    summary = {"total": len(folders), "unchanged": 0, "changed": 0, "drift": [], "failed": []}
+    pending, checked = [], []
+    started = time.monotonic()
+
+    def write():
+        digests = {}
+        for folder, digest, fetched in pending:
             try:
-                users = {user[0][serverConfig[server]["acl_ldap_attribute"]]}
-            except KeyError:
+                result = store_acl(server, fetched, *folders[folder])
+            except ValueError as e:
+                summary["failed"].append({"folder_name": folder, "message": str(e)})
                 continue
-        elif acl['type'] == 'group':
-            # Add the group to the users
-            users = lookup_group_members(acl['name'], serverConfig[server]["acl_ldap_attribute"])
+            if result["inserted"] or result["updated"] or result["deleted"]:
+                summary["drift"].append({"folder_name": folder, "inserted": result["inserted"],
+                                         "updated": result["updated"], "deleted": result["deleted"]})
+            digests[folder] = digest
+        store_fingerprints(db.session, server, digests, checked, time.time())
+        db.session.commit()
+        pending.clear()
+        checked.clear()
+
+    probes = probe_tree(server_config, list(folders), known, workers, force, progress)
+    for done, (folder, digest, fetched, error) in enumerate(probes, start=1):
+        if error:
+            summary["failed"].append({"folder_name": folder, "message": str(error)})
+        elif fetched is None:
+            summary["unchanged"] += 1
+            checked.append(folder)
         else:
-            # This is an 'everyone' or unknown type, we presume the worst
-            users = {acl_output['everyone']}
+            summary["changed"] += 1
+            pending.append((folder, digest, fetched))
 
-        users.discard('')
-        users.discard(None)
-        if not users:
-            # Skip if group is empty
-            continue
+        if done % batch_size == 0:
+            write()
+    write()
 
-        # Find the existing ACL
-        share = Share.query.filter_by(folder_name=remote_folder, index=acl['index']).first()
-        if not share:
-            share = Share()
-        # Update the ACL
-        share.customer = parent.customer
-        share.folder_name = remote_folder
-        share.quota = quota
-        share.index = acl['index']
-        share.server = server
-        share.protocol = protocols
-        share.owner = owner_str
-        share.parent = parent
-        share.permission = acl['permission']
-        share.users = users
-        # Add the user/group to the database
-        db.session.add(share)
+    summary["elapsed"] = round(time.monotonic() - started, 3)
+    summary["rate"] = round(summary["total"] / summary["elapsed"], 2) if summary["elapsed"] else 0
+    app.logger.info(f"Reconciled {server}: {summary['changed']} of {summary['total']} folders changed, "
+                    f"{len(summary['drift'])} drifted, {len(summary['failed'])} failed in {summary['elapsed']}s")
+    return summary
 
-    # Commit changes to the database
-    db.session.commit()
 
-    return jsonify({"message": "Import completed successfully"}), 200
+def reconcile_task(payload, job):
+    return reconcile_server(payload['server'], payload.get('force', False),
+                            lambda *args: job.progress(**progress_fields(*args)))
+
+
+@app.route('/api/reconcile', methods=['POST'])
+def reconcile_route():
+    """Queues a reconciliation of one server, or of every server when none is given (e.g. from a nightly cron)."""
+    data = request.get_json(silent=True) or {}
+    server = data.get('server')
+    if server and server not in serverConfig:
+        return jsonify({'message': f'Unknown server {server}'}), 400
+
+    servers = [server] if server else [key for key, value in serverConfig.items() if 'acl_command' in value]
+    task_ids = [jobs.submit('reconcile', {'server': key, 'force': bool(data.get('force'))}, server=key,
+                            max_attempts=app.config['JOB_MAX_ATTEMPTS'])
+                for key in servers]
+    return jsonify({'task_ids': task_ids}), 200
+
+
+# Imports and deletes started from the UI go before tree imports, fixes and reconciliations. They are queued
+# without a server, so a long job does not hold them back through max_jobs, exec_commands limits them per server
+INTERACTIVE_PRIORITY = 10
+
+# Long-running work goes through the database backed queue, every web worker process runs JOB_WORKERS threads
+jobs = JobQueue(app, db, workers=app.config['JOB_WORKERS'],
+                server_limit=lambda server: serverConfig.get(server, {}).get('max_jobs', 1))
+jobs.register('import', import_task)
+jobs.register('delete', delete_task)
+jobs.register('bulk_shares', bulk_shares_task)
+jobs.register('fix_permissions', fix_permissions_task)
+jobs.register('import_tree', import_tree_task)
+jobs.register('reconcile', reconcile_task)
+jobs.start()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,299 @@
+"""
+End-to-end latency of the share endpoints against local stand-ins for the NAS and Active Directory.
+
+The application is copied to a temporary directory with generated configs (so the benchmark never touches
+configs/ or the real database), the SSH, HTTP and LDAP stubs from stubs.py are started, and every endpoint is
+driven with --requests requests on --concurrency threads through Flask's test client:
+
+    import (ssh)    POST /import of a folder on the SSH server
+    import (web)    POST /import of a folder on the web server
+    create          POST /create of a new share on the SSH server
+    bulk create     POST /api/shares/bulk of --bulk-rows new shares on the SSH server
+    delete          POST /delete/<id> of an imported ACE, which re-imports the folder
+
+Imports, deletes and bulk creates run as background jobs, their latency lasts until /api/jobs/events reports the job finished.
+
+Per endpoint the request latency is reported, and per phase (ssh, web, ldap and db calls made while that endpoint
+ran) the number of calls per request and the latency of a single call.
+
+    python benchmarks/bench_e2e.py
+    python benchmarks/bench_e2e.py --concurrency 8 --requests 200 --ssh-latency 0.02 --output e2e.json
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+ENDPOINTS = ("import (ssh)", "import (web)", "create", "bulk create", "delete")
+SSH_ROOT = "/ifs/admin"
+WEB_ROOT = "/ifs/web"
+
+
+class Recorder:
+    """Collects the duration of every call per phase, reset before each endpoint."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = {}
+
+    def reset(self):
+        with self._lock:
+            self.calls = {}
+
+    def add(self, phase, seconds):
+        with self._lock:
+            self.calls.setdefault(phase, []).append(seconds)
+
+    def wrap(self, phase, function):
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.add(phase, time.perf_counter() - started)
+        return timed
+
+
+def percentiles(samples) -> dict:
+    """p50, p95 and p99 in milliseconds."""
+    if not samples:
+        return {"p50": None, "p95": None, "p99": None}
+    if len(samples) == 1:
+        return {key: round(samples[0] * 1000, 2) for key in ("p50", "p95", "p99")}
+    cuts = statistics.quantiles(samples, n=100, method="inclusive")
+    return {"p50": round(cuts[49] * 1000, 2), "p95": round(cuts[94] * 1000, 2), "p99": round(cuts[98] * 1000, 2)}
+
+
+def prepare(workdir):
+    """Copies the application to workdir and writes servers.json, customers.json and ad.json for the stubs."""
+    for name in ("app.py", "helpers", "models", "templates"):
+        source = os.path.join(REPOSITORY, name)
+        if os.path.isdir(source):
+            shutil.copytree(source, os.path.join(workdir, name), ignore=shutil.ignore_patterns("__pycache__"))
+        else:
+            shutil.copy(source, workdir)
+    os.makedirs(os.path.join(workdir, "configs"))
+    with open(os.path.join(REPOSITORY, "configs", "servers.json.example")) as f:
+        examples = json.load(f)
+    return examples
+
+
+def write_configs(workdir, examples, ssh_port, web_url):
+    ssh = dict(examples["example-ssh"], title="Benchmark SSH", ssh_host="127.0.0.1", ssh_port=ssh_port)
+    # manage_share runs create_acl, the example only defines add_acl
+    ssh["create_acl_command"] = ssh["add_acl_command"]
+    web = dict(examples["example-web"], title="Benchmark web", web_host=web_url)
+    web["acl_command"] = [f"WEB#GET#{web_url}/cli/acl?path={{{{folder_name}}}}"]
+    web["quota_command"] = [f"WEB#GET#{web_url}/cli/quotas?path={{{{folder_name}}}}"]
+    web["protocol_command"] = [f"WEB#GET#{web_url}/cli/protocols?path={{{{folder_name}}}}"]
+    web["delete_acl_command"] = [f"WEB#PUT#{web_url}/cli/acl?path={{{{folder_name}}}}"]
+
+    configs = {
+        "servers.json": {"bench-ssh": ssh, "bench-web": web},
+        "customers.json": {
+            "Generic": {"server": {"value": "bench-ssh", "disabled": True},
+                        "parent": {"value": SSH_ROOT, "disabled": True},
+                        "folder_name": {"value": "", "disabled": False},
+                        "quota": {"value": 2, "disabled": False}},
+            "Web": {"server": {"value": "bench-web", "disabled": True},
+                    "parent": {"value": WEB_ROOT, "disabled": True}},
+        },
+    }
+    for name, content in configs.items():
+        with open(os.path.join(workdir, "configs", name), "w") as f:
+            json.dump(content, f, indent=2)
+
+
+def wait_for_job(client, task_id) -> dict:
+    """Reads the /api/jobs/events stream of a job until it ends and returns the last status."""
+    status = {}
+    while status.get("status") not in ("completed", "failed", "cancelled", "not_found"):
+        body = client.get(f"/api/jobs/events?ids={task_id}").get_data(as_text=True)
+        for event in body.split("\n\n"):
+            if event.startswith("event: job\n"):
+                status = json.loads(event.split("data: ", 1)[1])
+    return status
+
+
+def drive(name, requests, concurrency, recorder, make_client, request_for) -> dict:
+    """Sends ``requests`` requests built by request_for(number) and summarises latency and phases."""
+    recorder.reset()
+    local = threading.local()
+    errors = []
+
+    def send(number):
+        if not hasattr(local, "client"):
+            local.client = make_client()
+        started = time.perf_counter()
+        method, url, kwargs = request_for(number)
+        response = local.client.open(url, method=method, **kwargs)
+        if response.status_code >= 400:
+            errors.append(f"{response.status_code} {url}: {response.get_data(as_text=True)[:200]}")
+        elif response.is_json and "task_id" in response.json:
+            status = wait_for_job(local.client, response.json["task_id"])
+            if status["status"] != "completed":
+                errors.append(f"{status['status']} {url}: {status.get('message', '')[:200]}")
+        return time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = list(executor.map(send, range(requests)))
+    wall = time.perf_counter() - started
+
+    phases = {}
+    for phase, calls in sorted(recorder.calls.items()):
+        phases[phase] = {"calls_per_request": round(len(calls) / requests, 2), **percentiles(calls)}
+    return {"endpoint": name, "requests": requests, "errors": len(errors), "first_error": errors[0] if errors else None,
+            "throughput": round(requests / wall, 2), **percentiles(latencies), "phases": phases}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=100, help="requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=4, help="concurrent clients")
+    parser.add_argument("--endpoints", nargs="+", choices=ENDPOINTS, default=list(ENDPOINTS))
+    parser.add_argument("--departments", type=int, default=5, help="department folders per server")
+    parser.add_argument("--projects", type=int, default=20, help="project folders per department")
+    parser.add_argument("--aces", type=int, default=8, help="ACEs per generated folder")
+    parser.add_argument("--users", type=int, default=200, help="users in the directory")
+    parser.add_argument("--groups", type=int, default=20, help="groups in the directory")
+    parser.add_argument("--group-size", type=int, default=50, help="members per group")
+    parser.add_argument("--bulk-rows", type=int, default=20, help="shares per bulk create request")
+    parser.add_argument("--ssh-latency", type=float, default=0.005, help="seconds before every SSH reply")
+    parser.add_argument("--web-latency", type=float, default=0.005, help="seconds before every HTTP reply")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary application directory")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="sharemanagement-bench-")
+    examples = prepare(workdir)
+    output = os.path.abspath(args.output) if args.output else None
+    os.chdir(workdir)
+    sys.path.insert(0, workdir)
+
+    # helpers.domain reads configs/ad.json on import, stubs imports it
+    with open(os.path.join(workdir, "configs", "ad.json"), "w") as f:
+        json.dump({"example.com": {"server": "ldap://ldap-stub", "user": "cn=bench", "password": "bench",
+                                   "search_base": "dc=example,dc=com"}}, f)
+    import stubs
+
+    ssh_nas = stubs.NasState(SSH_ROOT, args.departments, args.projects, args.aces, args.users, args.groups, seed=1)
+    web_nas = stubs.NasState(WEB_ROOT, args.departments, args.projects, args.aces, args.users, args.groups, seed=2)
+    ssh_stub = stubs.SSHStub(ssh_nas, latency=args.ssh_latency)
+    web_stub = stubs.HTTPStub(web_nas, latency=args.web_latency)
+    stubs.LDAPStub(args.users, args.groups, args.group_size)
+    write_configs(workdir, examples, ssh_stub.port, web_stub.url)
+
+    import logging
+    import app as application
+    import helpers.commands
+    from sqlalchemy import event
+
+    logging.disable(logging.INFO)
+    application.app.config["WTF_CSRF_ENABLED"] = False
+
+    recorder = Recorder()
+    helpers.commands.ssh_exec_command = recorder.wrap("ssh", helpers.commands.ssh_exec_command)
+    helpers.commands.ssh_exec_batch = recorder.wrap("ssh", helpers.commands.ssh_exec_batch)
+    helpers.commands.web_exec_command = recorder.wrap("web", helpers.commands.web_exec_command)
+    pool_class = helpers.domain.LDAPConnectionPool
+    pool_class.run = recorder.wrap("ldap", pool_class.run)
+    with application.app.app_context():
+        engine = application.db.engine
+        parents = {share.folder_name: share.id for share in application.Share.query.all()}
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        context._bench_started = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        # Statements that started before the listeners were added have no start time
+        if hasattr(context, "_bench_started"):
+            recorder.add("db", time.perf_counter() - context._bench_started)
+
+    def import_request(server, folders):
+        def request_for(number):
+            folder = folders[number % len(folders)]
+            return "POST", "/import", {"json": {"server": server, "remote_folder": folder}}
+        return request_for
+
+    def ensure_imported(server, folders):
+        # Parents before children, so every folder has a parent share to hang off
+        client = application.app.test_client()
+        for folder in sorted(folders, key=lambda folder: folder.count('/')):
+            response = client.post("/import", json={"server": server, "remote_folder": folder})
+            if response.status_code == 200:
+                wait_for_job(client, response.json["task_id"])
+
+    def create_request(number):
+        return "POST", "/create", {"data": {
+            "customer": "Generic", "folder_name": f"bench_{os.getpid()}_{number}", "quota": 1,
+            "server": "bench-ssh", "protocol": ["nfs"], "owner": "user1", "users": "user1,user2",
+            "index": 0, "permission": "rwx", "parent": str(parents[SSH_ROOT])}}
+
+    def bulk_create_request(number):
+        return "POST", "/api/shares/bulk", {"json": {"rows": [
+            {"customer": "Generic", "folder_name": f"bulk_{os.getpid()}_{number}_{row}", "quota": 1,
+             "protocol": "nfs", "owner": "user1", "users": "user1,user2", "index": 0, "permission": "rwx"}
+            for row in range(args.bulk_rows)]}}
+
+    results = []
+    for endpoint in args.endpoints:
+        if endpoint == "import (ssh)":
+            ensure_imported("bench-ssh", [folder for folder in ssh_nas.folders if folder.count('/') == 3])
+            request_for, requests = import_request("bench-ssh", ssh_nas.leaves()), args.requests
+        elif endpoint == "import (web)":
+            ensure_imported("bench-web", [folder for folder in web_nas.folders if folder.count('/') == 3])
+            request_for, requests = import_request("bench-web", web_nas.leaves()), args.requests
+        elif endpoint == "create":
+            request_for, requests = create_request, args.requests
+        elif endpoint == "bulk create":
+            request_for, requests = bulk_create_request, max(1, args.requests // args.bulk_rows)
+        else:
+            ensure_imported("bench-ssh", [folder for folder in ssh_nas.folders if folder != SSH_ROOT])
+            # One ACE per folder, concurrent deletes in one folder would renumber each other's ACEs
+            with application.app.app_context():
+                ids = {}
+                for share in application.Share.query.filter(application.Share.server == "bench-ssh",
+                                                            application.Share.index >= 0):
+                    ids.setdefault(share.folder_name, share.id)
+            ids = list(ids.values())
+            request_for, requests = (lambda number: ("POST", f"/delete/{ids[number]}", {})), min(args.requests, len(ids))
+
+        result = drive(endpoint, requests, args.concurrency, recorder, application.app.test_client, request_for)
+        results.append(result)
+
+    print(f"{'endpoint':<14} {'requests':>8} {'errors':>6} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for result in results:
+        print(f"{result['endpoint']:<14} {result['requests']:>8} {result['errors']:>6} {result['throughput']:>8} "
+              f"{result['p50']:>9} {result['p95']:>9} {result['p99']:>9}")
+        for phase, stats in result["phases"].items():
+            print(f"  {phase:<12} {stats['calls_per_request']:>8} calls/request {'':>4} "
+                  f"{stats['p50']:>9} {stats['p95']:>9} {stats['p99']:>9}")
+        if result["first_error"]:
+            print(f"  first error: {result['first_error']}")
+    print(f"SSH stub: {ssh_stub.commands} commands on {ssh_stub.connections} connections, "
+          f"HTTP stub: {web_stub.requests} requests")
+
+    if output:
+        with open(output, "w") as f:
+            json.dump({"arguments": vars(args), "results": results}, f, indent=2)
+
+    if not args.keep:
+        shutil.rmtree(workdir, ignore_errors=True)
+    else:
+        print(f"Application directory: {workdir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+"""
+Benchmarks structured (acl_format, quota_format) parsing against the regexp and mapper parsers on the same data.
+
+Every synthetic folder is rendered twice, as the ``ls -led`` and ``isi quota`` text of example-ssh and as the
+OneFS API JSON of example-onefs-api, and both go through parse_command_output. The parsed results are compared
+before anything is timed. Quotas are also parsed with a Jinja quota_mapper over the same JSON, the way JSON
+output was read before formats existed.
+
+    python benchmarks/bench_formats.py
+    python benchmarks/bench_formats.py --sizes 10 1000 --folders 5000
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from helpers.commands import parse_command_output  # noqa: E402
+from helpers.config import compile_server_config  # noqa: E402
+
+EXAMPLE_CONFIG = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                              'configs', 'servers.json.example')
+SIZES = (10, 100, 1000, 10000)
+FOLDERS = 10000
+QUOTA_MAPPER = {
+    "hard": "{{ (quotas[0].thresholds.hard or 0) / 1073741824 }}",
+    "soft": "{{ (quotas[0].thresholds.soft or 0) / 1073741824 }}",
+}
+
+
+def synthetic_acl(aces, permission_names, seed=0) -> dict:
+    """A folder with ``aces`` ACEs, most of them inherited like on deep folders."""
+    rng = random.Random(seed)
+    names = list(permission_names)
+    entries = []
+    for _ in range(aces):
+        ace_type = rng.choice(("user", "group", "group", "everyone"))
+        permissions = rng.sample(names, rng.randint(1, 6))
+        if rng.random() < 0.8:
+            permissions += ["object_inherit", "container_inherit", "inherited_ace"]
+        entries.append({
+            "type": ace_type,
+            "name": "" if ace_type == "everyone" else f"{ace_type}_{rng.randrange(5000)}",
+            "access": "deny" if rng.random() < 0.05 else "allow",
+            "permissions": permissions,
+        })
+    return {"owner": "jdoe", "group": "lab_staff", "mode": "0770", "aces": entries}
+
+
+def acl_text(acl) -> str:
+    lines = ["drwxrwx---   +  12 jdoe  lab_staff  512 Jan  1 12:00 /ifs/lab/project",
+             f" OWNER: user:{acl['owner']}",
+             f" GROUP: group:{acl['group']}",
+             "CONTROL:dacl_auto_inherited,dacl_protected"]
+    for index, ace in enumerate(acl["aces"]):
+        trustee = f"{ace['type']}:{ace['name']}" if ace["name"] else ace["type"]
+        lines.append(f" {index}: {trustee} {ace['access']} {','.join(ace['permissions'])}")
+    return "\n".join(lines) + "\n"
+
+
+def acl_json(acl) -> str:
+    return json.dumps({
+        "owner": {"name": acl["owner"], "type": "user"},
+        "group": {"name": acl["group"], "type": "group"},
+        "mode": acl["mode"],
+        "authoritative": "acl",
+        "acl": [{"trustee": {"name": ace["name"], "type": ace["type"]}, "accesstype": ace["access"],
+                 "accessrights": ace["permissions"], "op": "add"} for ace in acl["aces"]],
+    })
+
+
+def synthetic_quotas(folders, seed=0) -> list[int]:
+    rng = random.Random(seed)
+    return [rng.randrange(1, 100000) * 1024 ** 3 // 10 for _ in range(folders)]
+
+
+def quota_text(hard) -> str:
+    return (f"                    Path: /ifs/lab/project\n                    Type: directory\n"
+            f"          Hard Threshold: {hard / 1024 ** 3:.2f}G\n                 Enforced: Yes\n")
+
+
+def quota_json(hard) -> str:
+    return json.dumps({"quotas": [{"path": "/ifs/lab/project", "type": "directory", "enforced": True,
+                                   "thresholds": {"hard": hard, "soft": None, "advisory": None}}]})
+
+
+def normalized(acl) -> dict:
+    """The regexp parser returns ACE indexes as strings, Share.normalize turns both into ints."""
+    return {**acl, "permissions": [{**ace, "index": int(ace["index"])} for ace in acl["permissions"]]}
+
+
+def best_of(function, repeat) -> float:
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def run(sizes, folders, repeat) -> list[dict]:
+    with open(EXAMPLE_CONFIG) as f:
+        examples = json.load(f)
+    text_server = compile_server_config("example-ssh", examples["example-ssh"])
+    json_server = compile_server_config("example-onefs-api", examples["example-onefs-api"])
+    mapper_raw = {key: value for key, value in examples["example-onefs-api"].items() if key != "quota_format"}
+    mapper_server = compile_server_config("example-onefs-api", {**mapper_raw, "quota_mapper": QUOTA_MAPPER})
+
+    results = []
+    permission_names = json_server.formats["acl"].permission_map
+    for aces in sizes:
+        acl = synthetic_acl(aces, permission_names)
+        text, document = acl_text(acl), acl_json(acl)
+        if normalized(parse_command_output(text_server, "acl", text)) != \
+                parse_command_output(json_server, "acl", document):
+            raise AssertionError(f"acl_format and acl_regexp disagree with {aces} ACEs")
+        regexp = best_of(lambda: parse_command_output(text_server, "acl", text), repeat)
+        structured = best_of(lambda: parse_command_output(json_server, "acl", document), repeat)
+        results.append({"case": f"acl/{aces}", "items": aces, "regexp_seconds": regexp,
+                        "format_seconds": structured, "mapper_seconds": None,
+                        "speedup": round(regexp / structured, 2)})
+
+    hards = synthetic_quotas(folders)
+    texts, documents = [quota_text(hard) for hard in hards], [quota_json(hard) for hard in hards]
+    for text, document in zip(texts, documents):
+        from_text = parse_command_output(text_server, "quota", text)
+        from_json = parse_command_output(json_server, "quota", document)
+        from_mapper = parse_command_output(mapper_server, "quota", document)
+        # The text has two decimals, the mapper renders strings
+        if abs(from_text["hard"] - from_json["hard"]) > 0.01 or float(from_mapper["hard"]) != from_json["hard"]:
+            raise AssertionError(f"quota_format disagrees: {from_text} {from_json} {from_mapper}")
+    regexp = best_of(lambda: [parse_command_output(text_server, "quota", text) for text in texts], repeat)
+    structured = best_of(lambda: [parse_command_output(json_server, "quota", document)
+                                  for document in documents], repeat)
+    mapped = best_of(lambda: [parse_command_output(mapper_server, "quota", document)
+                              for document in documents], repeat)
+    results.append({"case": f"quota/{folders}", "items": folders, "regexp_seconds": regexp,
+                    "format_seconds": structured, "mapper_seconds": mapped,
+                    "speedup": round(regexp / structured, 2)})
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES, help="ACE counts to benchmark")
+    parser.add_argument("--folders", type=int, default=FOLDERS, help="quota outputs to parse")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per case, the fastest one counts")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = run(args.sizes, args.folders, args.repeat)
+    print(f"{'case':<14} {'regexp ms':>10} {'format ms':>10} {'mapper ms':>10} {'speedup':>8}")
+    for result in results:
+        mapper = f"{result['mapper_seconds'] * 1000:.2f}" if result['mapper_seconds'] is not None else "-"
+        print(f"{result['case']:<14} {result['regexp_seconds'] * 1000:>10.2f} "
+              f"{result['format_seconds'] * 1000:>10.2f} {mapper:>10} {result['speedup']:>7}x")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+"""
+Benchmarks parse_acl on synthetic ``ls -led`` outputs with 10 to 10,000 ACEs.
+
+Every output is also parsed with the previous implementation (kept below as reference_parse_acl) to check that
+both return the same result. Results can be saved with --output and compared with an earlier run with --baseline,
+which exits with status 1 when a case got slower than --tolerance.
+
+    python benchmarks/bench_parsers.py
+    python benchmarks/bench_parsers.py --output before.json
+    python benchmarks/bench_parsers.py --baseline before.json
+"""
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from helpers.config import compile_server_config  # noqa: E402
+from helpers.parsers import parse_acl  # noqa: E402
+from helpers.permissions import Permission  # noqa: E402
+
+EXAMPLE_CONFIG = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                              'configs', 'servers.json.example')
+SIZES = (10, 100, 1000, 10000)
+
+
+def reference_parse_acl(acl_output, acl_regexp):
+    """parse_acl as it was before the single-pass parser, for output comparison. It returns sets of letters."""
+    parsed_data = {
+        "owner": "nobody",
+        "group": "nobody",
+        "everyone": "everyone",
+        "permissions": []
+    }
+
+    for posix_type in ['owner', 'group', 'everyone']:
+        entity_match = re.search(acl_regexp['regex_patterns'][posix_type], acl_output)
+        if entity_match:
+            parsed_data[posix_type] = entity_match.group(posix_type)
+
+        posix_acl_match = re.search(acl_regexp['regex_patterns']['posix'], acl_output)
+        if not posix_acl_match:
+            continue
+        permission = set(posix_acl_match.group(posix_type))
+        permission.discard('-')
+
+        if not permission:
+            continue
+
+        parsed_data['permissions'].append({
+            "index": -1,
+            "type": posix_type,
+            "name": parsed_data[posix_type],
+            "access": "allow",
+            "permission": permission
+        })
+
+    permissions_pattern = acl_regexp['regex_patterns']['acl']
+    permission_map = acl_regexp.get('permission_map', {})
+    for match in re.finditer(permissions_pattern, acl_output):
+        permission_matches = match.group('permission')
+        translated_access = (permission_map.get(perm, perm) for perm in permission_matches.split(","))
+        unique_permissions = set()
+        for perm in translated_access:
+            if "r" in perm:
+                unique_permissions.add("r")
+            if "w" in perm:
+                unique_permissions.add("w")
+            if "x" in perm:
+                unique_permissions.add("x")
+
+        parsed_data['permissions'].append({
+            "index": match.group('index'),
+            "type": match.group('type'),
+            "name": match.group('name'),
+            "access": match.group('access'),
+            "permission": unique_permissions
+        })
+
+    return parsed_data
+
+
+def synthetic_acl_output(aces, permission_names, seed=0) -> str:
+    """An ``ls -led`` listing of a folder with ``aces`` ACEs, most of them inherited like on deep folders."""
+    rng = random.Random(seed)
+    lines = ["drwxrwx---   +  12 jdoe  lab_staff  512 Jan  1 12:00 /ifs/lab/project",
+             " OWNER: user:jdoe",
+             " GROUP: group:lab_staff",
+             "CONTROL:dacl_auto_inherited,dacl_protected"]
+    # Names that are not in the permission map go through the fallback path
+    names = list(permission_names) + ["unknown_right", "read_extra"]
+    for index in range(aces):
+        ace_type = rng.choice(("user", "group", "group", "everyone"))
+        name = "" if ace_type == "everyone" else f"{ace_type}_{rng.randrange(5000)}"
+        access = "deny" if rng.random() < 0.05 else "allow"
+        permissions = ",".join(rng.sample(names, rng.randint(1, 6)))
+        if rng.random() < 0.8:
+            permissions += ",object_inherit,container_inherit,inherited_ace"
+        lines.append(f" {index}: {ace_type}:{name} {access} {permissions}" if name
+                     else f" {index}: {ace_type} {access} {permissions}")
+    return "\n".join(lines) + "\n"
+
+
+def best_of(function, repeat) -> float:
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def run(sizes, repeat) -> list[dict]:
+    with open(EXAMPLE_CONFIG) as f:
+        examples = json.load(f)
+
+    results = []
+    for server in ("example-ssh", "example-web"):
+        acl_regexp = compile_server_config(server, examples[server]).regexps["acl"]
+        for aces in sizes:
+            output = synthetic_acl_output(aces, acl_regexp["permission_map"])
+            expected = reference_parse_acl(output, acl_regexp)
+            for ace in expected["permissions"]:
+                ace["permission"] = Permission.parse(ace["permission"])
+            if parse_acl(output, acl_regexp) != expected:
+                raise AssertionError(f"parse_acl output differs from the reference for {server} with {aces} ACEs")
+
+            reference = best_of(lambda: reference_parse_acl(output, acl_regexp), repeat)
+            current = best_of(lambda: parse_acl(output, acl_regexp), repeat)
+            results.append({
+                "case": f"{server}/{aces}",
+                "aces": aces,
+                "seconds": current,
+                "aces_per_second": round(aces / current),
+                "reference_seconds": reference,
+                "speedup": round(reference / current, 2),
+            })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES, help="ACE counts to benchmark")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per case, the fastest one counts")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare with the results of an earlier --output")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown against the baseline")
+    args = parser.parse_args()
+
+    results = run(args.sizes, args.repeat)
+    print(f"{'case':<20} {'ms':>10} {'ACEs/s':>12} {'reference ms':>14} {'speedup':>8}")
+    for result in results:
+        print(f"{result['case']:<20} {result['seconds'] * 1000:>10.2f} {result['aces_per_second']:>12} "
+              f"{result['reference_seconds'] * 1000:>14.2f} {result['speedup']:>7}x")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = {result["case"]: result for result in json.load(f)}
+        regressions = [result["case"] for result in results if result["case"] in baseline
+                       and result["seconds"] > baseline[result["case"]]["seconds"] * (1 + args.tolerance)]
+        if regressions:
+            print(f"Slower than {args.baseline}: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,323 @@
+"""
+Local stand-ins for a NAS and Active Directory, used by bench_e2e.py.
+
+NasState holds generated folders with their ACLs, quotas and exports. SSHStub is a paramiko server that answers the
+ls -led, isi, find and chmod commands of configs/servers.json.example from that state, HTTPStub serves the same
+state for WEB# commands, and LDAPStub is an ldap3 MOCK_SYNC directory with generated users and groups that
+helpers.domain connects to instead of a domain controller.
+"""
+import random
+import re
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import paramiko
+from ldap3 import Server, Connection, MOCK_SYNC
+
+import helpers.domain
+
+SEARCH_BASE = "dc=example,dc=com"
+PERMISSIONS = ("dir_gen_all,object_inherit,container_inherit",
+               "dir_gen_read,dir_gen_execute,object_inherit,container_inherit",
+               "dir_gen_read,object_inherit,container_inherit")
+
+
+class NasState:
+    """
+    Folders below ``root`` (``departments`` levels with ``projects`` folders each) with ``aces`` generated ACEs
+    referencing ``users`` users and ``groups`` groups. Every folder is exported over SMB and NFS.
+    """
+
+    def __init__(self, root, departments=5, projects=20, aces=8, users=200, groups=20, seed=0):
+        rng = random.Random(seed)
+        self.root = root.rstrip('/')
+        self.folders = {}
+        self._lock = threading.Lock()
+        self.add_folder(self.root, rng, 0, users, groups)
+        for department in range(departments):
+            department_folder = f"{self.root}/dept_{department}"
+            self.add_folder(department_folder, rng, aces, users, groups)
+            for project in range(projects):
+                self.add_folder(f"{department_folder}/proj_{project}", rng, aces, users, groups)
+
+    def add_folder(self, path, rng=None, aces=0, users=1, groups=1):
+        rng = rng or random.Random(path)
+        owner = f"user{rng.randrange(users)}"
+        with self._lock:
+            self.folders[path] = {
+                "owner": owner,
+                "group": f"grp_{rng.randrange(groups)}",
+                "mode": "rwxrwx---",
+                "quota": f"{rng.randint(1, 50) / 10}T",
+                "aces": [["group", f"grp_{rng.randrange(groups)}", "allow", rng.choice(PERMISSIONS)]
+                         if rng.random() < 0.7 else ["user", f"user{rng.randrange(users)}", "allow", rng.choice(PERMISSIONS)]
+                         for _ in range(aces)],
+            }
+
+    def leaves(self) -> list[str]:
+        with self._lock:
+            return [path for path in self.folders if path.count('/') - self.root.count('/') == 2]
+
+    def ls(self, path) -> str | None:
+        with self._lock:
+            folder = self.folders.get(path)
+            if folder is None:
+                return None
+            lines = [f"d{folder['mode']}  +  2 {folder['owner']}  {folder['group']}  0 Jan  1 12:00 {path}",
+                     f" OWNER: user:{folder['owner']}",
+                     f" GROUP: group:{folder['group']}",
+                     "CONTROL:dacl_auto_inherited"]
+            lines += [f" {index}: {ace_type}:{name} {access} {permission}"
+                      for index, (ace_type, name, access, permission) in enumerate(folder["aces"])]
+        return "\n".join(lines)
+
+    def quota(self, path) -> str | None:
+        with self._lock:
+            folder = self.folders.get(path)
+            return None if folder is None else f"Type: directory\nHard Threshold: {folder['quota']}\n"
+
+    def inventory(self, kind) -> str:
+        """The CSV listing of every SMB share, NFS export or directory quota, as isi ... list --format csv."""
+        with self._lock:
+            folders = {path: dict(folder) for path, folder in self.folders.items()}
+        units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4, "P": 1024 ** 5}
+        if kind == "smb":
+            lines = [f"{path.rsplit('/', 1)[-1]},{path}" for path in folders]
+        elif kind == "nfs":
+            lines = [f"{number},System,{path}," for number, path in enumerate(folders, start=1)]
+        else:
+            lines = [f"directory,DEFAULT,{path},No,{int(float(folder['quota'][:-1]) * units[folder['quota'][-1]])},-,-,0"
+                     for path, folder in folders.items()]
+        return "\n".join(lines) + "\n"
+
+    def find(self, path, min_depth=1, max_depth=None) -> str:
+        path = path.rstrip('/')
+        depth = path.count('/')
+        with self._lock:
+            found = [folder for folder in self.folders if folder.startswith(f"{path}/")
+                     and folder.count('/') - depth >= min_depth
+                     and (max_depth is None or folder.count('/') - depth <= max_depth)]
+        return "\n".join(sorted(found))
+
+    def chmod(self, arguments: str):
+        """Applies the +a#, =a# and -a# forms of chmod that the example add/edit/delete commands print."""
+        match = re.match(r"(?P<op>[+=\\-]+)a# (?P<index>\d+) (?:(?P<type>user|group) (?P<name>\S+) "
+                         r"(?P<access>allow|deny) (?P<permission>\S+) )?(?P<path>\S+)$", arguments.strip())
+        if not match:
+            return
+        path, index = match.group('path'), int(match.group('index'))
+        if path not in self.folders:
+            self.add_folder(path)
+        with self._lock:
+            aces = self.folders[path]["aces"]
+            ace = [match.group('type'), match.group('name'), match.group('access'), match.group('permission')]
+            op = match.group('op').lstrip('\\')
+            if op == '-' and index < len(aces):
+                del aces[index]
+            elif op == '=' and index < len(aces):
+                aces[index] = ace
+            elif op == '+':
+                aces.insert(min(index, len(aces)), ace)
+
+
+class SSHStub(paramiko.ServerInterface):
+    """
+    An SSH server on 127.0.0.1 that accepts any password and answers commands from ``nas``, waiting ``latency``
+    seconds before each reply. Commands it does not know exit with status 127.
+    """
+
+    def __init__(self, nas: NasState, latency=0.0, port=0):
+        self.nas = nas
+        self.latency = latency
+        self.commands = 0
+        self.connections = 0
+        self._key = paramiko.RSAKey.generate(2048)
+        self._socket = socket.socket()
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind(("127.0.0.1", port))
+        self._socket.listen(100)
+        self.port = self._socket.getsockname()[1]
+        threading.Thread(target=self._accept, name="ssh-stub", daemon=True).start()
+
+    def _accept(self):
+        while True:
+            conn, _ = self._socket.accept()
+            self.connections += 1
+            transport = paramiko.Transport(conn)
+            transport.add_server_key(self._key)
+            transport.start_server(server=self)
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return "password"
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=self._exec, args=(channel, command.decode()), daemon=True).start()
+        return True
+
+    def _exec(self, channel, command):
+        self.commands += 1
+        if self.latency:
+            time.sleep(self.latency)
+        try:
+            status, output = self.run(command)
+        except Exception as e:
+            status, output = 1, f"{e}\n"
+        if status == 0:
+            channel.sendall(output.encode())
+        else:
+            channel.sendall_stderr(output.encode())
+        channel.send_exit_status(status)
+        # EOF instead of close, closing can overtake the reply to the exec request and fail it on the client.
+        # The client closes the channel once it has read the output.
+        channel.shutdown_write()
+
+    def run(self, command) -> tuple[int, str]:
+        if command.startswith("exec 2>&1\n"):
+            return self.run_batch(command[len("exec 2>&1\n"):])
+        if match := re.fullmatch(r'ls -led (\S+) && echo "(.*)"', command):
+            listing = self.nas.ls(match.group(1))
+            if listing is None:
+                return 1, f"ls: {match.group(1)}: No such file or directory\n"
+            return 0, f"{listing}\n{match.group(2)}\n"
+        if match := re.fullmatch(r"isi (smb shares|nfs exports|quota quotas) list(?: --type directory)? "
+                                 r"--format csv --no-header --no-footer", command):
+            return 0, self.nas.inventory(match.group(1).split()[0])
+        if match := re.fullmatch(r"isi quota quotas view (\S+) directory", command):
+            quota = self.nas.quota(match.group(1))
+            return (0, quota) if quota is not None else (1, "Quota not found\n")
+        if match := re.fullmatch(r'\(isi (?:smb shares|nfs exports) list \| grep "(\S+)"\) && echo "(\w+),"',
+                                 command):
+            if match.group(1) not in self.nas.folders:
+                return 1, ""
+            return 0, f"{match.group(1)}\n{match.group(2)},\n"
+        if match := re.fullmatch(r"find (\S+) -mindepth (\d+)(?: -maxdepth (\d+))?(?: -type d)?\s*", command):
+            max_depth = int(match.group(3)) if match.group(3) else None
+            return 0, self.nas.find(match.group(1), int(match.group(2)), max_depth) + "\n"
+        if command.startswith("echo "):
+            # The example mutations are dry runs that print the chmod, apply it so re-imports see the change
+            for part in command[5:].split(" && echo "):
+                if part.startswith("chmod "):
+                    self.nas.chmod(part[len("chmod "):].replace("-h ", "", 1))
+            return 0, command[5:] + "\n"
+        return 127, f"stub: unknown command: {command}\n"
+
+    def run_batch(self, script) -> tuple[int, str]:
+        """A script of helpers.commands.batch_script: every mutation's { } groups, then its exit status."""
+        output = ""
+        for mutation in script.split("; printf '\x1e%s\\n' \"$?\"\n")[:-1]:
+            status = 0
+            for command in re.findall(r"\{ (.*?)\n\}", mutation, re.S):
+                status, reply = self.run(command)
+                output += reply
+                if status:
+                    break
+            output += f"\x1e{status}\n"
+        return 0, output
+
+
+class HTTPStub:
+    """An HTTP server on 127.0.0.1 serving /cli/acl, /cli/quotas and /cli/protocols from ``nas``."""
+
+    def __init__(self, nas: NasState, latency=0.0, port=0):
+        stub = self
+        self.nas = nas
+        self.latency = latency
+        self.requests = 0
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def reply(self, status, body):
+                self.send_response(status)
+                self.send_header("Content-Type", "text/plain")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                stub.requests += 1
+                if stub.latency:
+                    time.sleep(stub.latency)
+                url = urlparse(self.path)
+                path = parse_qs(url.query).get("path", [""])[0]
+                if url.path == "/cli/acl":
+                    body = stub.nas.ls(path)
+                    body = None if body is None else f"{body}\neveryone:Domain Users\n"
+                elif url.path == "/cli/quotas":
+                    body = stub.nas.quota(path)
+                elif url.path == "/cli/protocols":
+                    body = "smb,\nnfs,\n" if path in stub.nas.folders else None
+                else:
+                    body = None
+                if body is None:
+                    self.reply(404, b"Not found")
+                else:
+                    self.reply(200, body.encode())
+
+            def do_PUT(self):
+                stub.requests += 1
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                self.reply(200, b"{}")
+
+            do_POST = do_PUT
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.url = f"http://127.0.0.1:{self.port}"
+        threading.Thread(target=self.server.serve_forever, name="http-stub", daemon=True).start()
+
+
+class LDAPStub:
+    """
+    An ldap3 MOCK_SYNC directory with ``users`` users and ``groups`` groups of ``group_size`` members, patched
+    into helpers.domain so its connection pools bind to the directory instead of a domain controller.
+    """
+
+    def __init__(self, users=200, groups=20, group_size=50, seed=0):
+        rng = random.Random(seed)
+        self.server = Server("ldap-stub")
+        self._directory = Connection(self.server, user="cn=bench", password="bench", client_strategy=MOCK_SYNC)
+        self._directory.strategy.add_entry("cn=bench", {"userPassword": "bench", "sn": "bench"})
+        for number in range(users):
+            dn = f"cn=user{number},{SEARCH_BASE}"
+            self._directory.strategy.add_entry(dn, {
+                "objectClass": "user", "samAccountName": f"user{number}", "givenName": "User", "sn": str(number),
+                "mail": f"user{number}@example.com", "distinguishedName": dn})
+        for number in range(groups):
+            dn = f"cn=grp_{number},{SEARCH_BASE}"
+            members = rng.sample(range(users), min(group_size, users))
+            self._directory.strategy.add_entry(dn, {
+                "objectClass": "group", "cn": f"grp_{number}", "samAccountName": f"grp_{number}",
+                "distinguishedName": dn, "member": [f"cn=user{member},{SEARCH_BASE}" for member in members]})
+
+        stub = self
+
+        class StubPool(helpers.domain.LDAPConnectionPool):
+            def __init__(self, domain_config, size=helpers.domain.POOL_SIZE):
+                super().__init__(domain_config, size)
+                self.server = stub.server
+
+            def _bind(self):
+                conn = Connection(stub.server, user="cn=bench", password="bench", client_strategy=MOCK_SYNC)
+                conn.strategy.entries = stub._directory.strategy.entries
+                conn.bind()
+                self._stats["binds"] += 1
+                return conn
+
+        helpers.domain.LDAPConnectionPool = StubPool
+        self.pool_class = StubPool
+
+    @staticmethod
+    def domain_config() -> dict:
+        return {"server": "ldap://ldap-stub", "user": "cn=bench", "password": "bench", "search_base": SEARCH_BASE}
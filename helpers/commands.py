@@ -1,17 +1,37 @@
+import codecs
 import json
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
 
 from jinja2 import Template
-from paramiko.client import SSHClient, AutoAddPolicy
 from paramiko.ssh_exception import SSHException
-from requests import get, post, put, RequestException
+from requests import RequestException
 from requests.auth import HTTPBasicAuth
 
+from helpers.cache import TTLCache
+from helpers.config import compile_server_config, jinja_env
+from helpers.connections import entry_name, get_local_runner, get_ssh_pool, get_web_pool
+from helpers.metrics import COMMAND_SECONDS, PARSE_SECONDS, TRANSPORT_SECONDS, timed
 from helpers.parsers import parse_output
 
 
-def local_exec_command(server_config, command, arguments):
-    raise NotImplementedError("Local command execution is not implemented.")
+def local_exec_command(server_config, command, arguments: dict):
+    """
+    Executes a command on this host and returns the output.
+
+    The command runs in a shell, the values in LOCAL# templates are quoted by helpers.config.local_jinja_env.
+    """
+    logging.debug(f"Executing local command: {command}")
+    # Labelled with the entry like its runner, every LOCAL# entry runs on this host
+    with timed(TRANSPORT_SECONDS, server=entry_name(server_config), transport="local"):
+        exit_status, stdout, stderr = get_local_runner(server_config).exec_command(command)
+    if exit_status != 0:
+        raise OSError(f"{command} failed with exit status {exit_status}: {stderr.decode('utf-8')}")
+    output = stdout.decode('utf-8').strip()
+    logging.debug(f"Output: {output}")
+    return output
 
 
 def map_output(web_output, command_type, mapping):
@@ -21,7 +41,8 @@ def map_output(web_output, command_type, mapping):
     Args:
         web_output (dict): The output from the web call.
         command_type (str): The type of command (not used in this implementation but kept for signature consistency).
-        mapping (dict): The mapping structure with Jinja2 templates or hardcoded values.
+        mapping (dict): The mapping structure with Jinja2 templates or hardcoded values, either as strings
+            or precompiled by helpers.config.
 
     Returns:
         dict: The mapped output with resolved templates and hardcoded values.
@@ -56,57 +77,132 @@ def map_output(web_output, command_type, mapping):
             return {key: recursive_map(value, data) for key, value in structure.items()}
         elif isinstance(structure, list):
             return [recursive_map(item, data) for item in structure]
+        elif isinstance(structure, Template):
+            return structure.render(**data)
         elif isinstance(structure, str):
             # Render the string as a Jinja2 template
-            template = Template(structure)
-            return template.render(**data)
+            return jinja_env.from_string(structure).render(**data)
         else:
             return structure
 
     return recursive_map(mapping, web_output)
 
 
-def exec_command(server_config, command_type, arguments: dict):
+def run_raw_command(server_config, command_type, template: Template, arguments: dict) -> str:
     """
-    Executes a command on the server and returns the output.
+    Renders and executes a single compiled command from a command list and returns its unparsed output.
     """
-    command_list = server_config[f"{command_type}_command"]
-    output = []
+    # Render the command with Jinja2
+    command = template.render(**arguments)
 
-    for raw_command in command_list:
-        # Render the command with Jinja2
-        template = Template(raw_command)
-        command = template.render(**arguments)
+    logging.debug(f"Command executing: {command}")
+    if command.startswith("SSH#"):
+        return ssh_exec_command(server_config, command[4:], arguments)
+    elif command.startswith("WEB#"):
+        return web_exec_command(server_config, command[4:], arguments)
+    elif command.startswith("LOCAL#"):
+        return local_exec_command(server_config, command[6:], arguments)
+    raise NotImplementedError(f"Unsupported command prefix for {command_type}, should be SSH#, WEB# or LOCAL#")
 
-        logging.debug(f"Command executing: {command}")
+
+def iter_lines(chunks):
+    """Decodes a stream of UTF-8 byte chunks into lines, without the line endings."""
+    decoder = codecs.getincrementaldecoder('utf-8')('replace')
+    pending = ""
+    for chunk in chunks:
+        lines = (pending + decoder.decode(chunk)).splitlines(keepends=True)
+        # The last line may continue in the next chunk, a trailing \r may be the first half of a \r\n
+        pending = lines.pop() if lines and not lines[-1].endswith('\n') else ""
+        for line in lines:
+            yield line.rstrip('\r\n')
+    pending += decoder.decode(b'', final=True)
+    if pending:
+        yield pending.rstrip('\r')
+
+
+def stream_command(server_config, command_type, arguments: dict):
+    """
+    Executes a command list and yields the output lines of its commands, in command list order, while they run.
+
+    For listings too large to hold in memory (inventories, find output): only one chunk of output is held at a
+    time and the caller can start working on the first lines before the command finishes. Streamed output is
+    not cached. A failing command raises after its last line.
+    """
+    server_config = compile_server_config(server_config.get('title', ''), server_config)
+    for template in server_config.templates[command_type]:
+        command = template.render(**arguments)
+        logging.debug(f"Command streaming: {command}")
         if command.startswith("SSH#"):
-            raw_output = ssh_exec_command(server_config, command[4:], arguments)
+            transport, chunks = "ssh", get_ssh_pool(server_config).stream_command(command[4:])
         elif command.startswith("WEB#"):
-            raw_output = web_exec_command(server_config, command[4:], arguments)
+            method, url, headers, auth, data = web_request(server_config, command[4:], dict(arguments))
+            transport, chunks = "web", get_web_pool(server_config).stream(method, url, headers, auth, data)
         elif command.startswith("LOCAL#"):
-            raw_output = local_exec_command(server_config, command[6:], arguments)
+            transport, chunks = "local", get_local_runner(server_config).stream_command(command[6:])
         else:
-            raise NotImplementedError(f"Unsupported command prefix for {command_type}, should be SSH#, WEB# or LOCAL#")
+            raise NotImplementedError(f"Unsupported command prefix for {command_type}, should be SSH#, WEB# or "
+                                      f"LOCAL#")
+        # Includes the time the caller spends on the lines, the command runs for that long too
+        with timed(TRANSPORT_SECONDS, server=entry_name(server_config), transport=f"{transport}_stream"):
+            yield from iter_lines(chunks)
 
-        # If there is a regexp directive, parse it through that
-        if f"{command_type}_regexp" in server_config:
-            raw_output = parse_output(str(raw_output), command_type, server_config[f"{command_type}_regexp"])
 
-        # There is no regexp directive, and we're still a string, then we should have returned JSON
-        if isinstance(raw_output, str):
-            try:
-                raw_output = json.loads(raw_output)
-            except json.JSONDecodeError:
-                logging.debug(f"Failed to parse JSON output, not JSON?: {raw_output}")
-                raw_output = {"output": raw_output}
-
-        if f"{command_type}_mapper" in server_config:
-            raw_output = map_output(raw_output, command_type, server_config[f"{command_type}_mapper"])
+def parse_command_output(server_config, command_type, raw_output):
+    """
+    Parses and maps the output of a single command with the regexp and mapper of its command type.
 
-        output.append(raw_output)
+    A command type with a <command_type>_format (see helpers.parsers.StructuredFormat) returns JSON and is read
+    field by field instead, without regexp or mapper.
+    """
+    if command_type in server_config.formats:
+        with timed(PARSE_SECONDS, command_type=command_type, stage="format"):
+            raw_output = server_config.formats[command_type].parse(raw_output)
         logging.debug(f"Output from command: {raw_output}")
+        return raw_output
+
+    # If there is a regexp directive, parse it through that
+    if command_type in server_config.regexps:
+        with timed(PARSE_SECONDS, command_type=command_type, stage="regexp"):
+            raw_output = parse_output(str(raw_output), command_type, server_config.regexps[command_type])
+
+    # There is no regexp directive, and we're still a string, then we should have returned JSON
+    if isinstance(raw_output, str):
+        try:
+            raw_output = json.loads(raw_output)
+        except json.JSONDecodeError:
+            logging.debug(f"Failed to parse JSON output, not JSON?: {raw_output}")
+            raw_output = {"output": raw_output}
+
+    if command_type in server_config.mappers:
+        with timed(PARSE_SECONDS, command_type=command_type, stage="mapper"):
+            raw_output = map_output(raw_output, command_type, server_config.mappers[command_type])
+
+    logging.debug(f"Output from command: {raw_output}")
+    return raw_output
+
+
+def run_command(server_config, command_type, template: Template, arguments: dict):
+    """
+    Renders, executes, parses and maps a single compiled command from a command list.
+    """
+    raw_output = run_raw_command(server_config, command_type, template, arguments)
+    return parse_command_output(server_config, command_type, raw_output)
+
+
+def parse_outputs(server_config, command_type, raw_outputs: list) -> dict:
+    """
+    Parses the raw outputs of a command list, as returned by exec_commands(..., raw=True), into the merged
+    output exec_command would have returned.
+    """
+    server_config = compile_server_config(server_config.get('title', ''), server_config)
+    return merge_outputs([parse_command_output(server_config, command_type, raw_output)
+                          for raw_output in raw_outputs])
 
-    # Merge the dicts
+
+def merge_outputs(output: list[dict]) -> dict:
+    """
+    Merges the per-command output dicts of a command list, in command list order.
+    """
     merged_output = {}
     for item in output:
         for key,value in item.items():
@@ -117,36 +213,339 @@ def exec_command(server_config, command_type, arguments: dict):
     logging.debug(merged_output)
     return merged_output
 
+
+# Command types that only read the state of a folder, their raw outputs are cached per (server, type, folder)
+CACHED_COMMANDS = ("acl", "quota", "protocol")
+# Command types that change the ACL of a folder, and through inheritance possibly the folders below it
+MUTATING_COMMANDS = ("create_acl", "edit_acl", "delete_acl", "fix_acl")
+# Defaults, read_cache_ttl can be set per server in servers.json, 0 disables the cache for that server
+READ_CACHE_SIZE = 4096
+READ_CACHE_TTL = 60
+
+_read_cache = TTLCache(READ_CACHE_SIZE, READ_CACHE_TTL)
+_read_cache_lock = Lock()
+# Bumped by every invalidation, a read that started before it must not store its (possibly stale) output
+_read_generation = 0
+_read_invalidations = 0
+# Called with (server_config, folder_name, command_type) after every invalidation, for caches built on the reads
+_invalidation_listeners = []
+
+
+def host_key(server_config) -> str:
+    """The host a servers.json entry talks to, several entries can point at the same host."""
+    return server_config.get('ssh_host') or server_config.get('web_host') or server_config.get('title', '')
+
+
+def server_key(server_config) -> tuple[str, str]:
+    """
+    The servers.json entry (and its host) for caches of parsed or parseable output, entries on the same host
+    may parse the same folders with other regexps and formats.
+    """
+    return entry_name(server_config), host_key(server_config)
+
+
+def _read_cache_key(server_config, command_type, arguments: dict):
+    """The cache key of a read, None for commands that are not cached or that take more than a folder_name."""
+    if command_type not in CACHED_COMMANDS or set(arguments) != {"folder_name"}:
+        return None
+    if not server_config.get('read_cache_ttl', READ_CACHE_TTL):
+        return None
+    return *server_key(server_config), command_type, arguments["folder_name"]
+
+
+def _store_read(server_config, key, generation, raw_outputs: list):
+    if key is None:
+        return
+    with _read_cache_lock:
+        if generation == _read_generation:
+            _read_cache.set(key, tuple(raw_outputs), server_config.get('read_cache_ttl', READ_CACHE_TTL))
+
+
+def on_invalidate(callback):
+    """
+    Registers callback(server_config, folder_name, command_type) to run after invalidate_reads, usable as a
+    decorator. command_type is the mutation that caused the invalidation, None for an explicit one.
+    """
+    _invalidation_listeners.append(callback)
+    return callback
+
+
+def invalidate_reads(server_config=None, folder_name=None, command_type=None) -> int:
+    """
+    Drops the cached reads of folder_name and every folder below it on a server, for every servers.json entry of
+    the server's host. Without a folder all reads of the host are dropped, without a server the whole cache.
+    Returns the number of entries dropped.
+    """
+    global _read_generation, _read_invalidations
+    with _read_cache_lock:
+        _read_generation += 1
+        if server_config is None:
+            dropped = len(_read_cache)
+            _read_cache.clear()
+        else:
+            host = host_key(server_config)
+            prefix = f"{folder_name.rstrip('/')}/" if folder_name else ""
+            dropped = _read_cache.invalidate_where(
+                lambda key: key[1] == host and (not folder_name or key[3] == folder_name
+                                                or key[3].startswith(prefix)))
+        _read_invalidations += dropped
+    for callback in _invalidation_listeners:
+        callback(server_config, folder_name, command_type)
+    return dropped
+
+
+def read_cache_stats() -> dict:
+    return {**_read_cache.stats(), "invalidations": _read_invalidations}
+
+
+def exec_command(server_config, command_type, arguments: dict, concurrent=False, refresh=False):
+    """
+    Executes a command on the server and returns the output.
+
+    By default the commands in the command list run one after the other, which is what mutations
+    (create/edit/delete ACL) need. Read-only probes can pass concurrent=True to run them in parallel.
+
+    The outputs of the acl, quota and protocol commands of a folder are cached for read_cache_ttl seconds
+    (servers.json, default 60), refresh=True skips the cached output. The mutating command types drop the
+    cached reads of the folder they touch and of the folders below it.
+    """
+    if concurrent:
+        return exec_commands(server_config, [(command_type, arguments)], refresh=refresh)[0]
+
+    server_config = compile_server_config(server_config.get('title', ''), server_config)
+    key = _read_cache_key(server_config, command_type, arguments)
+    cached = None if refresh or key is None else _read_cache.get(key)
+    if cached is not None:
+        return merge_outputs([parse_command_output(server_config, command_type, raw_output)
+                              for raw_output in cached])
+
+    generation = _read_generation
+    output = []
+    raw_outputs = []
+    try:
+        with timed(COMMAND_SECONDS, server=entry_name(server_config), command_type=command_type):
+            for template in server_config.templates[command_type]:
+                raw_outputs.append(run_raw_command(server_config, command_type, template, arguments))
+                output.append(parse_command_output(server_config, command_type, raw_outputs[-1]))
+    finally:
+        # Also after a failure, the command list may have been applied partially
+        if command_type in MUTATING_COMMANDS:
+            invalidate_reads(server_config, arguments.get('folder_name'), command_type)
+    _store_read(server_config, key, generation, raw_outputs)
+    return merge_outputs(output)
+
+
+# Worker threads for concurrent command execution, one pool of max_concurrency threads per host, so the
+# commands waiting for a busy server never hold threads the other servers need
+_server_executors: dict[str, ThreadPoolExecutor] = {}
+_server_executors_lock = Lock()
+
+
+def _server_executor(server_config) -> ThreadPoolExecutor:
+    key = host_key(server_config)
+    with _server_executors_lock:
+        if key not in _server_executors:
+            _server_executors[key] = ThreadPoolExecutor(max_workers=server_config.get('max_concurrency', 4),
+                                                        thread_name_prefix=f"exec_command-{key}")
+        return _server_executors[key]
+
+
+def exec_commands(server_config, commands: list[tuple[str, dict]], raw=False, refresh=False) -> list:
+    """
+    Executes several independent command types on the same server concurrently.
+
+    Every command of every command list is fanned out to the worker pool of the server, with at most
+    max_concurrency (servers.json, default 4) of them running against the server at once. The per-command
+    outputs are merged per command type in command list order, exactly like exec_command does. Reads are
+    cached and mutations invalidate them like in exec_command.
+
+    Args:
+        server_config (dict): The servers.json entry of the server.
+        commands (list): (command_type, arguments) tuples, e.g. [("acl", args), ("quota", args)].
+        raw (bool): Return the unparsed output of every command instead, see parse_outputs.
+        refresh (bool): Ask the server even if the output of a read is cached.
+
+    Returns:
+        list: The merged output of each command type (with raw, the list of command outputs of each command
+            type), in the order they were requested.
+    """
+    server_config = compile_server_config(server_config.get('title', ''), server_config)
+    executor = _server_executor(server_config)
+    started = time.perf_counter()
+    generation = _read_generation
+    keys = [_read_cache_key(server_config, command_type, arguments) for command_type, arguments in commands]
+    futures = []
+    for (command_type, arguments), key in zip(commands, keys):
+        cached = None if refresh or key is None else _read_cache.get(key)
+        if cached is not None:
+            futures.append(cached)
+            continue
+        # Every command gets its own copy of the arguments, web_exec_command writes into them
+        futures.append([executor.submit(run_raw_command, server_config, command_type, template, dict(arguments))
+                        for template in server_config.templates[command_type]])
+
+    results = []
+    try:
+        for (command_type, _), key, command_futures in zip(commands, keys, futures):
+            if isinstance(command_futures, tuple):
+                outputs = list(command_futures)
+            else:
+                outputs = [future.result() for future in command_futures]
+                # The command types run side by side, each is timed from the submission until its last command
+                COMMAND_SECONDS.observe(time.perf_counter() - started, server=entry_name(server_config),
+                                        command_type=command_type)
+                _store_read(server_config, key, generation, outputs)
+            results.append(outputs if raw else
+                           merge_outputs([parse_command_output(server_config, command_type, output)
+                                          for output in outputs]))
+    finally:
+        for command_type, arguments in commands:
+            if command_type in MUTATING_COMMANDS:
+                invalidate_reads(server_config, arguments.get('folder_name'), command_type)
+    return results
+
+
+# Default for the optional ssh_batch_size in servers.json, the number of mutations sent as one script by exec_batch
+SSH_BATCH_SIZE = 50
+# Printed by a batch script after every mutation, followed by its exit status
+BATCH_MARKER = "\x1e"
+
+
+def batch_script(mutations: list[list[str]]) -> str:
+    """
+    A POSIX shell script that runs the rendered commands of every mutation (without the SSH# prefix) and prints
+    BATCH_MARKER and the exit status after each. The commands of one mutation are chained with &&, like
+    exec_command stops a command list at the first failure, and every command gets its own { } group, so a
+    failing mutation does not stop the ones after it.
+    """
+    lines = ["exec 2>&1"]
+    for commands in mutations:
+        lines.append(" && ".join(f"{{ {command}\n}}" for command in commands)
+                     + f"; printf '{BATCH_MARKER}%s\\n' \"$?\"")
+    return "\n".join(lines) + "\n"
+
+
+def ssh_exec_batch(server_config, mutations: list[list[str]]) -> list[OSError | None]:
+    """Runs batch_script(mutations) over the server's pooled SSH connection, returns None or the error of each."""
+    script = batch_script(mutations)
+    logging.debug(f"Executing batch of {len(mutations)} commands: {script}")
+    with timed(TRANSPORT_SECONDS, server=entry_name(server_config), transport="ssh_batch"):
+        exit_status, stdout, stderr = get_ssh_pool(server_config).exec_command(script)
+    pieces = stdout.decode('utf-8').split(BATCH_MARKER)
+    results = []
+    output = pieces[0]
+    for piece in pieces[1:len(mutations) + 1]:
+        status, _, rest = piece.partition("\n")
+        results.append(None if status.strip() == "0" else
+                       OSError(f"{' && '.join(mutations[len(results)])} failed with exit status {status.strip()}: "
+                               f"{output.strip()}"))
+        output = rest
+    # The script ended early, e.g. a command ran exit, the mutation that was running may have been applied
+    for number, commands in enumerate(mutations[len(results):]):
+        results.append(OSError(f"{' && '.join(commands)} {'did not finish' if number == 0 else 'did not run'}, "
+                               f"the batch stopped with exit status {exit_status}: "
+                               f"{output.strip()} {stderr.decode('utf-8').strip()}".rstrip()))
+        output = ""
+    return results
+
+
+def exec_batch(server_config, commands: list[tuple[str, dict]], on_batch=None) -> list[Exception | None]:
+    """
+    Runs many mutations (e.g. a create_acl per new share) on one server in order and returns None or the error
+    of each, a failure does not stop the mutations after it.
+
+    Every command list is rendered before anything is sent, a mutation that does not render fails on its own.
+    Mutations whose command list is all SSH# are sent as scripts of up to ssh_batch_size (servers.json, default
+    50) mutations, see batch_script, so provisioning 200 shares takes a few round trips instead of 200. Other
+    mutations run with exec_command. Any error of a batch (or single mutation) fails only its mutations.
+    The cached reads of every touched folder are invalidated like exec_command does.
+
+    Args:
+        on_batch: called with {number: None or error} of the mutations of every batch once it ran, e.g. to
+            store the applied ones right away.
+    """
+    server_config = compile_server_config(server_config.get('title', ''), server_config)
+    batch_size = server_config.get('ssh_batch_size', SSH_BATCH_SIZE)
+    results: list[Exception | None] = [None] * len(commands)
+
+    def report(numbers, errors):
+        for number, error in zip(numbers, errors):
+            results[number] = error
+        if on_batch:
+            on_batch(dict(zip(numbers, errors)))
+
+    rendered = {}
+    for number, (command_type, arguments) in enumerate(commands):
+        try:
+            rendered[number] = [template.render(**arguments) for template in server_config.templates[command_type]]
+        except Exception as e:
+            report([number], [ValueError(f"{command_type} for {arguments.get('folder_name')} does not render: {e}")])
+
+    batch: list[tuple[int, list[str]]] = []
+
+    def flush():
+        if batch:
+            numbers = [number for number, _ in batch]
+            try:
+                errors = ssh_exec_batch(server_config, [command_list for _, command_list in batch])
+            except Exception as e:
+                # E.g. the connection failed, any of the mutations may or may not have been applied
+                errors = [e] * len(batch)
+            batch.clear()
+            report(numbers, errors)
+
+    try:
+        for number, command_list in rendered.items():
+            if all(command.startswith("SSH#") for command in command_list):
+                batch.append((number, [command[4:] for command in command_list]))
+                if len(batch) >= batch_size:
+                    flush()
+                continue
+            # Keep the order, everything batched so far runs first
+            flush()
+            command_type, arguments = commands[number]
+            try:
+                exec_command(server_config, command_type, arguments)
+                error = None
+            except Exception as e:
+                error = e
+            report([number], [error])
+        flush()
+    finally:
+        for command_type, arguments in commands:
+            if command_type in MUTATING_COMMANDS:
+                invalidate_reads(server_config, arguments.get('folder_name'), command_type)
+    return results
+
+
 def ssh_exec_command(server_config, command, arguments: dict):
     """
     Executes a command on the server via SSH and returns the output.
+
+    The command runs on a channel of the server's pooled SSH connection, so only the first command
+    against a server pays for the TCP handshake, key exchange and authentication.
     """
     logging.debug(f"Executing command: {command}")
     try:
-        # Execute the command
-        with SSHClient() as ssh:
-            ssh.set_missing_host_key_policy(AutoAddPolicy())
-            ssh.connect(server_config['ssh_host'],
-                        username=server_config['ssh_username'],
-                        password=server_config['ssh_password'])
-            stdin, stdout, stderr = ssh.exec_command(command)
-            exit_status = stdout.channel.recv_exit_status()
-            if exit_status != 0:
-                raise OSError(f"{command} failed with exit status {exit_status}: {stderr.read().decode('utf-8')}")
-            output = stdout.read().decode('utf-8').strip()
+        with timed(TRANSPORT_SECONDS, server=entry_name(server_config), transport="ssh"):
+            exit_status, stdout, stderr = get_ssh_pool(server_config).exec_command(command)
+        if exit_status != 0:
+            raise OSError(f"{command} failed with exit status {exit_status}: {stderr.decode('utf-8')}")
+        output = stdout.decode('utf-8').strip()
     except SSHException as e:
         logging.error(f"SSH Error: {e}")
         raise
     logging.debug(f"Output: {output}")
     return output
 
-def web_exec_command(server_config, command, arguments: dict):
+def web_request(server_config, command, arguments: dict) -> tuple[str, str, dict, object, dict]:
     """
-    Executes a command on the server via web interface and returns the output.
+    Splits a WEB# command into the (method, url, headers, auth, data) of its request.
     """
     # We have GET# and POST# commands and PUT# commands
     auth = None
-    headers = server_config.get("web_headers", {})
+    # A copy, the bearer token must not end up in the shared server config
+    headers = dict(server_config.get("web_headers", {}))
     if server_config.get("web_auth") == "basic":
         auth = HTTPBasicAuth(server_config["web_username"], server_config["web_password"])
     elif server_config.get("web_auth") == "bearer":
@@ -160,20 +559,25 @@ def web_exec_command(server_config, command, arguments: dict):
         url = command.split(";data=")[0]
         arguments["data"] = data
 
+    method, _, url = url.partition("#")
+    if method not in ("GET", "POST", "PUT"):
+        raise ValueError(f"Unsupported web command: {command}")
+    return method, url, headers, auth, data
+
+
+def web_exec_command(server_config, command, arguments: dict):
+    """
+    Executes a command on the server via web interface and returns the output.
+
+    The request goes through the server's pooled session, see helpers.connections.WebSessionPool.
+    """
+    method, url, headers, auth, data = web_request(server_config, command, arguments)
+
     logging.debug(f"Executing web command: {command}")
     try:
-        # Parse the command and execute the appropriate HTTP request
-        if url.startswith("GET#"):
-            response = get(url[4:],  headers=headers, auth=auth, json=data)
-        elif command.startswith("POST#"):
-            response = post(url[5:], headers=headers, auth=auth, json=data)
-        elif command.startswith("PUT#"):
-            response = put(url[4:],  headers=headers, auth=auth, json=data)
-        else:
-            raise ValueError(f"Unsupported web command: {command}")
-
-        response.raise_for_status()  # Raise an error for HTTP status codes 4xx/5xx
-        output = response.text
+        with timed(TRANSPORT_SECONDS, server=entry_name(server_config), transport="web"):
+            # Raises an error for HTTP status codes 4xx/5xx
+            output = get_web_pool(server_config).request(method, url, headers=headers, auth=auth, json=data)
     except RequestException as e:
         logging.error(f"Web command error: {e}")
         raise
@@ -0,0 +1,297 @@
+import json
+import logging
+import os
+import re
+import shlex
+import time
+from collections.abc import Mapping
+from threading import Lock
+
+from jinja2 import Environment, Template, TemplateSyntaxError
+
+from helpers.parsers import StructuredFormat, permission_masks
+
+# One Jinja2 environment for every command and mapper template, so filters and caches are shared
+jinja_env = Environment()
+# Quotes a value for use as a single shell word, e.g. {{ paths | map('shell_quote') | join(' ') }}
+jinja_env.filters['shell_quote'] = lambda value: shlex.quote(str(value))
+
+
+class ShellQuoted(str):
+    """A rendered value that is already quoted for the shell, see local_jinja_env."""
+
+
+def shell_quote(value) -> ShellQuoted:
+    return value if isinstance(value, ShellQuoted) else ShellQuoted(shlex.quote(str(value)))
+
+
+def shell_join(value, d='', attribute=None) -> str:
+    """The join filter, keeping the result quoted if every joined item was."""
+    items = [item[attribute] if attribute else item for item in value]
+    joined = d.join(str(item) for item in items)
+    return ShellQuoted(joined) if items and all(isinstance(item, ShellQuoted) for item in items) else joined
+
+
+def shell_finalize(value):
+    """
+    Quotes every {{ }} of a LOCAL# command as one shell word (a list as one word per item), so a folder name
+    can never inject shell syntax. Values that went through shell_quote are left alone, None renders as nothing.
+    """
+    if value is None:
+        return ''
+    if isinstance(value, ShellQuoted):
+        return value
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return " ".join(shell_quote(item) for item in value)
+    return shell_quote(value)
+
+
+# LOCAL# commands run in a shell on this host, their values are quoted without relying on the template author
+local_jinja_env = Environment(finalize=shell_finalize)
+local_jinja_env.filters['shell_quote'] = shell_quote
+local_jinja_env.filters['join'] = shell_join
+
+COMMAND_PREFIXES = ("SSH#", "WEB#", "LOCAL#")
+ACL_PATTERNS = ("owner", "group", "everyone", "posix", "acl")
+
+
+class ServerConfig(dict):
+    """
+    A servers.json entry with its command templates, mappers and regular expressions compiled once.
+
+    The raw keys are still available through the dict interface, the compiled versions are kept in
+    ``templates``, ``mappers``, ``regexps`` and ``formats`` keyed by command type (e.g. "acl", "create_acl").
+    """
+
+    def __init__(self, name, raw: dict):
+        super().__init__(raw)
+        self.name = name
+        self.templates: dict[str, list[Template]] = {}
+        self.mappers: dict[str, object] = {}
+        self.regexps: dict[str, object] = {}
+        self.formats: dict[str, StructuredFormat] = {}
+
+        if not isinstance(self.get('title'), str):
+            raise ValueError(f"Server {name}: 'title' is required")
+
+        for key, value in raw.items():
+            if key.endswith("_command"):
+                self.templates[key[:-len("_command")]] = self._compile_commands(key, value)
+            elif key.endswith("_mapper"):
+                self.mappers[key[:-len("_mapper")]] = self._compile_mapper(key, value)
+            elif key.endswith("_regexp"):
+                self.regexps[key[:-len("_regexp")]] = self._compile_regexp(key, value)
+
+        for key, value in raw.items():
+            if key.endswith("_format"):
+                self.formats[key[:-len("_format")]] = self._compile_format(key, value)
+
+    def _compile_template(self, key, source) -> Template:
+        env = local_jinja_env if source.startswith("LOCAL#") else jinja_env
+        try:
+            return env.from_string(source)
+        except TemplateSyntaxError as e:
+            raise ValueError(f"Server {self.name}: invalid template in {key}: {e}") from e
+
+    def _compile_commands(self, key, commands) -> list[Template]:
+        if not isinstance(commands, list) or not all(isinstance(command, str) for command in commands):
+            raise ValueError(f"Server {self.name}: {key} must be a list of strings")
+        for command in commands:
+            if not command.startswith(COMMAND_PREFIXES):
+                raise ValueError(f"Server {self.name}: {key} command must start with SSH#, WEB# or LOCAL#: {command}")
+        return [self._compile_template(key, command) for command in commands]
+
+    def _compile_mapper(self, key, structure):
+        if isinstance(structure, dict):
+            return {k: self._compile_mapper(key, v) for k, v in structure.items()}
+        elif isinstance(structure, list):
+            return [self._compile_mapper(key, item) for item in structure]
+        elif isinstance(structure, str):
+            return self._compile_template(key, structure)
+        return structure
+
+    def _compile_format(self, key, spec) -> StructuredFormat:
+        command_type = key[:-len("_format")]
+        if command_type in self.regexps or command_type in self.mappers:
+            raise ValueError(f"Server {self.name}: {key} cannot be combined with a {command_type}_regexp or "
+                             f"{command_type}_mapper")
+        try:
+            return StructuredFormat(command_type, spec)
+        except ValueError as e:
+            raise ValueError(f"Server {self.name}: invalid {key}: {e}") from e
+
+    def _compile_pattern(self, key, pattern) -> re.Pattern:
+        try:
+            return re.compile(pattern)
+        except (re.error, TypeError) as e:
+            raise ValueError(f"Server {self.name}: invalid regular expression in {key}: {e}") from e
+
+    def _compile_regexp(self, key, regexp):
+        if key != "acl_regexp":
+            return self._compile_pattern(key, regexp)
+
+        # The ACL parser takes a set of named patterns and a permission map
+        patterns = regexp.get('regex_patterns', {}) if isinstance(regexp, dict) else {}
+        missing = [name for name in ACL_PATTERNS if name not in patterns]
+        if missing:
+            raise ValueError(f"Server {self.name}: acl_regexp.regex_patterns is missing {', '.join(missing)}")
+        permission_map = dict(regexp.get('permission_map', {}))
+        return {
+            "regex_patterns": {name: self._compile_pattern(f"{key}.{name}", pattern)
+                               for name, pattern in patterns.items()},
+            "permission_map": permission_map,
+            "permission_masks": permission_masks(permission_map),
+        }
+
+
+def compile_server_config(name, raw) -> ServerConfig:
+    """Compiles a single servers.json entry, returning it unchanged if it has already been compiled."""
+    if isinstance(raw, ServerConfig):
+        return raw
+    return ServerConfig(name, raw)
+
+
+def load_server_config(path) -> dict[str, ServerConfig]:
+    """
+    Loads and compiles servers.json. Broken templates or regular expressions raise a ValueError here
+    instead of on the first command that uses them.
+    """
+    with open(path) as f:
+        raw_config = json.load(f)
+    return {name: compile_server_config(name, raw) for name, raw in raw_config.items()}
+
+
+# How often (seconds) a ConfigFile looks at the modification time of its file
+CHECK_INTERVAL = 2.0
+
+_config_files = []
+
+
+class ConfigFile(Mapping):
+    """
+    A JSON configuration file that is reloaded when it changes on disk, read through the Mapping interface.
+
+    At most every ``check_interval`` seconds an access compares the file's modification time and size with the
+    loaded version and, if they differ, runs ``loader(path)`` and swaps in the result. Only the thread that
+    notices the change reloads, every other thread keeps reading the previous version meanwhile, and callers that
+    hold on to an entry (e.g. a ServerConfig for the duration of a command) are never affected by a reload. A file
+    that fails to load is logged and the previous version stays active.
+
+    ``on_reload(old, new)`` callbacks run after every successful reload.
+    """
+
+    def __init__(self, path, loader, check_interval=CHECK_INTERVAL):
+        self.path = path
+        self.loader = loader
+        self.check_interval = check_interval
+        self.version = 0
+        self.loaded_at = None
+        self.load_time = None
+        self.error = None
+        self._callbacks = []
+        self._reload_lock = Lock()
+        self._signature = None
+        self._checked = 0.0
+        self._value = {}
+        self._load(self._stat())
+        _config_files.append(self)
+
+    def on_reload(self, callback):
+        self._callbacks.append(callback)
+        return callback
+
+    def _stat(self):
+        stat = os.stat(self.path)
+        return stat.st_mtime_ns, stat.st_size
+
+    def _load(self, signature):
+        started = time.perf_counter()
+        value = self.loader(self.path)
+        old, self._value = self._value, value
+        self._signature = signature
+        self.version += 1
+        self.loaded_at = time.time()
+        self.load_time = round(time.perf_counter() - started, 4)
+        self.error = None
+        return old
+
+    def check(self, force=False) -> bool:
+        """Reloads the file if it changed, returns True if a new version was loaded."""
+        now = time.monotonic()
+        if not force and now - self._checked < self.check_interval:
+            return False
+        if not self._reload_lock.acquire(blocking=False):
+            # Another thread is reloading, keep serving the current version
+            return False
+        try:
+            self._checked = now
+            signature = self._stat()
+            if signature == self._signature and not force:
+                return False
+            old = self._load(signature)
+        except (OSError, ValueError) as e:
+            if self.error != str(e):
+                logging.error(f"Could not reload {self.path}, keeping version {self.version}: {e}")
+            self.error = str(e)
+            return False
+        finally:
+            self._reload_lock.release()
+
+        logging.info(f"Reloaded {self.path} (version {self.version}, {self.load_time}s)")
+        for callback in self._callbacks:
+            try:
+                callback(old, self._value)
+            except Exception as e:
+                logging.error(f"Reload callback for {self.path} failed: {e}")
+        return True
+
+    @property
+    def current(self) -> dict:
+        """The loaded configuration, reloaded first if the file changed."""
+        self.check()
+        return self._value
+
+    def __getitem__(self, key):
+        return self.current[key]
+
+    def __iter__(self):
+        return iter(self.current)
+
+    def __len__(self):
+        return len(self.current)
+
+    # Work on a single version, so a reload in the middle of a loop cannot mix two of them
+    def keys(self):
+        return self.current.keys()
+
+    def items(self):
+        return self.current.items()
+
+    def values(self):
+        return self.current.values()
+
+    def get(self, key, default=None):
+        return self.current.get(key, default)
+
+    def __contains__(self, key):
+        return key in self.current
+
+    def stats(self) -> dict:
+        return {
+            "path": self.path,
+            "version": self.version,
+            "loaded_at": self.loaded_at,
+            "load_time": self.load_time,
+            "entries": len(self._value),
+            "error": self.error,
+        }
+
+
+def load_json(path) -> dict:
+    with open(path) as f:
+        return json.load(f)
+
+
+def config_stats() -> list[dict]:
+    """Returns the version and load time of every ConfigFile in this process."""
+    return [config_file.stats() for config_file in _config_files]
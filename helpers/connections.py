@@ -0,0 +1,538 @@
+import atexit
+import logging
+import os
+import signal
+import subprocess
+import time
+from collections import deque
+from threading import BoundedSemaphore, Lock, Thread, Timer
+
+from paramiko.client import SSHClient, AutoAddPolicy
+from paramiko.ssh_exception import SSHException
+from requests import Session
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from helpers.cache import TTLCache
+from helpers.metrics import SSH_CONNECT_SECONDS, timed
+
+# Defaults for the optional ssh_* pool settings in servers.json
+SSH_DEFAULTS = {
+    "ssh_port": 22,
+    "ssh_max_channels": 8,
+    "ssh_channels_per_connection": 8,
+    "ssh_idle_timeout": 300,
+    "ssh_keepalive": 30,
+    "ssh_timeout": 30,
+}
+
+# Size of the chunks streamed commands yield, see stream_command
+STREAM_CHUNK_SIZE = 65536
+# How much of the stderr of a streamed command is kept for the error message
+STDERR_TAIL = 65536
+
+# Defaults for the optional local_* settings in servers.json
+LOCAL_DEFAULTS = {
+    "local_max_processes": 8,
+    "local_timeout": 300,
+    "local_shell": "/bin/sh",
+}
+
+# Defaults for the optional web_* session settings in servers.json
+WEB_DEFAULTS = {
+    "web_pool_size": 8,
+    "web_timeout": 30,
+    "web_retries": 3,
+    "web_backoff": 0.5,
+    "web_cache_size": 1024,
+}
+
+
+def entry_name(server_config) -> str:
+    """The servers.json key of a server, titles need not be unique. A raw (uncompiled) entry only has its title."""
+    return getattr(server_config, 'name', None) or server_config.get('title', '')
+
+
+class _PooledTransport:
+    """An authenticated SSH client kept open by the pool."""
+
+    def __init__(self, client: SSHClient):
+        self.client = client
+        self.active = 0
+        self.created = time.monotonic()
+        self.last_used = self.created
+
+    @property
+    def transport(self):
+        return self.client.get_transport()
+
+    def is_alive(self) -> bool:
+        transport = self.transport
+        return transport is not None and transport.is_active()
+
+    def close(self):
+        try:
+            self.client.close()
+        except Exception as e:
+            logging.debug(f"Error closing SSH connection: {e}")
+
+
+class SSHConnectionPool:
+    """
+    Keeps authenticated SSH transports to a single server alive and hands out channels on them.
+
+    At most ``max_channels`` commands run against the server at the same time; each transport carries up to
+    ``channels_per_connection`` concurrent channels (sshd's MaxSessions) before another transport is opened.
+    Transports that are broken, or idle for longer than ``idle_timeout`` seconds, are evicted.
+    """
+
+    def __init__(self, host, username, password, port=22, max_channels=8, channels_per_connection=8,
+                 idle_timeout=300, keepalive=30, timeout=30):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.max_channels = max_channels
+        self.channels_per_connection = channels_per_connection
+        self.idle_timeout = idle_timeout
+        self.keepalive = keepalive
+        self.timeout = timeout
+
+        self._lock = Lock()
+        self._slots = BoundedSemaphore(max_channels)
+        self._transports: list[_PooledTransport] = []
+        # Connections being opened outside the lock
+        self._connecting = 0
+        self._stats = {"connects": 0, "reuses": 0, "evictions": 0, "failures": 0, "commands": 0}
+
+    def _connect(self) -> _PooledTransport:
+        client = SSHClient()
+        client.set_missing_host_key_policy(AutoAddPolicy())
+        with timed(SSH_CONNECT_SECONDS, server=self.host):
+            client.connect(self.host,
+                           port=self.port,
+                           username=self.username,
+                           password=self.password,
+                           timeout=self.timeout,
+                           banner_timeout=self.timeout,
+                           auth_timeout=self.timeout)
+        client.get_transport().set_keepalive(self.keepalive)
+        logging.debug(f"SSH pool: opened connection to {self.host}")
+        return _PooledTransport(client)
+
+    def _evict(self, pooled: _PooledTransport):
+        if pooled in self._transports:
+            self._transports.remove(pooled)
+            self._stats["evictions"] += 1
+        pooled.close()
+
+    def prune(self):
+        """Closes broken transports and transports that have been idle for longer than idle_timeout."""
+        now = time.monotonic()
+        with self._lock:
+            for pooled in list(self._transports):
+                if not pooled.is_alive():
+                    self._evict(pooled)
+                elif pooled.active == 0 and now - pooled.last_used > self.idle_timeout:
+                    self._evict(pooled)
+
+    def _checkout(self) -> _PooledTransport:
+        self.prune()
+        with self._lock:
+            for pooled in self._transports:
+                if pooled.active < self.channels_per_connection:
+                    pooled.active += 1
+                    self._stats["reuses"] += 1
+                    return pooled
+            self._connecting += 1
+        # Connecting can take up to the timeout, other threads keep using and returning their channels meanwhile
+        try:
+            pooled = self._connect()
+        except BaseException:
+            with self._lock:
+                self._connecting -= 1
+            raise
+        with self._lock:
+            self._connecting -= 1
+            self._stats["connects"] += 1
+            pooled.active += 1
+            self._transports.append(pooled)
+        return pooled
+
+    def _checkin(self, pooled: _PooledTransport, broken=False):
+        with self._lock:
+            pooled.active -= 1
+            pooled.last_used = time.monotonic()
+            if broken:
+                self._stats["failures"] += 1
+                # A failed channel does not take the transport down with it, other channels may still be using it
+                if not pooled.is_alive():
+                    self._evict(pooled)
+            else:
+                self._stats["commands"] += 1
+
+    def _open_channel(self):
+        """Opens a session channel, replacing the transport once if it turns out to be dead."""
+        for attempt in range(2):
+            pooled = self._checkout()
+            try:
+                return pooled, pooled.transport.open_session(timeout=self.timeout)
+            except (SSHException, EOFError, OSError, AttributeError):
+                self._checkin(pooled, broken=True)
+                if attempt:
+                    raise
+                logging.debug(f"SSH pool: stale connection to {self.host}, reconnecting")
+
+    def exec_command(self, command) -> tuple[int, bytes, bytes]:
+        """
+        Runs a command on a pooled channel and returns (exit_status, stdout, stderr).
+        """
+        with self._slots:
+            pooled, channel = self._open_channel()
+            broken = False
+            try:
+                channel.settimeout(None)
+                channel.exec_command(command)
+                # Drain stdout before asking for the exit status, a full window would otherwise block the remote
+                stdout = channel.makefile('rb').read()
+                stderr = channel.makefile_stderr('rb').read()
+                exit_status = channel.recv_exit_status()
+            except (SSHException, EOFError, OSError):
+                broken = True
+                raise
+            finally:
+                channel.close()
+                self._checkin(pooled, broken=broken)
+        return exit_status, stdout, stderr
+
+    def stream_command(self, command, chunk_size=STREAM_CHUNK_SIZE):
+        """
+        Runs a command on a pooled channel and yields its stdout in chunks as they arrive, so a large listing
+        is never held in memory at once. Raises OSError after the last chunk if the command failed.
+
+        The channel (and its slot) is held until the generator is exhausted or closed.
+        """
+        with self._slots:
+            pooled, channel = self._open_channel()
+            broken = False
+            try:
+                channel.settimeout(None)
+                channel.exec_command(command)
+                while data := channel.recv(chunk_size):
+                    yield data
+                stderr = channel.makefile_stderr('rb').read()
+                exit_status = channel.recv_exit_status()
+            except (SSHException, EOFError, OSError):
+                broken = True
+                raise
+            finally:
+                channel.close()
+                self._checkin(pooled, broken=broken)
+        if exit_status != 0:
+            raise OSError(f"{command} failed with exit status {exit_status}: {stderr.decode('utf-8', 'replace')}")
+
+    def close(self):
+        with self._lock:
+            for pooled in list(self._transports):
+                self._evict(pooled)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "host": self.host,
+                "connections": len(self._transports),
+                "connecting": self._connecting,
+                "active_channels": sum(p.active for p in self._transports),
+                "max_channels": self.max_channels,
+                **self._stats,
+            }
+
+
+_ssh_pools: dict[tuple, SSHConnectionPool] = {}
+_ssh_pools_lock = Lock()
+
+
+def get_ssh_pool(server_config) -> SSHConnectionPool:
+    """Returns the shared SSH pool for a servers.json entry, creating it on first use."""
+    settings = {key: server_config.get(key, default) for key, default in SSH_DEFAULTS.items()}
+    key = (server_config['ssh_host'], settings['ssh_port'], server_config['ssh_username'])
+    with _ssh_pools_lock:
+        pool = _ssh_pools.get(key)
+        if pool is None:
+            pool = SSHConnectionPool(server_config['ssh_host'],
+                                     server_config['ssh_username'],
+                                     server_config['ssh_password'],
+                                     port=settings['ssh_port'],
+                                     max_channels=settings['ssh_max_channels'],
+                                     channels_per_connection=settings['ssh_channels_per_connection'],
+                                     idle_timeout=settings['ssh_idle_timeout'],
+                                     keepalive=settings['ssh_keepalive'],
+                                     timeout=settings['ssh_timeout'])
+            _ssh_pools[key] = pool
+    return pool
+
+
+def ssh_pool_stats() -> list[dict]:
+    """Returns the statistics of every SSH pool in this process."""
+    with _ssh_pools_lock:
+        pools = list(_ssh_pools.values())
+    return [pool.stats() for pool in pools]
+
+
+@atexit.register
+def close_ssh_pools():
+    with _ssh_pools_lock:
+        pools = list(_ssh_pools.values())
+        _ssh_pools.clear()
+    for pool in pools:
+        pool.close()
+
+
+class WebSessionPool:
+    """
+    A keep-alive requests.Session for the WEB# commands of one server.
+
+    Up to ``pool_size`` connections per host are kept open, so only the first request pays for the TCP and TLS
+    handshakes. Idempotent requests (GET, PUT) are retried ``retries`` times with exponential ``backoff`` on
+    connection errors and 502/503/504 responses, POST is never retried. GET responses with an ETag or
+    Last-Modified header are remembered, and the next GET of the same URL is made conditional, a 304 answer
+    returns the remembered body.
+    """
+
+    def __init__(self, pool_size=8, timeout=30, retries=3, backoff=0.5, cache_size=1024):
+        self.timeout = timeout
+        self.session = Session()
+        retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=(502, 503, 504),
+                      allowed_methods=frozenset({"GET", "PUT"}), raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        # Validators stay useful for as long as the server accepts them, so entries only leave on eviction
+        self._responses = TTLCache(cache_size, ttl=float('inf'))
+        self._lock = Lock()
+        self._stats = {"requests": 0, "conditional": 0, "not_modified": 0, "errors": 0}
+
+    def _count(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+    def request(self, method, url, headers=None, auth=None, json=None) -> str:
+        """Sends the request and returns the body, raises requests.HTTPError for 4xx/5xx answers."""
+        headers = dict(headers or {})
+        cached = self._responses.get(url) if method == "GET" else None
+        if cached is not None:
+            etag, last_modified, _ = cached
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+            self._count("conditional")
+
+        self._count("requests")
+        try:
+            response = self.session.request(method, url, headers=headers, auth=auth, json=json,
+                                            timeout=self.timeout)
+            if response.status_code == 304 and cached is not None:
+                self._count("not_modified")
+                return cached[2]
+            response.raise_for_status()
+        except Exception:
+            self._count("errors")
+            raise
+
+        if method == "GET":
+            etag, last_modified = response.headers.get("ETag"), response.headers.get("Last-Modified")
+            if etag or last_modified:
+                self._responses.set(url, (etag, last_modified, response.text))
+            elif cached is not None:
+                self._responses.invalidate(url)
+        return response.text
+
+    def stream(self, method, url, headers=None, auth=None, json=None, chunk_size=STREAM_CHUNK_SIZE):
+        """
+        Sends the request and yields the body in chunks as they arrive. Streamed responses are not remembered
+        for conditional GETs. Raises requests.HTTPError for 4xx/5xx answers.
+        """
+        self._count("requests")
+        try:
+            response = self.session.request(method, url, headers=headers, auth=auth, json=json,
+                                            timeout=self.timeout, stream=True)
+            response.raise_for_status()
+        except Exception:
+            self._count("errors")
+            raise
+        with response:
+            yield from response.iter_content(chunk_size)
+
+    def close(self):
+        self.session.close()
+        self._responses.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"cached_responses": len(self._responses), **self._stats}
+
+
+_web_pools: dict[str, WebSessionPool] = {}
+_web_pools_lock = Lock()
+
+
+def get_web_pool(server_config) -> WebSessionPool:
+    """
+    Returns the shared HTTP session of a servers.json entry, creating it on first use. Sessions are kept per entry
+    (see entry_name), so entries pointing at the same web_host each get the web_* settings they configure.
+    """
+    settings = {key: server_config.get(key, default) for key, default in WEB_DEFAULTS.items()}
+    key = entry_name(server_config)
+    with _web_pools_lock:
+        pool = _web_pools.get(key)
+        if pool is None:
+            pool = WebSessionPool(pool_size=settings['web_pool_size'],
+                                  timeout=settings['web_timeout'],
+                                  retries=settings['web_retries'],
+                                  backoff=settings['web_backoff'],
+                                  cache_size=settings['web_cache_size'])
+            _web_pools[key] = pool
+    return pool
+
+
+def web_pool_stats() -> dict[str, dict]:
+    """Returns the statistics of every HTTP session in this process."""
+    with _web_pools_lock:
+        pools = dict(_web_pools)
+    return {key: pool.stats() for key, pool in pools.items()}
+
+
+@atexit.register
+def close_web_pools():
+    with _web_pools_lock:
+        pools = list(_web_pools.values())
+        _web_pools.clear()
+    for pool in pools:
+        pool.close()
+
+
+def _kill_group(process):
+    """Kills a command started by LocalRunner and everything it started, if it is still running."""
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+class LocalRunner:
+    """
+    Runs LOCAL# commands in a shell on this host, for deployments that sit on a cluster node or next to the
+    mounted filesystem and would otherwise SSH to themselves.
+
+    At most ``max_processes`` commands run at the same time. stdout and stderr are drained while the command
+    runs, so a large listing cannot block it on a full pipe. A command running longer than ``timeout`` seconds
+    is killed together with everything it started.
+    """
+
+    def __init__(self, max_processes=8, timeout=300, shell="/bin/sh"):
+        self.max_processes = max_processes
+        self.timeout = timeout
+        self.shell = shell
+        self._slots = BoundedSemaphore(max_processes)
+        self._lock = Lock()
+        self._active = 0
+        self._stats = {"commands": 0, "failures": 0, "timeouts": 0}
+
+    def _count(self, key, active=0):
+        with self._lock:
+            self._active += active
+            if key:
+                self._stats[key] += 1
+
+    def exec_command(self, command) -> tuple[int, bytes, bytes]:
+        """
+        Runs a command and returns (exit_status, stdout, stderr), raises TimeoutError if it took too long.
+        """
+        with self._slots:
+            self._count(None, active=1)
+            try:
+                # A session of its own, so a timeout kills the whole pipeline and not just the shell
+                process = subprocess.Popen([self.shell, "-c", command], stdin=subprocess.DEVNULL,
+                                           stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True)
+                try:
+                    stdout, stderr = process.communicate(timeout=self.timeout)
+                except subprocess.TimeoutExpired:
+                    _kill_group(process)
+                    process.communicate()
+                    self._count("timeouts")
+                    raise TimeoutError(f"{command} did not finish within {self.timeout} seconds")
+            finally:
+                self._count(None, active=-1)
+        self._count("commands" if process.returncode == 0 else "failures")
+        return process.returncode, stdout, stderr
+
+    def stream_command(self, command, chunk_size=STREAM_CHUNK_SIZE):
+        """
+        Runs a command and yields its stdout in chunks as they arrive. Raises OSError after the last chunk if
+        the command failed, and TimeoutError if it was killed after ``timeout`` seconds.
+        """
+        with self._slots:
+            self._count(None, active=1)
+            try:
+                process = subprocess.Popen([self.shell, "-c", command], stdin=subprocess.DEVNULL,
+                                           stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True)
+                # stderr is drained on a thread so a chatty command cannot block on it, only its tail is kept
+                stderr = deque(maxlen=STDERR_TAIL // 1024)
+                reader = Thread(target=lambda: stderr.extend(iter(lambda: process.stderr.read(1024), b'')),
+                                daemon=True)
+                reader.start()
+                timed_out = []
+                killer = Timer(self.timeout, lambda: (timed_out.append(True), _kill_group(process)))
+                killer.start()
+                try:
+                    while data := process.stdout.read1(chunk_size):
+                        yield data
+                    process.wait()
+                finally:
+                    killer.cancel()
+                    if process.poll() is None:
+                        # The consumer stopped early
+                        _kill_group(process)
+                        process.wait()
+                    process.stdout.close()
+                    reader.join()
+                    process.stderr.close()
+            finally:
+                self._count(None, active=-1)
+        if timed_out:
+            self._count("timeouts")
+            raise TimeoutError(f"{command} did not finish within {self.timeout} seconds")
+        self._count("commands" if process.returncode == 0 else "failures")
+        if process.returncode != 0:
+            raise OSError(f"{command} failed with exit status {process.returncode}: "
+                          f"{b''.join(stderr).decode('utf-8', 'replace')}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"active": self._active, "max_processes": self.max_processes, **self._stats}
+
+
+_local_runners: dict[str, LocalRunner] = {}
+_local_runners_lock = Lock()
+
+
+def get_local_runner(server_config) -> LocalRunner:
+    """Returns the LOCAL# runner of a servers.json entry, creating it on first use."""
+    settings = {key: server_config.get(key, default) for key, default in LOCAL_DEFAULTS.items()}
+    key = entry_name(server_config)
+    with _local_runners_lock:
+        runner = _local_runners.get(key)
+        if runner is None:
+            runner = LocalRunner(max_processes=settings['local_max_processes'],
+                                 timeout=settings['local_timeout'],
+                                 shell=settings['local_shell'])
+            _local_runners[key] = runner
+    return runner
+
+
+def local_runner_stats() -> dict[str, dict]:
+    """Returns the statistics of every LOCAL# runner in this process."""
+    with _local_runners_lock:
+        runners = dict(_local_runners)
+    return {key: runner.stats() for key, runner in runners.items()}
@@ -1,9 +1,202 @@
-from json import load
-from ldap3 import Server, Connection, ALL
+import logging
+from contextlib import contextmanager
+from copy import copy
+from functools import wraps
+from threading import Condition, Lock
 
-with open('configs/ad.json') as f:
-    adConfig = load(f)
+from ldap3 import Server, Connection, ALL, BASE, NO_ATTRIBUTES
+from ldap3.core.exceptions import LDAPException
+from ldap3.utils.conv import escape_filter_chars
 
+from helpers.cache import TTLCache
+from helpers.config import ConfigFile, load_json
+from helpers.metrics import LDAP_SECONDS, timed
+
+# Reloaded when ad.json changes, see reset_domains
+adConfig = ConfigFile('configs/ad.json', load_json)
+
+# Defaults for the optional per-domain pool and cache settings in ad.json
+POOL_SIZE = 4
+CACHE_SIZE = 4096
+CACHE_TTL = 300
+MEMBER_BATCH_SIZE = 200
+PAGE_SIZE = 500
+
+# LDAP_MATCHING_RULE_IN_CHAIN, walks nested group membership on the domain controller
+IN_CHAIN = "1.2.840.113556.1.4.1941"
+
+
+class LDAPConnectionPool:
+    """
+    Hands out bound connections to one domain, binding at most ``size`` of them. The Server object is shared,
+    so the schema and DSA info are only read on the first bind. Connections that fail are dropped and rebound.
+    """
+
+    def __init__(self, domain_config, size=POOL_SIZE):
+        self.domain_config = domain_config
+        self.size = size
+        self.server = Server(domain_config["server"], get_info=ALL)
+        self._idle: list[Connection] = []
+        self._created = 0
+        self._condition = Condition(Lock())
+        self._closed = False
+        self._stats = {"binds": 0, "reuses": 0, "rebinds": 0}
+
+    def _bind(self) -> Connection:
+        conn = Connection(self.server, self.domain_config["user"], self.domain_config["password"],
+                          auto_bind=True, auto_range=True)
+        self._stats["binds"] += 1
+        return conn
+
+    def _acquire(self) -> Connection:
+        with self._condition:
+            while not self._idle and self._created >= self.size:
+                self._condition.wait()
+            if self._idle:
+                self._stats["reuses"] += 1
+                return self._idle.pop()
+            self._created += 1
+        try:
+            return self._bind()
+        except Exception:
+            self._discard(None)
+            raise
+
+    def _release(self, conn: Connection):
+        if self._closed:
+            self._discard(conn)
+            return
+        with self._condition:
+            self._idle.append(conn)
+            self._condition.notify()
+
+    def _discard(self, conn):
+        if conn is not None:
+            try:
+                conn.unbind()
+            except Exception as e:
+                logging.debug(f"Error unbinding LDAP connection: {e}")
+        with self._condition:
+            self._created -= 1
+            self._condition.notify()
+
+    @contextmanager
+    def connection(self):
+        conn = self._acquire()
+        try:
+            yield conn
+        except LDAPException:
+            self._discard(conn)
+            raise
+        except Exception:
+            self._release(conn)
+            raise
+        else:
+            self._release(conn)
+
+    def run(self, operation):
+        """Runs operation(conn) on a pooled connection, rebinding and retrying once if the connection broke."""
+        try:
+            with self.connection() as conn:
+                return operation(conn)
+        except LDAPException as e:
+            logging.debug(f"LDAP connection to {self.domain_config['server']} failed, rebinding: {e}")
+            self._stats["rebinds"] += 1
+            with self.connection() as conn:
+                return operation(conn)
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            self._discard(conn)
+
+    def stats(self) -> dict:
+        with self._condition:
+            return {
+                "server": self.domain_config["server"],
+                "connections": self._created,
+                "idle": len(self._idle),
+                "size": self.size,
+                **self._stats,
+            }
+
+
+_pools: dict[str, LDAPConnectionPool] = {}
+_caches: dict[str, TTLCache] = {}
+_pools_lock = Lock()
+
+
+def get_pool(domain) -> LDAPConnectionPool:
+    # Read the entry outside the lock, a changed ad.json resets the pools through reset_domains
+    domain_config = adConfig[domain]
+    with _pools_lock:
+        if domain not in _pools:
+            _pools[domain] = LDAPConnectionPool(domain_config, domain_config.get("pool_size", POOL_SIZE))
+        return _pools[domain]
+
+
+def get_cache(domain) -> TTLCache:
+    domain_config = adConfig[domain]
+    with _pools_lock:
+        if domain not in _caches:
+            _caches[domain] = TTLCache(domain_config.get("cache_size", CACHE_SIZE),
+                                       domain_config.get("cache_ttl", CACHE_TTL))
+        return _caches[domain]
+
+
+@adConfig.on_reload
+def reset_domains(old, new):
+    """Closes the pools and drops the caches of domains whose ad.json entry changed or was removed."""
+    changed = [domain for domain in old if old[domain] != new.get(domain)]
+    with _pools_lock:
+        pools = [_pools.pop(domain) for domain in changed if domain in _pools]
+        for domain in changed:
+            _caches.pop(domain, None)
+    # Connections that are checked out are unbound when they are returned to the closed pool
+    for pool in pools:
+        pool.close()
+
+
+def invalidate_cache(query=None) -> int:
+    """
+    Drops cached user lookups and group expansions. Without a query the whole cache is cleared, otherwise only
+    the entries for that user or group (in any domain notation) are removed. Returns the number of entries dropped.
+    """
+    with _pools_lock:
+        caches = dict(_caches)
+    if query is None:
+        dropped = sum(len(cache) for cache in caches.values())
+        for cache in caches.values():
+            cache.clear()
+        return dropped
+    query, domain = split_domain(query)
+    if domain not in caches:
+        return 0
+    return caches[domain].invalidate_where(lambda key: key[1] == query)
+
+
+def ldap_stats() -> dict:
+    """Returns the connection pool and cache statistics per domain."""
+    with _pools_lock:
+        pools, caches = dict(_pools), dict(_caches)
+    return {
+        "pools": {domain: pool.stats() for domain, pool in pools.items()},
+        "caches": {domain: cache.stats() for domain, cache in caches.items()},
+    }
+
+
+def timed_lookup(function):
+    """Observes the duration of a lookup, cache hits included, labelled with the domain of the query."""
+    @wraps(function)
+    def wrapper(query, *args, **kwargs):
+        with timed(LDAP_SECONDS, domain=split_domain(query)[1], operation=function.__name__):
+            return function(query, *args, **kwargs)
+    return wrapper
+
+
+@timed_lookup
 def lookup_user(query, search_by=None, exact=False) -> list[dict]:
     if not search_by:
         search_by = ["samAccountName", "mail", "givenName", "sn", "cn"]
@@ -17,27 +210,37 @@ def lookup_user(query, search_by=None, exact=False) -> list[dict]:
     if query == "everyone":
         return [{"samAccountName": "Domain Users"}]
 
-    """Search for a user in Active Directory by samAccountName, email, or name."""
-    server = Server(adConfig[domain]["server"], get_info=ALL)
-    conn = Connection(server, adConfig[domain]["user"], adConfig[domain]["password"], auto_bind=True)
+    # Only exact lookups are cached, prefix searches come from the type-ahead and vary with every keystroke
+    cache_key = ("user", query, tuple(search_by))
+    if exact:
+        cached = get_cache(domain).get(cache_key)
+        if cached is not None:
+            return [copy(result) for result in cached]
 
+    """Search for a user in Active Directory by samAccountName, email, or name."""
     # Construct the search filter based on the search_by fields
     search_filter = f"(&(objectClass=user)(|"
     for field in search_by:
         search_filter += f"({field}={query}{'' if exact else '*'})"
     search_filter += "))"
 
-    conn.search(adConfig[domain]["search_base"], search_filter, attributes=['samAccountName', 'mail', 'givenName', 'sn'])
-
-    results = []
-    for entry in conn.entries:
-        results.append({
-            'samAccountName': entry.samAccountName.value,
-            'email': entry.mail.value,
-            'first_name': entry.givenName.value,
-            'last_name': entry.sn.value
-        })
-    conn.unbind()
+    def search(conn):
+        conn.search(adConfig[domain]["search_base"], search_filter,
+                    attributes=['samAccountName', 'mail', 'givenName', 'sn'])
+
+        results = []
+        for entry in conn.entries:
+            results.append({
+                'samAccountName': entry.samAccountName.value,
+                'email': entry.mail.value,
+                'first_name': entry.givenName.value,
+                'last_name': entry.sn.value
+            })
+        return results
+
+    results = get_pool(domain).run(search)
+    if exact:
+        get_cache(domain).set(cache_key, [copy(result) for result in results])
     return results
 
 def split_domain(query: str) -> (str, str):
@@ -58,8 +261,17 @@ def split_domain(query: str) -> (str, str):
 
     return query.lower(), domain.lower()
 
+@timed_lookup
 def lookup_group_members(query, account_attribute) -> set[str]:
-    """Search for group members in Active Directory by group name and return their samAccountName."""
+    """
+    Search for group members in Active Directory by group name and return their samAccountName.
+
+    Members are resolved in bulk: the member DNs (range retrieval past AD's 1,500 value limit is handled by the
+    connection's auto_range) below search_base, or else below the domain root (e.g. foreign security principals),
+    are looked up with paged OR-filter searches of member_batch_size DNs each. Members outside the domain root
+    are read one by one, like before. With nested_groups set in ad.json, all transitive members are fetched in
+    one paged LDAP_MATCHING_RULE_IN_CHAIN query from the domain root instead.
+    """
     query, domain = split_domain(query)
 
     # Root/Wheel is a special case, do not return it
@@ -69,20 +281,63 @@ def lookup_group_members(query, account_attribute) -> set[str]:
     if query == "everyone":
         return {"Domain Users"}
 
-    server = Server(adConfig[domain]["server"], get_info=ALL)
-    conn = Connection(server, adConfig[domain]["user"], adConfig[domain]["password"], auto_bind=True)
+    cache_key = ("group", query, account_attribute)
+    cached = get_cache(domain).get(cache_key)
+    if cached is not None:
+        return set(cached)
 
-    # Search filter to match group name
-    search_filter = f"(&(objectClass=group)(cn={query}))"
-    conn.search(adConfig[domain]["search_base"], search_filter, attributes=['member'])
+    search_base = adConfig[domain]["search_base"]
+    domain_root = ",".join(part for part in search_base.split(",") if part.strip().lower().startswith("dc="))
+    nested = adConfig[domain].get("nested_groups", False)
+    batch_size = adConfig[domain].get("member_batch_size", MEMBER_BATCH_SIZE)
 
-    results = set()
-    for entry in conn.entries:
-        for member_dn in entry.member:
-            # Query each member's DN to get their desired attribute
-            conn.search(member_dn, '(objectClass=*)', attributes=[account_attribute])
-            if conn.entries:
-                results.add(conn.entries[0][account_attribute].value)
+    def below(dn, base) -> bool:
+        return bool(base) and (dn.lower() == base.lower() or dn.lower().endswith(f",{base.lower()}"))
 
-    conn.unbind()
-    return results
\ No newline at end of file
+    def add_values(values, value):
+        # Multi-valued attributes keep all of their values
+        values.update(value if isinstance(value, list) else [value])
+
+    def paged_values(conn, base, search_filter):
+        values = set()
+        for entry in conn.extend.standard.paged_search(base, search_filter, attributes=[account_attribute],
+                                                       paged_size=PAGE_SIZE, generator=True):
+            if entry.get('type') == 'searchResEntry':
+                add_values(values, entry['attributes'].get(account_attribute))
+        return values
+
+    def search(conn):
+        # Search filter to match group name, the members are only needed when they are not resolved in chain
+        search_filter = f"(&(objectClass=group)(cn={query}))"
+        conn.search(search_base, search_filter, attributes=NO_ATTRIBUTES if nested else ['member'])
+        groups = [(entry.entry_dn, [] if nested else list(entry.member.values)) for entry in conn.entries]
+
+        results = set()
+        for group_dn, member_dns in groups:
+            if nested:
+                results |= paged_values(conn, domain_root or search_base,
+                                        f"(memberOf:{IN_CHAIN}:={escape_filter_chars(group_dn)})")
+                continue
+            by_base = {}
+            for dn in member_dns:
+                base = search_base if below(dn, search_base) else domain_root if below(dn, domain_root) else None
+                by_base.setdefault(base, []).append(dn)
+            for base, dns in by_base.items():
+                if base is None:
+                    # Another domain or partition, query each member's DN to get their desired attribute
+                    for dn in dns:
+                        conn.search(dn, '(objectClass=*)', search_scope=BASE, attributes=[account_attribute])
+                        for entry in conn.response or []:
+                            if entry.get('type') == 'searchResEntry':
+                                add_values(results, entry['attributes'].get(account_attribute))
+                    continue
+                for start in range(0, len(dns), batch_size):
+                    dn_filter = "".join(f"(distinguishedName={escape_filter_chars(dn)})"
+                                        for dn in dns[start:start + batch_size])
+                    results |= paged_values(conn, base, f"(|{dn_filter})")
+        return results
+
+    results = get_pool(domain).run(search)
+    results.discard(None)
+    get_cache(domain).set(cache_key, frozenset(results))
+    return results
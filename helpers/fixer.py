@@ -0,0 +1,112 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from threading import BoundedSemaphore, Lock
+
+from helpers.commands import exec_command, stream_command
+
+# Defaults for the optional fix_* settings in servers.json
+FIX_CHUNK_SIZE = 500
+FIX_WORKERS = 4
+
+
+def desired_acl(server_config, shares) -> list[dict]:
+    """
+    Builds the ACL a folder should have from its Share rows. POSIX rows (index -1) are not propagated.
+
+    Returns:
+        list: One dict per ACE, in index order, with index, users, permission and mapped_permission.
+    """
+    acls = []
+    for share in sorted(shares, key=lambda share: share.index):
+        if share.index < 0:
+            continue
+        # mapped_permission is keyed on the letters, e.g. "rwx"
+        permission = str(share.permission)
+        if permission not in server_config.get('mapped_permission', {}):
+            raise ValueError(f"No mapped_permission for '{permission}' on {share.folder_name}")
+        acls.append({
+            "index": share.index,
+            "users": share.users.split(','),
+            "permission": permission,
+            "mapped_permission": server_config['mapped_permission'][permission],
+        })
+    return acls
+
+
+def fix_permissions(server_config, folder_name, acls, progress=None) -> dict:
+    """
+    Propagates an ACL through every entry below folder_name.
+
+    The entries are listed with the server's fix_list_command (one path per line) and, while the listing streams
+    in, cut into chunks of fix_chunk_size paths. fix_acl_command runs once per chunk on fix_workers threads, at
+    most twice as many chunks as workers wait for a thread, which in turn holds the listing back. fix_acl_command
+    gets folder_name, paths (the chunk) and acls (see desired_acl). ``progress`` is called with
+    (processed, total, elapsed_seconds) whenever a chunk finishes, total is the number of entries listed so far.
+
+    Returns:
+        dict: total, processed, chunks, elapsed and rate (entries per second).
+    """
+    chunk_size = server_config.get('fix_chunk_size', FIX_CHUNK_SIZE)
+    workers = server_config.get('fix_workers', FIX_WORKERS)
+    pending = BoundedSemaphore(workers * 2)
+
+    def fix_chunk(chunk):
+        try:
+            exec_command(server_config, "fix_acl", {"folder_name": folder_name, "paths": chunk, "acls": acls})
+            return len(chunk)
+        finally:
+            pending.release()
+
+    def chunks():
+        chunk = [folder_name]
+        for path in stream_command(server_config, "fix_list", {"folder_name": folder_name}):
+            if not path.strip() or path.rstrip('/') == folder_name.rstrip('/'):
+                continue
+            chunk.append(path)
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    total = 0
+    processed = 0
+    futures = []
+    started = time.monotonic()
+    lock = Lock()
+
+    def done(future):
+        nonlocal processed
+        if future.cancelled() or future.exception():
+            return
+        with lock:
+            processed += future.result()
+            if progress:
+                progress(processed, total, time.monotonic() - started)
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="fix_permissions") as executor:
+        try:
+            for chunk in chunks():
+                pending.acquire()
+                with lock:
+                    total += len(chunk)
+                future = executor.submit(fix_chunk, chunk)
+                future.add_done_callback(done)
+                futures.append(future)
+            logging.info(f"Fixing permissions on {total} entries below {folder_name} in {len(futures)} chunks")
+            for future in as_completed(futures):
+                future.result()
+        except Exception:
+            for future in futures:
+                future.cancel()
+            raise
+
+    elapsed = time.monotonic() - started
+    return {
+        "total": total,
+        "processed": processed,
+        "chunks": len(futures),
+        "elapsed": round(elapsed, 3),
+        "rate": round(processed / elapsed, 2) if elapsed else 0,
+    }
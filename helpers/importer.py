@@ -0,0 +1,195 @@
+import hashlib
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from helpers.commands import exec_command, exec_commands, parse_outputs, stream_command
+from helpers.config import compile_server_config
+from helpers.domain import lookup_user, lookup_group_members
+from helpers.inventory import get_inventory
+
+
+# The command types that describe the state of a folder on the server
+PROBE_COMMANDS = ("acl", "quota", "protocol")
+
+
+def probe_folder(server_config, remote_folder, refresh=False, inventory=None) -> dict:
+    """
+    Runs the acl, quota and protocol commands of a folder concurrently and returns their unparsed outputs.
+    Outputs cached by helpers.commands are used unless refresh is set.
+
+    The protocols and quota are looked up in ``inventory``, or without one in the server's inventory unless
+    refresh is set (see helpers.inventory), instead of asking the server about this folder.
+
+    Returns:
+        dict: {command_type: [output of every command in the command list], or the parsed output (a dict)
+            when it came from the inventory}
+    """
+    if inventory is None and not refresh:
+        inventory = get_inventory(server_config)
+    probe = inventory.probe(remote_folder) if inventory else {}
+    command_types = [command_type for command_type in PROBE_COMMANDS if command_type not in probe]
+    outputs = exec_commands(server_config, [(command_type, {"folder_name": remote_folder})
+                                            for command_type in command_types], raw=True, refresh=refresh)
+    probe.update(zip(command_types, outputs))
+    return probe
+
+
+def fingerprint(probe: dict) -> str:
+    """A digest of the raw probe outputs, equal digests mean the folder did not change on the server."""
+    return hashlib.sha256(json.dumps(probe, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def fetch_acl(server_config, remote_folder, probe=None, refresh=False) -> dict:
+    """
+    Reads the ACL, quota and protocols of a folder from the server and resolves the ACEs to users in the domain.
+    A probe from probe_folder is parsed instead of asking the server again, refresh bypasses cached outputs.
+
+    This does not touch the database, so it is safe to call from worker threads.
+
+    Returns:
+        dict: {"folder_name", "owner", "quota", "protocols", "acls": [{"index", "permission", "users"}]}
+    """
+    if probe is None:
+        probe = probe_folder(server_config, remote_folder, refresh)
+    acl_output, quota_output, protocol_output = (
+        probe[command_type] if isinstance(probe[command_type], dict)
+        else parse_outputs(server_config, command_type, probe[command_type])
+        for command_type in PROBE_COMMANDS)
+    ldap_attribute = server_config["acl_ldap_attribute"]
+
+    owner_str = ""
+    owner = lookup_user(acl_output['owner'], search_by=[ldap_attribute], exact=True)
+    if owner:
+        owner_str = owner[0][ldap_attribute]
+
+    acls = []
+    for acl in acl_output['permissions']:
+        if acl['access'] == "deny":
+            # Skip denied permissions
+            continue
+        elif acl['type'] == 'user':
+            # Add the user to the users
+            user = lookup_user(acl['name'], search_by=[ldap_attribute], exact=True)
+            if not user:
+                continue
+            try:
+                users = {user[0][ldap_attribute]}
+            except KeyError:
+                continue
+        elif acl['type'] == 'group':
+            # Add the group to the users
+            users = lookup_group_members(acl['name'], ldap_attribute)
+        else:
+            # This is an 'everyone' or unknown type, we presume the worst
+            users = {acl_output['everyone']}
+
+        users.discard('')
+        users.discard(None)
+        if not users:
+            # Skip if group is empty
+            continue
+
+        acls.append({"index": acl['index'], "permission": acl['permission'], "users": users})
+
+    return {
+        "folder_name": remote_folder,
+        "owner": owner_str,
+        # Get the keys for each protocol that is not 0
+        "protocols": {key for key, value in protocol_output.items() if value != 0},
+        "quota": quota_output['hard'],
+        "acls": acls,
+    }
+
+
+def list_folders(server_config, root_folder, max_depth=None) -> list[str]:
+    """
+    Lists the folders below root_folder with the server's list_command, sorted so parents come before children.
+
+    The list_command gets folder_name and max_depth (None for unlimited) and should print one path per line,
+    or return JSON with a "folders" list. Printed paths are filtered while they stream in.
+    """
+    arguments = {"folder_name": root_folder, "max_depth": max_depth}
+    server_config = compile_server_config(server_config.get('title', ''), server_config)
+
+    def candidates():
+        if "list" in server_config.mappers:
+            # A mapper needs the whole output
+            output = exec_command(server_config, "list", arguments)
+            yield from output.get("folders", str(output.get("output", "")).splitlines())
+            return
+        lines = stream_command(server_config, "list", arguments)
+        for line in lines:
+            if line.lstrip().startswith("{"):
+                # A JSON answer has to be read whole
+                yield from json.loads("\n".join([line, *lines])).get("folders", [])
+                return
+            yield line
+
+    root_folder = root_folder.rstrip('/')
+    root_depth = root_folder.count('/')
+    folders = set()
+    for folder in candidates():
+        folder = folder.strip().rstrip('/')
+        if folder.startswith(f"{root_folder}/") and (max_depth is None or folder.count('/') - root_depth <= max_depth):
+            folders.add(folder)
+    return sorted(folders, key=lambda folder: (folder.count('/'), folder))
+
+
+def fetch_tree(server_config, folders, workers=8, progress=None, refresh=False):
+    """
+    Fetches the ACLs of many folders with a bounded pool of worker threads.
+
+    Yields (folder, fetched, error) tuples in the order of ``folders``, so a caller that got the folders from
+    list_folders receives every parent before its children while later folders are still being fetched.
+    ``progress`` is called with (done, total, elapsed_seconds) after every folder. The server's inventory is
+    listed once up front, and listed again first if refresh is set.
+    """
+    inventory = get_inventory(server_config, refresh)
+
+    def fetch(folder):
+        try:
+            probe = probe_folder(server_config, folder, refresh, inventory)
+            return folder, fetch_acl(server_config, folder, probe), None
+        except Exception as e:
+            logging.warning(f"Import of {folder} failed: {e}")
+            return folder, None, e
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="import") as executor:
+        for done, result in enumerate(executor.map(fetch, folders), start=1):
+            yield result
+            if progress:
+                progress(done, len(folders), time.monotonic() - started)
+
+
+def probe_tree(server_config, folders, known: dict, workers=8, force=False, progress=None):
+    """
+    Probes many folders with a bounded pool of worker threads and only parses the ones that changed.
+
+    ``known`` maps folder names to the fingerprint of their previous probe. Yields (folder, digest, fetched, error)
+    tuples in the order of ``folders``, where fetched is None if the fingerprint is unchanged (unless ``force``)
+    and otherwise the fetch_acl result parsed from the same probe. ``progress`` is called with
+    (done, total, elapsed_seconds) after every folder. The server is always asked, cached reads would hide drift,
+    so the server's inventory is listed again once up front.
+    """
+    inventory = get_inventory(server_config, refresh=True)
+
+    def check(folder):
+        try:
+            probe = probe_folder(server_config, folder, refresh=True, inventory=inventory)
+            digest = fingerprint(probe)
+            if not force and known.get(folder) == digest:
+                return folder, digest, None, None
+            return folder, digest, fetch_acl(server_config, folder, probe), None
+        except Exception as e:
+            logging.warning(f"Probe of {folder} failed: {e}")
+            return folder, None, None, e
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="probe") as executor:
+        for done, result in enumerate(executor.map(check, folders), start=1):
+            yield result
+            if progress:
+                progress(done, len(folders), time.monotonic() - started)
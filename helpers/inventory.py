@@ -0,0 +1,200 @@
+import logging
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+from helpers.commands import host_key, server_key, on_invalidate, stream_command
+from helpers.config import compile_server_config
+from helpers.parsers import quota_from_match
+
+# The protocols with a server-wide listing, each from an optional <protocol>_inventory_command in servers.json
+PROTOCOL_INVENTORIES = ("smb", "nfs", "s3")
+# Used for a listing without a <protocol>_inventory_regexp, every absolute path in the output
+DEFAULT_PATH_PATTERN = re.compile(r"(?P<path>/[^\s\"',]+)")
+# Default for the optional inventory_ttl in servers.json, in seconds
+INVENTORY_TTL = 300
+# The mutations that get the protocols and quota of the share, and so may change them on the server
+INVALIDATING_COMMANDS = ("create_acl", "edit_acl")
+
+
+class Inventory:
+    """
+    The shares, exports and quotas of one server, listed once and indexed by path.
+
+    ``covers`` holds the probe command types ("protocol", "quota") the inventory answers. Paths that were changed
+    by our own mutations since the inventory was listed are ``stale`` and are read per folder again.
+    """
+
+    def __init__(self, protocols: dict[str, set], quotas: dict[str, dict], covers: set, loaded_at: float):
+        self.protocols = protocols
+        self.quotas = quotas
+        self.covers = covers
+        self.loaded_at = loaded_at
+        self.stale: set[str] = set()
+
+    def probe(self, folder_name) -> dict:
+        """
+        The parsed protocol and quota output of a folder, in the form probe_folder returns them, for the
+        command types this inventory covers and as long as the folder is not stale.
+        """
+        folder_name = folder_name.rstrip('/')
+        if folder_name in self.stale:
+            return {}
+        probe = {}
+        if "protocol" in self.covers:
+            probe["protocol"] = {protocol: 1 for protocol in sorted(self.protocols.get(folder_name, ()))}
+        if "quota" in self.covers:
+            probe["quota"] = dict(self.quotas.get(folder_name, {"soft": 0.0, "hard": 0.0}))
+        return probe
+
+    def stats(self) -> dict:
+        return {
+            "covers": sorted(self.covers),
+            "protocol_paths": len(self.protocols),
+            "quota_paths": len(self.quotas),
+            "stale": len(self.stale),
+            "age": round(time.monotonic() - self.loaded_at, 1),
+        }
+
+
+def inventory_types(server_config) -> list[str]:
+    """The inventory command types (e.g. "smb_inventory", "quota_inventory") configured for a server."""
+    server_config = compile_server_config(server_config.get('title', ''), server_config)
+    return [f"{name}_inventory" for name in (*PROTOCOL_INVENTORIES, "quota")
+            if f"{name}_inventory" in server_config.templates]
+
+
+def load_inventory(server_config) -> Inventory | None:
+    """
+    Runs every inventory command of a server concurrently and indexes the output by path while it streams in,
+    so a listing of hundreds of megabytes is never held in memory. Returns None if the server has no inventory
+    commands.
+
+    A <protocol>_inventory_regexp is searched (line by line) for every path the protocol is enabled on,
+    quota_inventory_regexp for every quota with a path group and the {soft,hard}_number and _unit groups of
+    quota_regexp.
+    """
+    server_config = compile_server_config(server_config.get('title', ''), server_config)
+    command_types = inventory_types(server_config)
+    if not command_types:
+        return None
+    if "quota_inventory" in command_types and "quota_inventory" not in server_config.regexps:
+        raise ValueError(f"Server {server_config.name}: quota_inventory_command needs a quota_inventory_regexp")
+
+    def index(command_type) -> dict:
+        pattern = server_config.regexps.get(command_type, DEFAULT_PATH_PATTERN)
+        found = {}
+        for line in stream_command(server_config, command_type, {}):
+            for match in pattern.finditer(line):
+                path = match.group('path').rstrip('/')
+                found[path] = quota_from_match(match) if command_type == "quota_inventory" else True
+        return found
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=len(command_types), thread_name_prefix="inventory") as executor:
+        indexes = dict(zip(command_types, executor.map(index, command_types)))
+
+    quotas: dict[str, dict] = indexes.pop("quota_inventory", {})
+    protocols: dict[str, set] = {}
+    for command_type, paths in indexes.items():
+        for path in paths:
+            protocols.setdefault(path, set()).add(command_type[:-len("_inventory")])
+
+    covers = {"quota"} if "quota_inventory" in command_types else set()
+    if len(command_types) > len(covers):
+        covers.add("protocol")
+    logging.info(f"Inventory of {server_config['title']}: {len(protocols)} shared paths and {len(quotas)} quotas "
+                 f"in {time.monotonic() - started:.2f}s")
+    return Inventory(protocols, quotas, covers, time.monotonic())
+
+
+# Keyed on server_key, every servers.json entry indexes the listings with its own regexps
+_inventories: dict[tuple, Inventory] = {}
+_inventory_locks: dict[tuple, Lock] = {}
+# When our mutations touched a folder, per entry, so a listing that was running at the time is not trusted
+_mutated: dict[tuple, dict[str, float]] = {}
+# When the last listing of an entry failed, that entry is probed per folder until inventory_ttl has passed
+_failed: dict[tuple, float] = {}
+_inventories_lock = Lock()
+
+
+def get_inventory(server_config, refresh=False) -> Inventory | None:
+    """
+    Returns the inventory of a server, listing it again once it is older than inventory_ttl (servers.json,
+    default 300 seconds, 0 disables the inventory) or when refresh is set. Concurrent callers wait for a
+    single listing. Returns None if the server has no inventory commands or the listing failed, the folders are
+    then probed one by one. A failed listing is tried again after inventory_ttl or on refresh.
+    """
+    ttl = server_config.get('inventory_ttl', INVENTORY_TTL)
+    if not ttl:
+        return None
+    key = server_key(server_config)
+    with _inventories_lock:
+        lock = _inventory_locks.setdefault(key, Lock())
+    requested = time.monotonic()
+    with lock:
+        inventory = _inventories.get(key)
+        # Somebody else may have listed it while we waited, that listing is fresh enough for a refresh too
+        if inventory is not None and (inventory.loaded_at >= requested if refresh
+                                      else time.monotonic() - inventory.loaded_at < ttl):
+            return inventory
+        failed = _failed.get(key)
+        if failed is not None and (failed >= requested if refresh else time.monotonic() - failed < ttl):
+            return None
+        started = time.monotonic()
+        try:
+            inventory = load_inventory(server_config)
+        except Exception as e:
+            logging.warning(f"Inventory of {key[0]} failed, probing per folder: {e}")
+            inventory = None
+            _failed[key] = time.monotonic()
+        else:
+            _failed.pop(key, None)
+        with _inventories_lock:
+            mutated = _mutated.pop(key, {})
+            if inventory is None:
+                _inventories.pop(key, None)
+            else:
+                # Folders changed while listing may or may not be in the listing, older changes are
+                inventory.stale = {folder for folder, changed in mutated.items() if changed >= started}
+                _mutated[key] = {folder: mutated[folder] for folder in inventory.stale}
+                _inventories[key] = inventory
+        return inventory
+
+
+@on_invalidate
+def invalidate_inventory(server_config=None, folder_name=None, command_type=None):
+    """
+    Marks a folder stale after one of our mutations, so it is read per folder until the next listing, in the
+    inventory of every servers.json entry on the server's host. Without a folder those inventories are dropped,
+    without a server every inventory. Mutations that only change ACEs (delete_acl, fix_acl) leave the inventory
+    alone.
+    """
+    if command_type is not None and command_type not in INVALIDATING_COMMANDS:
+        return
+    if server_config is not None and not (server_config.get('inventory_ttl', INVENTORY_TTL)
+                                          and inventory_types(server_config)):
+        return
+    with _inventories_lock:
+        if server_config is None:
+            _inventories.clear()
+            return
+        host = host_key(server_config)
+        # Entries that have an inventory or are listing one right now
+        keys = [key for key in _inventory_locks if key[1] == host]
+        if folder_name is None:
+            for key in keys:
+                _inventories.pop(key, None)
+            return
+        folder_name = folder_name.rstrip('/')
+        for key in keys:
+            _mutated.setdefault(key, {})[folder_name] = time.monotonic()
+            if key in _inventories:
+                _inventories[key].stale.add(folder_name)
+
+
+def inventory_stats() -> dict[str, dict]:
+    with _inventories_lock:
+        inventories = dict(_inventories)
+    return {name: inventory.stats() for (name, _), inventory in inventories.items()}
@@ -0,0 +1,313 @@
+import json
+import logging
+import os
+import socket
+import time
+import uuid
+from threading import Condition, Event, Lock, Thread
+
+from sqlalchemy import select, update, func
+
+from models.job import Job
+
+# A job in one of these states will not change anymore
+FINISHED = ('completed', 'failed', 'cancelled')
+# Errors in the job itself (a missing share, a server without the command), retrying them cannot help
+PERMANENT_ERRORS = (ValueError, PermissionError, NotImplementedError)
+
+
+class JobCancelled(Exception):
+    """Raised inside a job handler once the job has been cancelled."""
+
+
+class JobContext:
+    """Handed to job handlers to report progress and to notice cancellation."""
+
+    def __init__(self, queue, job_id, payload: dict, attempt: int):
+        self.queue = queue
+        self.id = job_id
+        self.payload = payload
+        self.attempt = attempt
+
+    def progress(self, **fields):
+        """
+        Records the progress fields (e.g. processed, total, rate, eta) of the job and raises JobCancelled if
+        a cancellation was requested in the meantime. The fields are written to the database by the queue's
+        heartbeat thread, so a handler holding a write transaction never blocks on its own progress reports.
+        """
+        self.queue._report(self.id, fields)
+        if self.queue._cancel_requested(self.id):
+            raise JobCancelled(f"Job {self.id} was cancelled")
+
+
+class JobQueue:
+    """
+    A job queue stored in the application database, so jobs survive restarts and every web worker process
+    sees the same jobs.
+
+    Each process runs ``workers`` threads that claim queued jobs in priority order. A job is only claimed while
+    fewer than server_limit(server) jobs of the same server are running, in any process. Failed jobs are retried
+    up to max_attempts times with exponential backoff (except for PERMANENT_ERRORS), and jobs of a crashed process are picked up again once
+    their heartbeat is older than ``stale_after`` seconds.
+
+    Progress, heartbeats and cancellation requests are exchanged with the database every ``sync_interval``
+    seconds by a single heartbeat thread per process. ``follow`` reports the changes of jobs as they happen.
+    """
+
+    def __init__(self, app, db, workers=4, server_limit=None, poll_interval=1.0, backoff=30, stale_after=300,
+                 sync_interval=1.0):
+        self.app = app
+        self.db = db
+        self.workers = workers
+        self.server_limit = server_limit or (lambda server: 1)
+        self.poll_interval = poll_interval
+        self.backoff = backoff
+        self.stale_after = stale_after
+        self.sync_interval = sync_interval
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        # Flask-SQLAlchemy only hands out the engine inside an application context
+        with app.app_context():
+            self.engine = db.engine
+
+        self._handlers = {}
+        self._running = set()
+        self._progress = {}
+        self._cancelled = set()
+        self._running_lock = Lock()
+        self._wakeup = Event()
+        self._threads = []
+        # Counts every submit, progress report, cancellation and finish in this process, see follow
+        self._changes = 0
+        self._changed = Condition()
+
+    def register(self, kind, handler):
+        """Registers handler(payload, context) for a job kind. Its return value (a dict) is stored as the result."""
+        self._handlers[kind] = handler
+
+    def submit(self, kind, payload: dict, server=None, priority=0, max_attempts=1) -> str:
+        """Queues a job and returns its id."""
+        job_id = str(uuid.uuid4())
+        with self.engine.begin() as conn:
+            conn.execute(Job.__table__.insert().values(
+                id=job_id, kind=kind, server=server, payload=json.dumps(payload), status='queued',
+                priority=priority, attempts=0, max_attempts=max_attempts, cancel_requested=False,
+                created_at=time.time(), run_after=0))
+        self._wakeup.set()
+        self._notify()
+        return job_id
+
+    def get(self, job_id) -> dict | None:
+        return self.get_many([job_id]).get(job_id)
+
+    def get_many(self, job_ids) -> dict[str, dict]:
+        """The status of every existing job of job_ids, by id, in one query."""
+        with self.app.app_context():
+            statuses = {job.id: job.to_dict() for job in Job.query.filter(Job.id.in_(list(job_ids)))}
+        # Progress of a job running in this process may not have been written yet
+        with self._running_lock:
+            for job_id, status in statuses.items():
+                status.update(self._progress.get(job_id, {}))
+        return statuses
+
+    def follow(self, job_ids, timeout=300, min_interval=0.05):
+        """
+        Yields a list with the status of every job of job_ids that changed, the first time every status, until all
+        of them are finished or timeout seconds have passed. Unknown jobs are reported once with status
+        "not_found".
+
+        Changes made in this process are picked up right away (at most every min_interval seconds), those of
+        other processes once their heartbeat wrote them, so the database is read every sync_interval seconds
+        while nothing happens here. An empty list is yielded after every such quiet interval, e.g. to keep a
+        connection alive.
+        """
+        pending = list(dict.fromkeys(job_ids))
+        sent = {}
+        deadline = time.monotonic() + timeout
+        while pending:
+            read_at = time.monotonic()
+            with self._changed:
+                changes = self._changes
+            statuses = self.get_many(pending)
+            changed = []
+            for job_id in list(pending):
+                status = statuses.get(job_id, {'id': job_id, 'status': 'not_found', 'message': 'Job not found'})
+                if status != sent.get(job_id):
+                    sent[job_id] = status
+                    changed.append(status)
+                if status['status'] in FINISHED or status['status'] == 'not_found':
+                    pending.remove(job_id)
+            yield changed
+            remaining = deadline - time.monotonic()
+            if not pending or remaining <= 0:
+                return
+            with self._changed:
+                self._changed.wait_for(lambda: self._changes != changes, min(self.sync_interval, remaining))
+            # Busy jobs report progress many times a second, the database is read at most every min_interval
+            time.sleep(max(0.0, min(read_at + min_interval, deadline) - time.monotonic()))
+
+    def history(self, limit=50, status=None) -> list[dict]:
+        with self.app.app_context():
+            query = Job.query.order_by(Job.created_at.desc())
+            if status:
+                query = query.filter(Job.status == status)
+            return [job.to_dict() for job in query.limit(limit)]
+
+    def cancel(self, job_id) -> bool:
+        """Cancels a queued job right away, or asks a running job to stop at its next progress report."""
+        now = time.time()
+        with self.engine.begin() as conn:
+            cancelled = conn.execute(update(Job).where(Job.id == job_id, Job.status == 'queued')
+                                     .values(status='cancelled', finished_at=now)).rowcount
+            if not cancelled:
+                cancelled = conn.execute(update(Job).where(Job.id == job_id, Job.status == 'running')
+                                         .values(cancel_requested=True)).rowcount
+        self._notify()
+        return bool(cancelled)
+
+    def start(self):
+        for number in range(self.workers):
+            thread = Thread(target=self._worker_loop, name=f"job-worker-{number}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        thread = Thread(target=self._heartbeat_loop, name="job-heartbeat", daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def _claim(self):
+        """Atomically moves the best runnable job to running and returns (id, kind, payload, attempts)."""
+        now = time.time()
+        with self.engine.begin() as conn:
+            candidates = conn.execute(select(Job.id, Job.server)
+                                      .where(Job.status == 'queued', Job.run_after <= now)
+                                      .order_by(Job.priority.desc(), Job.created_at)
+                                      .limit(20)).all()
+
+        for job_id, server in candidates:
+            claim = update(Job).where(Job.id == job_id, Job.status == 'queued')
+            if server is not None:
+                # The per-server limit is part of the UPDATE, so two processes cannot both take the last slot
+                running = (select(func.count()).select_from(Job)
+                           .where(Job.server == server, Job.status == 'running').scalar_subquery())
+                claim = claim.where(running < self.server_limit(server))
+            claim = claim.values(status='running', worker=self.worker_id, started_at=now, heartbeat=now,
+                                 attempts=Job.attempts + 1)
+            with self.engine.begin() as conn:
+                if conn.execute(claim).rowcount == 1:
+                    return conn.execute(select(Job.id, Job.kind, Job.payload, Job.attempts, Job.max_attempts)
+                                        .where(Job.id == job_id)).one()
+        return None
+
+    def _notify(self):
+        with self._changed:
+            self._changes += 1
+            self._changed.notify_all()
+
+    def _report(self, job_id, fields: dict):
+        with self._running_lock:
+            self._progress[job_id] = fields
+        self._notify()
+
+    def _cancel_requested(self, job_id) -> bool:
+        with self._running_lock:
+            return job_id in self._cancelled
+
+    def _finish(self, job_id, **values):
+        """Writes the outcome of a run, together with its last progress report if the heartbeat has not yet."""
+        with self._running_lock:
+            fields = self._progress.pop(job_id, None)
+        if fields is not None:
+            values['progress'] = json.dumps(fields)
+        with self.engine.begin() as conn:
+            conn.execute(update(Job).where(Job.id == job_id).values(**values))
+        self._notify()
+
+    def _run(self, job_id, kind, payload, attempts, max_attempts):
+        with self._running_lock:
+            self._running.add(job_id)
+        context = JobContext(self, job_id, json.loads(payload), attempts)
+        try:
+            handler = self._handlers.get(kind)
+            if handler is None:
+                raise NotImplementedError(f"No handler registered for job kind {kind}")
+            with self.app.app_context():
+                try:
+                    result = handler(context.payload, context) or {}
+                except Exception:
+                    self.db.session.rollback()
+                    raise
+            self._finish(job_id, status='completed', result=json.dumps(result), message=None,
+                         finished_at=time.time())
+        except JobCancelled as e:
+            self._finish(job_id, status='cancelled', message=str(e), finished_at=time.time())
+        except Exception as e:
+            logging.exception(f"Job {job_id} ({kind}) failed on attempt {attempts}/{max_attempts}")
+            if attempts < max_attempts and not isinstance(e, PERMANENT_ERRORS):
+                self._finish(job_id, status='queued', message=str(e),
+                             run_after=time.time() + self.backoff * 2 ** (attempts - 1))
+            else:
+                self._finish(job_id, status='failed', message=str(e), finished_at=time.time())
+        finally:
+            with self._running_lock:
+                self._running.discard(job_id)
+                self._progress.pop(job_id, None)
+                self._cancelled.discard(job_id)
+
+    def _worker_loop(self):
+        while True:
+            try:
+                claimed = self._claim()
+            except Exception as e:
+                logging.error(f"Could not claim a job: {e}")
+                claimed = None
+            if claimed is None:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+            self._notify()
+            self._run(*claimed)
+
+    def _sync(self):
+        """Writes pending progress and heartbeats of the jobs running here and reads back cancellation requests."""
+        now = time.time()
+        with self._running_lock:
+            running = list(self._running)
+            pending, self._progress = self._progress, {}
+        try:
+            with self.engine.begin() as conn:
+                if running:
+                    conn.execute(update(Job).where(Job.id.in_(running)).values(heartbeat=now))
+                    cancelled = conn.execute(select(Job.id).where(Job.id.in_(running),
+                                                                  Job.cancel_requested.is_(True))).scalars()
+                    with self._running_lock:
+                        self._cancelled.update(cancelled)
+                for job_id, fields in pending.items():
+                    conn.execute(update(Job).where(Job.id == job_id).values(progress=json.dumps(fields)))
+        except Exception:
+            # Keep the progress for the next round unless a newer report came in
+            with self._running_lock:
+                for job_id, fields in pending.items():
+                    if job_id in self._running:
+                        self._progress.setdefault(job_id, fields)
+            raise
+
+    def _requeue_stale(self):
+        """Jobs of a process that died: retry them if attempts are left, fail them otherwise."""
+        now = time.time()
+        stale = (Job.status == 'running', Job.heartbeat < now - self.stale_after)
+        with self.engine.begin() as conn:
+            conn.execute(update(Job).where(*stale, Job.attempts < Job.max_attempts)
+                         .values(status='queued', message='Worker stopped, retrying'))
+            conn.execute(update(Job).where(*stale)
+                         .values(status='failed', message='Worker stopped', finished_at=now))
+
+    def _heartbeat_loop(self):
+        last_requeue = 0
+        while True:
+            time.sleep(self.sync_interval)
+            try:
+                self._sync()
+                if time.monotonic() - last_requeue > self.stale_after / 5:
+                    self._requeue_stale()
+                    last_requeue = time.monotonic()
+            except Exception as e:
+                logging.error(f"Job heartbeat failed: {e}")
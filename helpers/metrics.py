@@ -0,0 +1,125 @@
+import logging
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock
+
+# Upper bounds in seconds, from a cached LDAP lookup to an import over a slow link
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Operations taking longer than this many seconds are logged as warnings, None disables the slow log
+slow_threshold = None
+
+
+class Histogram:
+    """
+    Durations of one operation in cumulative buckets per label set, as a Prometheus histogram. Observing is a
+    bisect and a few additions under a lock, cheap enough for every SSH command and LDAP lookup.
+    """
+
+    def __init__(self, name, description, labels: tuple[str, ...], buckets=BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        self._series: dict[tuple, list] = {}
+        self._lock = Lock()
+
+    def observe(self, seconds: float, **labels):
+        key = tuple(str(labels.get(label, '')) for label in self.labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                # Bucket counts, then the sum and the count of all observations
+                series = self._series[key] = [0] * len(self.buckets) + [0.0, 0]
+            index = bisect_left(self.buckets, seconds)
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += seconds
+            series[-1] += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {key: list(values) for key, values in self._series.items()}
+        for key, values in sorted(series.items()):
+            labels = [_label(label, value) for label, value in zip(self.labels, key)]
+            cumulative = 0
+            for bound, count in zip(self.buckets, values):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_label_set(labels + [_label('le', bound)])} {cumulative}")
+            lines.append(f"{self.name}_bucket{_label_set(labels + [_label('le', '+Inf')])} {values[-1]}")
+            lines.append(f"{self.name}_sum{_label_set(labels)} {values[-2]}")
+            lines.append(f"{self.name}_count{_label_set(labels)} {values[-1]}")
+        return lines
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+
+def _label_set(labels: list[str]) -> str:
+    return f"{{{','.join(labels)}}}" if labels else ""
+
+
+def _label(name, value) -> str:
+    value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return f'{name}="{value}"'
+
+
+_histograms: dict[str, Histogram] = {}
+_histograms_lock = Lock()
+
+
+def histogram(name, description, labels=()) -> Histogram:
+    """Returns the histogram registered under name, registering it on first use."""
+    with _histograms_lock:
+        if name not in _histograms:
+            _histograms[name] = Histogram(name, description, tuple(labels))
+        return _histograms[name]
+
+
+# The phases of an import or a mutation, see helpers.commands, helpers.connections,
+# helpers.domain and the commit listeners in app.py
+COMMAND_SECONDS = histogram("sharemanagement_command_seconds",
+                            "Duration of a command list (exec_command) against a server",
+                            ("server", "command_type"))
+TRANSPORT_SECONDS = histogram("sharemanagement_transport_seconds",
+                              "Duration of a single remote command, including the wait for a free channel",
+                              ("server", "transport"))
+SSH_CONNECT_SECONDS = histogram("sharemanagement_ssh_connect_seconds",
+                                "Duration of opening and authenticating a pooled SSH connection", ("server",))
+PARSE_SECONDS = histogram("sharemanagement_parse_seconds",
+                          "Duration of parsing (regexp or format) and mapping (Jinja) the output of a command",
+                          ("command_type", "stage"))
+LDAP_SECONDS = histogram("sharemanagement_ldap_seconds",
+                         "Duration of an LDAP lookup, cache hits included", ("domain", "operation"))
+DB_COMMIT_SECONDS = histogram("sharemanagement_db_commit_seconds",
+                              "Duration of a database commit, including the flush", ())
+
+
+@contextmanager
+def timed(metric: Histogram, **labels):
+    """
+    Observes the duration of the block in metric, also when it raises. Blocks slower than slow_threshold are
+    logged with their labels.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        metric.observe(elapsed, **labels)
+        if slow_threshold is not None and elapsed >= slow_threshold:
+            logging.warning(f"Slow operation: {metric.name} {labels} took {elapsed:.3f}s")
+
+
+def render_metrics() -> str:
+    """Returns every registered histogram in the Prometheus text exposition format."""
+    with _histograms_lock:
+        histograms = list(_histograms.values())
+    lines = []
+    for metric in histograms:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
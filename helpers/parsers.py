@@ -1,5 +1,8 @@
+import json
 import re
 
+from helpers.permissions import Permission, LETTERS
+
 def parse_output(output, parser_type, regexp):
     """
     Parses the output of a command based on the server configuration and type.
@@ -23,54 +26,85 @@ def parse_protocol(output, regexp):
 
 def parse_quota(output, regexp) -> dict[str, float]:
     # Get the quota from the output
-    quota = {"soft": 0.0, "hard": 0.0}
-
     quota_match = re.search(regexp, output)
     if quota_match:
-        for quota_type in ['soft', 'hard']:
-            quota_raw = 0.0
-            quota_unit = ''
-            if f"{quota_type}_number" in quota_match.groupdict():
-                quota_raw = quota_match.group(f"{quota_type}_number")
-            if f"{quota_type}_unit" in quota_match.groupdict():
-                quota_unit = quota_match.group(f"{quota_type}_unit")
-
-            if quota_unit == 'P':
-                quota_number = float(quota_raw) * 1024 * 1024
-            elif quota_unit == 'T':
-                quota_number = float(quota_raw) * 1024
-            elif quota_unit == 'G':
-                quota_number = float(quota_raw)
-            elif quota_unit == 'M':
-                quota_number = float(quota_raw) / 1024
-            elif quota_unit == 'K':
-                quota_number = float(quota_raw) / 1024 / 1024
-            else:
-                # Presume bytes
-                quota_number = float(quota_raw) / 1024 / 1024 / 1024
-            quota[quota_type] = quota_number
+        return quota_from_match(quota_match)
+    return {"soft": 0.0, "hard": 0.0}
+
+
+def quota_from_match(quota_match) -> dict[str, float]:
+    """Converts the {soft,hard}_number and {soft,hard}_unit groups of a quota regexp match to GiB."""
+    quota = {"soft": 0.0, "hard": 0.0}
+    for quota_type in ['soft', 'hard']:
+        quota_raw = 0.0
+        quota_unit = ''
+        if f"{quota_type}_number" in quota_match.groupdict():
+            quota_raw = quota_match.group(f"{quota_type}_number")
+        if f"{quota_type}_unit" in quota_match.groupdict():
+            quota_unit = quota_match.group(f"{quota_type}_unit")
+        quota[quota_type] = to_gib(quota_raw, quota_unit)
     return quota
 
+
+def to_gib(number, unit='') -> float:
+    """Converts a number with a K, M, G, T or P unit to GiB, a number without a unit is in bytes."""
+    if unit == 'P':
+        return float(number) * 1024 * 1024
+    elif unit == 'T':
+        return float(number) * 1024
+    elif unit == 'G':
+        return float(number)
+    elif unit == 'M':
+        return float(number) / 1024
+    elif unit == 'K':
+        return float(number) / 1024 / 1024
+    # Presume bytes
+    return float(number) / 1024 / 1024 / 1024
+
+# Creating an IntFlag member is slow, the ACE loop picks one of these instead
+PERMISSIONS = [Permission(mask) for mask in range(8)]
+
+
+def permission_mask(permission: str) -> int:
+    """The Permission bits of every r, w or x that occurs in a (translated) permission string, e.g. "r,x" is 5."""
+    mask = 0
+    for letter, bit in LETTERS.items():
+        if letter in permission:
+            mask |= bit.value
+    return mask
+
+
+def permission_masks(permission_map: dict) -> dict[str, int]:
+    """Precomputes permission_mask of every translation in an acl_regexp permission_map."""
+    return {name: permission_mask(translated) for name, translated in permission_map.items()}
+
+
 def parse_acl(acl_output, acl_regexp):
-    """Parses ACL output using regex patterns and permission map from the configuration."""
+    """
+    Parses ACL output using regex patterns and permission map from the configuration.
+
+    The ACEs are read in a single finditer pass, and every permission name is translated with a table of
+    bitmasks (precomputed by helpers.config, filled on first use for names that are not in the map). The
+    permission of every ACE is a helpers.permissions.Permission.
+    """
     parsed_data = {
         "owner": "nobody",
         "group": "nobody",
         "everyone": "everyone",
         "permissions": []
     }
+    patterns = acl_regexp['regex_patterns']
 
     # Extract POSIX permissions and turn them into ACL
+    posix_acl_match = re.search(patterns['posix'], acl_output)
     for posix_type in ['owner', 'group', 'everyone']:
-        entity_match = re.search(acl_regexp['regex_patterns'][posix_type], acl_output)
+        entity_match = re.search(patterns[posix_type], acl_output)
         if entity_match:
-           parsed_data[posix_type] = entity_match.group(posix_type)
+            parsed_data[posix_type] = entity_match.group(posix_type)
 
-        posix_acl_match = re.search(acl_regexp['regex_patterns']['posix'], acl_output)
         if not posix_acl_match:
             continue
-        permission = set(posix_acl_match.group(posix_type))
-        permission.discard('-')
+        permission = Permission.parse(posix_acl_match.group(posix_type))
 
         if not permission:
             continue
@@ -84,30 +118,244 @@ def parse_acl(acl_output, acl_regexp):
         })
 
     # Extract permissions
-    permissions_pattern = acl_regexp['regex_patterns']['acl']
     permission_map = acl_regexp.get('permission_map', {})
-    for match in re.finditer(permissions_pattern, acl_output):
-        permission_matches = match.group('permission')
-        translated_access = (permission_map.get(perm, perm) for perm in permission_matches.split(","))
-        # We now have an array with ["", "r,w", "x", "r,w,x"] etc.
-        # Remove empty string and flatten to a single set("r","w","x")
-        unique_permissions = set()
-        for perm in translated_access:
-            if "r" in perm:
-                unique_permissions.add("r")
-            if "w" in perm:
-                unique_permissions.add("w")
-            if "x" in perm:
-                unique_permissions.add("x")
+    masks = acl_regexp.get('permission_masks')
+    if masks is None:
+        masks = permission_masks(permission_map)
+    for match in re.finditer(patterns['acl'], acl_output):
+        index, ace_type, name, access, permissions = match.group('index', 'type', 'name', 'access', 'permission')
+        # Plain ints in the loop, IntFlag operators are a lot slower
+        mask = 0
+        for perm in permissions.split(","):
+            perm_mask = masks.get(perm)
+            if perm_mask is None:
+                # Not in the permission map, the name itself is scanned for r, w and x
+                perm_mask = masks[perm] = permission_mask(permission_map.get(perm, perm))
+            mask |= perm_mask
 
         parsed_data['permissions'].append({
-            "index": match.group('index'),
-            "type": match.group('type'),
-            "name": match.group('name'),
-            "access": match.group('access'),
-            "permission": unique_permissions
+            "index": index,
+            "type": ace_type,
+            "name": name,
+            "access": access,
+            "permission": PERMISSIONS[mask]
         })
 
     return parsed_data
 
 
+# What the regexp parsers return when nothing matched, structured output starts from the same
+STRUCTURED_DEFAULTS = {
+    "acl": {"owner": "nobody", "group": "nobody", "everyone": "everyone", "permissions": []},
+    "quota": {"soft": 0.0, "hard": 0.0},
+    "protocol": {},
+}
+# Completes an ACE of structured acl output, the index defaults to its position in the list
+ACE_DEFAULTS = {"type": "everyone", "name": "", "access": "allow", "permission": Permission.NONE}
+SIZE_PATTERN = re.compile(r"\s*(?P<number>[0-9.]+)\s*(?P<unit>[KMGTP]?)i?B?\s*$")
+
+
+def coerce_bool(value) -> bool:
+    if isinstance(value, str):
+        return value.strip().lower() in ("1", "true", "yes", "on", "enabled")
+    return bool(value)
+
+
+def coerce_size(value) -> float:
+    """A size in GiB from a number of bytes or a string like "1073741824", "100G" or "1.5 TiB"."""
+    if isinstance(value, (int, float)):
+        return to_gib(value)
+    match = SIZE_PATTERN.match(str(value))
+    if not match:
+        raise ValueError(f"not a size: {value!r}")
+    return to_gib(match.group('number'), match.group('unit'))
+
+
+def coerce_flags(value) -> dict[str, int]:
+    """The enabled names of a list (or comma separated string) of names, like parse_protocol returns them."""
+    names = value.split(",") if isinstance(value, str) else value
+    return {str(name).strip(): 1 for name in names if str(name).strip()}
+
+
+def coerce_mode(value) -> tuple[Permission, Permission, Permission]:
+    """The owner, group and everyone Permission of an octal mode (0770, "0770") or a mode line ("drwxrwx---")."""
+    if isinstance(value, int):
+        value = f"{value:o}"
+    value = str(value).strip()
+    if value.isdigit():
+        digits = value[-3:].rjust(3, '0')
+        return tuple(PERMISSIONS[int(digit) & 7] for digit in digits)
+    letters = value[-9:]
+    if len(letters) != 9:
+        raise ValueError(f"not a mode: {value!r}")
+    return tuple(Permission.parse(letters[start:start + 3]) for start in (0, 3, 6))
+
+
+COERCIONS = {
+    "str": str,
+    "int": int,
+    "float": float,
+    "bool": coerce_bool,
+    "size": coerce_size,
+    "flags": coerce_flags,
+    "mode": coerce_mode,
+    # Filled per format, it needs the permission map
+    "permission": None,
+}
+
+
+class StructuredFormat:
+    """
+    A <command_type>_format from servers.json, for commands that return JSON (or JSON lines) instead of text.
+
+    The fields are read by dotted paths and coerced once, without regular expressions or Jinja templates, into the
+    dicts the regexp parsers return::
+
+        "quota_format": {
+          "type": "json",
+          "root": "quotas.0",
+          "fields": {
+            "hard": {"path": "thresholds.hard", "type": "size"},
+            "soft": {"path": "thresholds.soft", "type": "size"}
+          }
+        }
+
+    ``type`` is "json" (the default) or "jsonl", one JSON document per line read into a list. ``root`` is the
+    path the fields are read from. A field is a path or a dict with ``path``, ``type`` (see COERCIONS),
+    ``default`` and ``each``, the fields of every item of the list at path. In a path, a number indexes a list,
+    "" is the current value and "#" the position of the item in ``each``. A field whose path is missing or null
+    gets its default or, without one, is left out. Fields of type "permission" translate permission names with
+    the ``permission_map`` of the format, like the one of an acl_regexp.
+
+    For the acl, quota and protocol command types missing fields are filled in as the regexp parsers do, ACEs
+    in the acl "permissions" included, and an acl "mode" field (type "mode") adds the owner, group and everyone
+    ACEs of the POSIX mode.
+    """
+
+    def __init__(self, command_type, spec: dict):
+        if not isinstance(spec, dict):
+            raise ValueError("must be an object")
+        if spec.get('type', 'json') not in ('json', 'jsonl'):
+            raise ValueError(f"unknown type {spec['type']!r}, must be json or jsonl")
+        self.command_type = command_type
+        self.lines = spec.get('type') == 'jsonl'
+        self.root = self._compile_path(spec.get('root', ''))
+        self.permission_map = dict(spec.get('permission_map', {}))
+        self.permission_masks = permission_masks(self.permission_map)
+        self.fields = self._compile_fields(spec.get('fields'), "fields")
+
+    @staticmethod
+    def _compile_path(path):
+        """A getter for a dotted path, paths without list indexes are plain lookups."""
+        if not isinstance(path, str):
+            raise ValueError(f"path must be a string, not {path!r}")
+        keys = tuple(int(key) if key.isdigit() else key for key in path.split(".")) if path else ()
+        if not keys:
+            return lambda data: data
+        if any(isinstance(key, int) for key in keys):
+            return lambda data: StructuredFormat._resolve(data, keys)
+
+        def get(data):
+            # Only a dict can be indexed by a string, anything else raises a TypeError
+            try:
+                for key in keys:
+                    data = data[key]
+            except (KeyError, TypeError):
+                return None
+            return data
+        return get
+
+    def _compile_fields(self, fields, where) -> list[tuple]:
+        if not isinstance(fields, dict) or not fields:
+            raise ValueError(f"{where} must be an object with at least one field")
+        compiled = []
+        for name, field in fields.items():
+            if isinstance(field, str):
+                field = {"path": field}
+            if not isinstance(field, dict) or 'path' not in field:
+                raise ValueError(f"{where}.{name} must be a path or an object with a path")
+            coercion = field.get('type')
+            if coercion is not None and coercion not in COERCIONS:
+                raise ValueError(f"{where}.{name}: unknown type {coercion!r}, must be one of {', '.join(COERCIONS)}")
+            coerce = self._coerce_permission if coercion == "permission" else COERCIONS.get(coercion)
+            each = self._compile_fields(field['each'], f"{where}.{name}.each") if 'each' in field else None
+            # "#" has no getter, it is the position of the item
+            getter = None if field['path'] == "#" else self._compile_path(field['path'])
+            compiled.append((name, getter, coerce, 'default' in field, field.get('default'), each))
+        return compiled
+
+    def _coerce_permission(self, value) -> Permission:
+        """Translates permission names (a list or comma separated) with the permission map, like parse_acl."""
+        names = value.split(",") if isinstance(value, str) else value
+        mask = 0
+        masks = self.permission_masks
+        for name in names:
+            name_mask = masks.get(name)
+            if name_mask is None:
+                name_mask = self.permission_masks[name] = permission_mask(self.permission_map.get(name, name))
+            mask |= name_mask
+        return PERMISSIONS[mask]
+
+    @staticmethod
+    def _resolve(data, path: tuple):
+        for key in path:
+            if isinstance(data, dict):
+                data = data.get(str(key) if isinstance(key, int) else key)
+            elif isinstance(data, list) and isinstance(key, int) and key < len(data):
+                data = data[key]
+            else:
+                return None
+            if data is None:
+                return None
+        return data
+
+    def _read(self, data, fields, position=None) -> dict:
+        result = {}
+        for name, getter, coerce, has_default, default, each in fields:
+            value = position if getter is None else getter(data)
+            if value is None:
+                if has_default:
+                    result[name] = default
+                continue
+            if each is not None:
+                if not isinstance(value, list):
+                    raise ValueError(f"{name}: expected a list, got {type(value).__name__}")
+                value = [self._read(item, each, item_position) for item_position, item in enumerate(value)]
+            if coerce is not None:
+                try:
+                    value = coerce(value)
+                except (TypeError, ValueError) as e:
+                    raise ValueError(f"{name}: cannot convert {value!r}: {e}") from None
+            result[name] = value
+        return result
+
+    def load(self, output):
+        """The JSON document of the output (a string or an iterable of lines), a list of them for jsonl."""
+        try:
+            if self.lines:
+                lines = output.splitlines() if isinstance(output, str) else output
+                return [json.loads(line) for line in lines if line.strip()]
+            return json.loads(output if isinstance(output, str) else "\n".join(output))
+        except json.JSONDecodeError as e:
+            raise ValueError(f"{self.command_type} output is not {'JSON lines' if self.lines else 'JSON'}: {e}") \
+                from None
+
+    def parse(self, output) -> dict:
+        parsed = self._read(self.root(self.load(output)), self.fields)
+        if self.command_type == "acl":
+            return self._complete_acl(parsed)
+        return {**STRUCTURED_DEFAULTS.get(self.command_type, {}), **parsed}
+
+    def _complete_acl(self, parsed: dict) -> dict:
+        acl = {**STRUCTURED_DEFAULTS["acl"], **parsed}
+        mode = acl.pop("mode", None)
+        permissions = []
+        if mode is not None:
+            for posix_type, permission in zip(("owner", "group", "everyone"), mode):
+                if permission:
+                    permissions.append({"index": -1, "type": posix_type, "name": acl[posix_type],
+                                        "access": "allow", "permission": permission})
+        for position, ace in enumerate(acl["permissions"]):
+            permissions.append({"index": ace.get("index", position), **ACE_DEFAULTS, **ace})
+        acl["permissions"] = permissions
+        return acl
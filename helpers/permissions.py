@@ -0,0 +1,50 @@
+from enum import IntFlag
+
+
+class Permission(IntFlag):
+    """
+    The permissions of an ACE as bits, so merging ACEs is an OR and checking for a right is an AND.
+
+    Finer grained (NTFS style) rights can be added as further bits from 8 upwards, r, w and x stay the POSIX bits.
+    """
+    NONE = 0
+    X = 1
+    W = 2
+    R = 4
+
+    @classmethod
+    def parse(cls, value) -> "Permission":
+        """
+        Converts the representations used throughout the application: an int, a collection of letters like
+        {"r", "x"}, or a string like "rwx", "r,w,x" or "r-x".
+        """
+        if isinstance(value, int):
+            return cls(value)
+        if isinstance(value, str):
+            value = value.replace(',', '')
+        elif not isinstance(value, (set, frozenset, list, tuple)):
+            raise ValueError(f"Permission must be an int, a string or a collection, not {type(value).__name__}")
+
+        permission = cls.NONE
+        for letter in value:
+            if letter in ('-', ''):
+                continue
+            try:
+                permission |= LETTERS[letter]
+            except (KeyError, TypeError):
+                raise ValueError(f"Unknown permission {letter!r}") from None
+        return permission
+
+    @property
+    def letters(self) -> str:
+        """The permission as in the UI and mapped_permission keys, e.g. "rx"."""
+        return "".join(letter for letter, bit in LETTERS.items() if self & bit)
+
+    def __str__(self):
+        return self.letters
+
+    def __format__(self, format_spec):
+        return format(self.letters, format_spec)
+
+
+LETTERS = {"r": Permission.R, "w": Permission.W, "x": Permission.X}
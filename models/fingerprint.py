@@ -0,0 +1,34 @@
+from sqlalchemy import Column, String, Float, update
+from sqlalchemy.dialects import postgresql, sqlite
+from models.base import Base
+
+
+class Fingerprint(Base):
+    """The digest of the raw acl, quota and protocol output of a folder as of the last reconciliation."""
+    __tablename__ = 'fingerprint'
+
+    server = Column(String(100), primary_key=True)
+    folder_name = Column(String(100), primary_key=True)
+    digest = Column(String(64), nullable=False)
+    # When the folder was last probed, and when its digest last changed
+    checked_at = Column(Float, nullable=False)
+    changed_at = Column(Float, nullable=False)
+
+
+def store_fingerprints(session, server, digests: dict, checked: list, now: float):
+    """
+    Saves the new digests of changed folders and marks the unchanged ``checked`` folders as probed at ``now``,
+    in one statement each. Nothing is committed.
+    """
+    if digests:
+        dialect = postgresql if session.get_bind().dialect.name == 'postgresql' else sqlite
+        statement = dialect.insert(Fingerprint.__table__).values([
+            {"server": server, "folder_name": folder_name, "digest": digest, "checked_at": now, "changed_at": now}
+            for folder_name, digest in digests.items()])
+        session.execute(statement.on_conflict_do_update(
+            index_elements=['server', 'folder_name'],
+            set_={"digest": statement.excluded.digest, "checked_at": now, "changed_at": now}))
+    if checked:
+        session.execute(update(Fingerprint)
+                        .where(Fingerprint.server == server, Fingerprint.folder_name.in_(checked))
+                        .values(checked_at=now))
@@ -0,0 +1,54 @@
+import json
+import time
+
+from sqlalchemy import Column, Integer, String, Boolean, Float, Text, Index
+from models.base import Base
+
+
+class Job(Base):
+    __tablename__ = 'job'
+
+    id = Column(String(36), primary_key=True)
+    kind = Column(String(50), nullable=False)
+    server = Column(String(100), nullable=True)
+    payload = Column(Text, nullable=False, default='{}')
+    # queued, running, completed, failed or cancelled
+    status = Column(String(20), nullable=False, default='queued')
+    priority = Column(Integer, nullable=False, default=0)
+    attempts = Column(Integer, nullable=False, default=0)
+    max_attempts = Column(Integer, nullable=False, default=1)
+    cancel_requested = Column(Boolean, nullable=False, default=False)
+    worker = Column(String(100), nullable=True)
+    progress = Column(Text, nullable=True)
+    result = Column(Text, nullable=True)
+    message = Column(Text, nullable=True)
+    created_at = Column(Float, nullable=False, default=time.time)
+    run_after = Column(Float, nullable=False, default=0)
+    started_at = Column(Float, nullable=True)
+    finished_at = Column(Float, nullable=True)
+    heartbeat = Column(Float, nullable=True)
+
+    __table_args__ = (
+        Index('ix_job_status_priority', 'status', 'priority', 'created_at'),
+        Index('ix_job_server_status', 'server', 'status'),
+    )
+
+    def to_dict(self) -> dict:
+        """The job as returned by the API: progress and result fields are merged into the top level."""
+        data = {
+            'id': self.id,
+            'kind': self.kind,
+            'server': self.server,
+            'status': self.status,
+            'priority': self.priority,
+            'attempts': self.attempts,
+            'max_attempts': self.max_attempts,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+        }
+        data.update(json.loads(self.progress or '{}'))
+        data.update(json.loads(self.result or '{}'))
+        if self.message:
+            data['message'] = self.message
+        return data
@@ -0,0 +1,225 @@
+import base64
+import json
+import logging
+import shlex
+
+from sqlalchemy import text, Integer, Float, or_, and_, func, false
+from sqlalchemy.exc import OperationalError
+
+from helpers.permissions import Permission, LETTERS
+from models.share import Share
+
+# Columns of Share that are searchable, also usable as field qualifiers, e.g. "users:jdoe server:smdnas02"
+SEARCH_COLUMNS = ('customer', 'folder_name', 'server', 'protocol', 'owner', 'users', 'permission')
+
+_fts_enabled = False
+
+
+def _fts_value(column, prefix=""):
+    """The SQL expression indexed for a column, permission bits are indexed as their letters, e.g. "rx"."""
+    if column != 'permission':
+        return f"{prefix}{column}"
+    return " || ".join(f"(CASE WHEN {prefix}permission & {int(bit)} THEN '{letter}' ELSE '' END)"
+                       for letter, bit in LETTERS.items())
+
+
+def permission_tokens(term) -> list[str]:
+    """
+    The indexed letters of every permission that includes the permission of term, e.g. ["rx", "rwx"] for "rx",
+    so the index finds the same shares as the bitmask filter. Raises ValueError if term is not a permission.
+    """
+    wanted = Permission.parse(term)
+    bits = list(LETTERS.values())
+    permissions = {Permission(sum(int(bit) for number, bit in enumerate(bits) if subset >> number & 1))
+                   for subset in range(1, 2 ** len(bits))}
+    return sorted(str(permission) for permission in permissions if permission & wanted == wanted)
+
+
+def create_share_fts(engine) -> bool:
+    """
+    Creates the share_fts FTS5 index with triggers that keep it in sync with every INSERT, UPDATE (including
+    upserts) and DELETE on share, and fills it if it is out of date. Returns False if the database is not SQLite
+    or lacks FTS5, in which case search_shares falls back to LIKE scans.
+    """
+    global _fts_enabled
+    if engine.dialect.name != 'sqlite':
+        return False
+
+    columns = ", ".join(SEARCH_COLUMNS)
+    new_values = ", ".join(_fts_value(column, "new.") for column in SEARCH_COLUMNS)
+    values = ", ".join(_fts_value(column) for column in SEARCH_COLUMNS)
+    statements = [
+        # Keep '_', '-' and '.' inside tokens so folder, user and server names stay whole words
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS share_fts USING fts5({columns}, tokenize=\"unicode61 tokenchars '_-.'\")",
+        f"""CREATE TRIGGER IF NOT EXISTS share_fts_insert AFTER INSERT ON share BEGIN
+                INSERT INTO share_fts(rowid, {columns}) VALUES (new.id, {new_values});
+            END""",
+        """CREATE TRIGGER IF NOT EXISTS share_fts_delete AFTER DELETE ON share BEGIN
+                DELETE FROM share_fts WHERE rowid = old.id;
+            END""",
+        f"""CREATE TRIGGER IF NOT EXISTS share_fts_update AFTER UPDATE ON share BEGIN
+                DELETE FROM share_fts WHERE rowid = old.id;
+                INSERT INTO share_fts(rowid, {columns}) VALUES (new.id, {new_values});
+            END""",
+    ]
+    try:
+        with engine.begin() as conn:
+            # Triggers of an older index (e.g. permissions as "r,w,x") are replaced and the index is rebuilt
+            trigger = conn.exec_driver_sql("SELECT sql FROM sqlite_master WHERE type = 'trigger' "
+                                           "AND name = 'share_fts_insert'").scalar()
+            outdated = trigger is not None and new_values not in trigger
+            if outdated:
+                for name in ("share_fts_insert", "share_fts_update", "share_fts_delete"):
+                    conn.exec_driver_sql(f"DROP TRIGGER IF EXISTS {name}")
+            for statement in statements:
+                conn.exec_driver_sql(statement)
+            indexed = conn.exec_driver_sql("SELECT count(*) FROM share_fts").scalar()
+            rows = conn.exec_driver_sql("SELECT count(*) FROM share").scalar()
+            if outdated or indexed != rows:
+                logging.info(f"Rebuilding the share search index ({rows} rows)")
+                conn.exec_driver_sql("DELETE FROM share_fts")
+                conn.exec_driver_sql(f"INSERT INTO share_fts(rowid, {columns}) SELECT id, {values} FROM share")
+    except OperationalError as e:
+        logging.warning(f"SQLite FTS5 is not available, search falls back to LIKE: {e}")
+        return False
+
+    _fts_enabled = True
+    return True
+
+
+def parse_search(query: str) -> list[tuple[str | None, str]]:
+    """Splits a search string into (field, term) pairs, field is None for unqualified terms."""
+    try:
+        words = shlex.split(query)
+    except ValueError:
+        # Unbalanced quotes, search for the words as typed
+        words = query.split()
+
+    terms = []
+    for word in words:
+        field, _, term = word.partition(':')
+        if term and field.lower() in SEARCH_COLUMNS:
+            terms.append((field.lower(), term))
+        else:
+            terms.append((None, word))
+    return [(field, term) for field, term in terms if term]
+
+
+def fts_match(terms) -> str:
+    """
+    Builds an FTS5 MATCH expression where every term is a prefix match and all terms must match. Permission terms
+    match every permission that includes them, see permission_tokens.
+    """
+    expressions = []
+    for field, term in terms:
+        phrase = '"' + term.replace('"', '""') + '"*'
+        try:
+            permissions = " OR ".join(f'"{token}"' for token in permission_tokens(term))
+        except ValueError:
+            permissions = None
+        if field == 'permission':
+            expressions.append(f"permission : ({permissions})" if permissions else f"permission : {phrase}")
+        elif field:
+            expressions.append(f"{field} : {phrase}")
+        else:
+            expressions.append(f"({phrase} OR permission : ({permissions}))" if permissions else phrase)
+    return " AND ".join(expressions)
+
+
+def _permission_filter(term):
+    """Shares that have at least the permissions of term, None if term is not a permission."""
+    try:
+        permission = Permission.parse(term)
+    except ValueError:
+        return None
+    return Share.permission.op('&')(int(permission)) == int(permission)
+
+
+def search_shares(query: str, ranked=True):
+    """
+    Returns a Share query for a search string, ranked by relevance unless ranked is False. Terms are prefix
+    matches and may be qualified with a column, e.g. "users:jdoe server:smdnas02 lab". A permission matches the
+    shares that have at least that permission, e.g. "permission:rx" also finds "rwx".
+    """
+    terms = parse_search(query)
+    if not terms:
+        return Share.query
+    if any(field == 'permission' and _permission_filter(term) is None for field, term in terms):
+        return Share.query.filter(false())
+
+    if _fts_enabled:
+        fts = (text("SELECT rowid, bm25(share_fts) AS rank FROM share_fts WHERE share_fts MATCH :match")
+               .bindparams(match=fts_match(terms))
+               .columns(rowid=Integer, rank=Float)
+               .subquery())
+        query = Share.query.join(fts, fts.c.rowid == Share.id)
+        return query.order_by(fts.c.rank) if ranked else query
+
+    query = Share.query
+    for field, term in terms:
+        if field == 'permission':
+            query = query.filter(_permission_filter(term))
+            continue
+        columns = [field] if field else [column for column in SEARCH_COLUMNS if column != 'permission']
+        matches = [getattr(Share, column).ilike(f'%{term}%') for column in columns]
+        if not field and (permission := _permission_filter(term)) is not None:
+            matches.append(permission)
+        query = query.filter(or_(*matches))
+    return query
+
+
+# Columns the listing can be sorted on, Share.id breaks ties so every row has a unique position
+SORT_COLUMNS = ('id', 'index', 'quota', 'customer', 'folder_name', 'server', 'protocol', 'owner', 'users',
+                'permission')
+
+
+def encode_cursor(values: list) -> str:
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> list:
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError as e:
+        raise ValueError("Invalid cursor") from e
+    if not isinstance(values, list) or len(values) != 2:
+        raise ValueError("Invalid cursor")
+    return values
+
+
+def page_shares(query, sort='folder_name', direction='asc', after=None, limit=50):
+    """
+    Returns one page of a Share query with keyset pagination: instead of an OFFSET, the page starts right
+    after the (sort value, id) of the last row of the previous page, so every page costs the same.
+
+    Returns:
+        tuple: (rows, cursor for the next page or None on the last page)
+    """
+    if sort not in SORT_COLUMNS:
+        raise ValueError(f"Cannot sort on {sort}")
+    column = getattr(Share, sort)
+    if column.nullable:
+        # NULL never compares equal or greater, sort and seek on '' instead
+        column = func.coalesce(column, '')
+    descending = direction == 'desc'
+
+    if after:
+        value, last_id = decode_cursor(after)
+        if descending:
+            query = query.filter(or_(column < value, and_(column == value, Share.id < last_id)))
+        else:
+            query = query.filter(or_(column > value, and_(column == value, Share.id > last_id)))
+
+    if descending:
+        query = query.order_by(column.desc(), Share.id.desc())
+    else:
+        query = query.order_by(column.asc(), Share.id.asc())
+
+    # Fetch one extra row to know whether there is a next page
+    rows = query.limit(limit + 1).all()
+    cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        value = getattr(rows[-1], sort)
+        cursor = encode_cursor(['' if value is None else value, rows[-1].id])
+    return rows, cursor
@@ -1,8 +1,30 @@
 import re
-from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, UniqueConstraint
+import logging
+
+from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, UniqueConstraint, Index, select, update, delete
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.orm import relationship, validates
+from sqlalchemy.types import TypeDecorator
+
+from helpers.permissions import Permission
 from models.base import Base
 
+# Rows per INSERT ... ON CONFLICT statement, keeps the bound parameters well below SQLite's limit
+UPSERT_BATCH_SIZE = 500
+
+
+class PermissionType(TypeDecorator):
+    """Stores a helpers.permissions.Permission as its integer bits."""
+    impl = Integer
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return None if value is None else int(Permission.parse(value))
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else Permission(value)
+
+
 class Share(Base):
     __tablename__ = 'share'
 
@@ -15,13 +37,17 @@ class Share(Base):
     owner = Column(String(100), nullable=False)
     users = Column(String(200), nullable=False)
     index = Column(Integer, nullable=False, default=-1)
-    permission = Column(String(50), nullable=False)
+    permission = Column(PermissionType, nullable=False)
     parent_id = Column(Integer, ForeignKey('share.id'), nullable=True)
     parent = relationship('Share', remote_side=[id], backref='children')
     can_fix = Column(Boolean, nullable=False, default=True)
 
     __table_args__ = (
         UniqueConstraint('index', 'folder_name', name='unique_acl_constraint'),
+        # The unique constraint starts with index, so it does not help lookups by folder
+        Index('ix_share_folder_server', 'folder_name', 'server'),
+        Index('ix_share_server', 'server'),
+        Index('ix_share_parent_id', 'parent_id'),
     )
 
     @validates('quota')
@@ -31,6 +57,11 @@ class Share(Base):
             raise ValueError("Quota must be a positive number or 0 to unset")
         return value
 
+    @validates('index')
+    def validate_index(self, key, value):
+        # Parsers return the ACE index as a string
+        return int(value)
+
     @validates('folder_name', 'owner')
     def validate_posix(self, key, value):
         value = str(value)
@@ -38,7 +69,11 @@ class Share(Base):
             raise ValueError(f"{key} must be a valid POSIX string")
         return value
 
-    @validates('users', 'permission', 'protocol')
+    @validates('permission')
+    def validate_permission(self, key, value):
+        return Permission.parse(value)
+
+    @validates('users', 'protocol')
     def validate_unique_set(self, key, value):
         if isinstance(value, str):
             value = set(value.split(','))
@@ -48,4 +83,121 @@ class Share(Base):
             raise ValueError(f"{key} must be a string, set or a list")
         value.discard(None)
         value.discard('')
-        return ','.join(sorted(value))
\ No newline at end of file
+        return ','.join(sorted(value))
+
+    def to_dict(self) -> dict:
+        return {
+            'id': self.id,
+            'customer': self.customer,
+            'folder_name': self.folder_name,
+            'quota': self.quota,
+            'server': self.server,
+            'protocol': self.protocol,
+            'owner': self.owner,
+            'users': self.users,
+            'index': self.index,
+            'permission': str(self.permission),
+            'parent_id': self.parent_id,
+            'can_fix': self.can_fix,
+        }
+
+    @classmethod
+    def normalize(cls, **values) -> dict:
+        """Runs values through the column validators, for bulk statements that bypass the ORM."""
+        share = cls(**values)
+        return {key: getattr(share, key) for key in values}
+
+
+def migrate_permission_column(engine):
+    """
+    Converts share.permission from the comma separated letters it used to hold ("r,w,x") to Permission bits.
+    SQLite cannot change the type of a column, so the table is rebuilt. The search index and its triggers are
+    dropped with it and recreated by models.search.create_share_fts.
+    """
+    if engine.dialect.name != 'sqlite':
+        return
+    with engine.begin() as conn:
+        columns = {row[1]: row[2] for row in conn.exec_driver_sql("PRAGMA table_info(share)")}
+        if columns.get('permission', 'INTEGER').upper() == 'INTEGER':
+            return
+
+        count = conn.exec_driver_sql("SELECT count(*) FROM share").scalar()
+        logging.info(f"Converting the permissions of {count} shares to bits")
+        for statement in ("DROP TRIGGER IF EXISTS share_fts_insert", "DROP TRIGGER IF EXISTS share_fts_update",
+                          "DROP TRIGGER IF EXISTS share_fts_delete", "DROP TABLE IF EXISTS share_fts"):
+            conn.exec_driver_sql(statement)
+        for index in Share.__table__.indexes:
+            conn.exec_driver_sql(f"DROP INDEX IF EXISTS {index.name}")
+        conn.exec_driver_sql("ALTER TABLE share RENAME TO share_old")
+        Share.__table__.create(conn)
+
+        names = ", ".join(f'"{column.name}"' for column in Share.__table__.columns)
+        bits = " + ".join(f"(instr(permission, '{letter}') > 0) * {int(bit)}"
+                          for letter, bit in (("r", Permission.R), ("w", Permission.W), ("x", Permission.X)))
+        values = names.replace('"permission"', f"({bits})")
+        conn.exec_driver_sql(f"INSERT INTO share ({names}) SELECT {values} FROM share_old")
+        conn.exec_driver_sql("DROP TABLE share_old")
+
+
+def create_share_indexes(engine):
+    """create_all only adds indexes to new tables, this adds the ones an existing share table is missing."""
+    for index in Share.__table__.indexes:
+        index.create(engine, checkfirst=True)
+
+
+def _upsert(session, rows: list[dict]) -> dict:
+    """INSERT ... ON CONFLICT (index, folder_name) DO UPDATE, returns {index: id} of the written rows."""
+    dialect = postgresql if session.get_bind().dialect.name == 'postgresql' else sqlite
+    ids = {}
+    for start in range(0, len(rows), UPSERT_BATCH_SIZE):
+        statement = dialect.insert(Share.__table__).values(rows[start:start + UPSERT_BATCH_SIZE])
+        statement = statement.on_conflict_do_update(
+            index_elements=['index', 'folder_name'],
+            set_={key: statement.excluded[key] for key in rows[0] if key not in ('index', 'folder_name')})
+        ids.update((index, share_id) for share_id, index in
+                   session.execute(statement.returning(Share.id, Share.index)))
+    return ids
+
+
+def reconcile_acl(session, folder_name, rows: list[dict]) -> dict:
+    """
+    Makes the stored ACL of a folder match ``rows`` (one dict of Share columns per ACE) in a fixed number of
+    statements: one SELECT of the existing rows, batched upserts for new and changed ACEs and one DELETE for the
+    ACEs that no longer exist on the server. Rows with a negative index (mode bits or rows created here) are
+    never deleted, and an empty ``rows`` raises a ValueError rather than wiping the folder.
+
+    Nothing is committed, the statements run in the session's transaction.
+
+    Returns:
+        dict: {"ids": {index: id}, "inserted", "updated", "unchanged", "deleted"}
+    """
+    # A folder has one row per index, a later ACE with the same index (e.g. the mode bits) replaces an earlier one
+    rows = {row['index']: row for row in (Share.normalize(**row, folder_name=folder_name) for row in rows)}
+    rows = list(rows.values())
+    if not rows:
+        raise ValueError(f"No ACL to store for {folder_name}")
+    columns = [Share.__table__.c[key] for key in rows[0] if key != 'index']
+    existing = {row.index: row for row in session.execute(
+        select(Share.id, Share.index, *columns).where(Share.folder_name == folder_name)).all()}
+
+    indexes = {row['index'] for row in rows}
+    changed = [row for row in rows if row['index'] not in existing
+               or any(getattr(existing[row['index']], key) != value for key, value in row.items())]
+    stale = [row.id for index, row in existing.items() if index >= 0 and index not in indexes]
+    ids = {index: row.id for index, row in existing.items() if index < 0 or index in indexes}
+    summary = {
+        "inserted": sum(row['index'] not in existing for row in changed),
+        "updated": sum(row['index'] in existing for row in changed),
+        "unchanged": len(rows) - len(changed),
+        "deleted": len(stale),
+    }
+
+    if changed:
+        ids.update(_upsert(session, changed))
+    if stale:
+        # Subfolders hang off one of the folder's rows, move them to a row that stays
+        session.execute(update(Share).where(Share.parent_id.in_(stale)).values(parent_id=ids[min(ids)]))
+        session.execute(delete(Share).where(Share.id.in_(stale)))
+
+    summary["ids"] = dict(sorted(ids.items()))
+    return summary